@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Benchmark first-level fits and design matrix construction
+
+A synthetic BOLD series (``--shape``, default 64x64x40x400) is written with
+the effects of a random design and noise, and a box mask filling
+``--mask-fill`` of the field of view. Each case is run in a fresh process,
+and its time and peak resident memory are reported:
+
+* ``native``, ``nistats``: the FirstLevelModel interfaces, cropped to the
+  mask
+* ``native, no crop``: the native fit of the full field of view
+* ``native, streamed``: the native fit within ``--max-mem-gb``
+* ``native, streamed .gz``: the same, reading a compressed series through
+  its gzip index
+* ``nistats, .gz``: the nistats fit of the compressed series
+* ``nistats, cached .gz``: the second of two fits of a compressed series
+  with a BOLD cache
+* ``design: convolution``, ``design: TR grid``: event regressors of
+  ``--conditions`` conditions over ``--design-vols`` volumes
+
+Usage::
+
+    python benchmarks/bench_first_level.py --shape 64 64 40 400
+
+Figures depend on the machine, its disk and its BLAS.
+"""
+import os
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+CONTRAST_INFO = [{'name': 'a-b', 'type': 't', 'weights': [{'a': 1, 'b': -1}],
+                  'entities': {}},
+                 {'name': 'abc', 'type': 'F', 'weights': [{'a': 1}, {'b': 1}, {'c': 1}],
+                  'entities': {}}]
+
+
+def make_inputs(path, shape, mask_fill, seed=0):
+    """ Write a BOLD series, uncompressed and compressed, a mask and a design """
+    import nibabel as nb
+    from fitlins.utils.design import save_design_matrix
+
+    rng = np.random.RandomState(seed)
+    n_vols = shape[-1]
+    mat = pd.DataFrame(rng.randn(n_vols, 3), columns=['a', 'b', 'c']).assign(constant=1.)
+    mat.index = np.arange(n_vols) * 2.
+    data = np.empty(shape, dtype=np.float32)
+    betas = rng.randn(*shape[:-1], 4).astype(np.float32)
+    for ix in range(shape[2]):
+        data[:, :, ix] = 1000 + betas[:, :, ix] @ mat.to_numpy(dtype=np.float32).T
+        data[:, :, ix] += rng.randn(*shape[:2], n_vols)
+
+    mask = np.zeros(shape[:-1], dtype=np.uint8)
+    side = mask_fill ** (1 / 3)
+    mask[tuple(slice(int(dim * (1 - side) / 2), int(dim * (1 + side) / 2))
+               for dim in shape[:-1])] = 1
+
+    affine = np.diag([3., 3., 3., 1.])
+    inputs = {'bold_file': os.path.join(path, 'bold.nii'),
+              'mask_file': os.path.join(path, 'mask.nii'),
+              'design_matrix': os.path.join(path, 'design.npz'),
+              'contrast_info': CONTRAST_INFO}
+    img = nb.Nifti1Image(data, affine)
+    img.to_filename(inputs['bold_file'])
+    img.to_filename(os.path.join(path, 'bold.nii.gz'))
+    nb.Nifti1Image(mask, affine).to_filename(inputs['mask_file'])
+    save_design_matrix(inputs['design_matrix'], mat)
+    return inputs, mask.mean()
+
+
+def make_runs(n_vols, n_conditions, seed=0):
+    rng = np.random.RandomState(seed)
+    n_events = n_vols // 2
+    events = pd.DataFrame({
+        'onset': np.sort(rng.uniform(0, n_vols * 2., n_events)),
+        'duration': 1.,
+        'trial_type': ['c{:02d}'.format(ix) for ix in rng.randint(n_conditions, size=n_events)],
+        'modulation': 1.})
+    return [{'repetition_time': 2., 'n_vols': n_vols, 'events': events, 'drift_model': None}]
+
+
+def fit(module, inputs, crop=True):
+    if not crop:
+        module.crop_to_mask = lambda *args: None
+    module.FirstLevelModel(**inputs).run()
+
+
+def run_case(case, inputs, opts, workdir):
+    """ Run one case in ``workdir``; return its time (s) and peak RSS (MB) """
+    from fitlins.interfaces import native, nistats
+    from fitlins.stats.hrf import make_design_matrices
+
+    os.makedirs(workdir)
+    os.chdir(workdir)
+    gz_inputs = dict(inputs, bold_file=inputs['bold_file'] + '.gz')
+    cache = os.path.join(workdir, 'cache')
+    cases = {
+        'native': lambda: fit(native, inputs),
+        'nistats': lambda: fit(nistats, inputs),
+        'native, no crop': lambda: fit(native, inputs, crop=False),
+        'native, streamed': lambda: fit(native, dict(inputs, max_mem_gb=opts.max_mem_gb)),
+        'native, streamed .gz': lambda: fit(native, dict(gz_inputs,
+                                                         max_mem_gb=opts.max_mem_gb)),
+        'nistats, .gz': lambda: fit(nistats, gz_inputs),
+        'nistats, cached .gz': lambda: fit(nistats, dict(gz_inputs, bold_cache=cache)),
+        'design: convolution': lambda: make_design_matrices(
+            make_runs(opts.design_vols, opts.conditions)),
+        'design: TR grid': lambda: make_design_matrices(
+            make_runs(opts.design_vols, opts.conditions), tr_grid=True),
+    }
+    if case == 'nistats, cached .gz':
+        # Time the second fit, from a warm cache
+        cases[case]()
+    start = time.perf_counter()
+    cases[case]()
+    elapsed = time.perf_counter() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+CASES = ['native', 'nistats', 'native, no crop', 'native, streamed', 'native, streamed .gz',
+         'nistats, .gz', 'nistats, cached .gz', 'design: convolution', 'design: TR grid']
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--shape', type=int, nargs=4, default=[64, 64, 40, 400],
+                        metavar=('X', 'Y', 'Z', 'T'))
+    parser.add_argument('--mask-fill', type=float, default=.6,
+                        help='fraction of the field of view within the mask')
+    parser.add_argument('--max-mem-gb', type=float, default=.25,
+                        help='memory budget of streamed fits')
+    parser.add_argument('--design-vols', type=int, default=2000)
+    parser.add_argument('--conditions', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('cases', nargs='*', metavar='CASE',
+                        help='cases to run (default: all); any of %s'
+                        % ', '.join(repr(case) for case in CASES))
+    opts = parser.parse_args()
+    unknown = set(opts.cases) - set(CASES)
+    if unknown:
+        parser.error('unknown cases: %s' % ', '.join(sorted(unknown)))
+    opts.cases = opts.cases or CASES
+
+    tmp_dir = tempfile.mkdtemp()
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        inputs, fill = make_inputs(tmp_dir, opts.shape, opts.mask_fill)
+        for case in opts.cases:
+            runs = []
+            for ix in range(opts.repeat):
+                workdir = os.path.join(tmp_dir, 'work-{}-{}'.format(len(results), ix))
+                with ctx.Pool(1) as pool:
+                    runs.append(pool.apply(run_case, (case, inputs, opts, workdir)))
+            results.append((case, min(elapsed for elapsed, _ in runs),
+                            max(rss for _, rss in runs)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('{} series, mask fills {:.0%}; {} conditions over {} volumes; best of {}'.format(
+        'x'.join(map(str, opts.shape)), fill, opts.conditions, opts.design_vols, opts.repeat))
+    print('  {:<24}{:>10}{:>14}'.format('case', 'time', 'peak RSS'))
+    for case, elapsed, rss in results:
+        print('  {:<24}{:8.2f} s{:10.0f} MB'.format(case, elapsed, rss))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Benchmark the threaded dataset scan and the construction of the shared index
+
+A synthetic dataset is written to a temporary directory, with raw and
+fMRIPrep-like derivative files for each subject. Directory listings may be
+slowed down with ``--latency``, which delays every call to :func:`os.scandir`
+to model network storage.
+
+Each row is the best of ``--repeat`` runs:
+
+* ``walk (serial)``: a serial :func:`os.walk` of the dataset, ``stat``-ing
+  every file
+* ``scan (N threads)``: :func:`fitlins.utils.bids._scan_tree` of each root,
+  with ``--workers`` threads
+* ``layout: BIDSLayout``: the single-threaded baseline, construction of a
+  persisted index by :class:`bids.layout.BIDSLayout` alone
+* ``layout: scan + walk``: the threaded scan of each root, followed by the
+  same :class:`bids.layout.BIDSLayout` construction, which walks the dataset
+  again
+* ``layout: scan + listing``: :func:`fitlins.utils.bids.init_layout`, which
+  scans each root with ``--workers`` threads and builds the index from the
+  scanned listing
+
+Layout rows are skipped with ``--no-layout``.
+
+Usage::
+
+    python benchmarks/bench_index.py --subjects 150 --workers 8 --latency 5
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
+
+def make_tree(root, n_subjects, n_runs):
+    """ Write empty raw and derivative files of ``n_subjects`` subjects """
+    deriv = os.path.join(root, 'derivatives', 'fmriprep')
+    os.makedirs(deriv)
+    for path in (root, deriv):
+        with open(os.path.join(path, 'dataset_description.json'), 'w') as fobj:
+            json.dump({'Name': 'bench', 'BIDSVersion': '1.1.1',
+                       'PipelineDescription': {'Name': 'fmriprep'}}, fobj)
+    with open(os.path.join(root, 'task-x_bold.json'), 'w') as fobj:
+        json.dump({'RepetitionTime': 2.0, 'TaskName': 'x'}, fobj)
+
+    space = 'space-MNI152NLin2009cAsym'
+    for ix in range(n_subjects):
+        sub = 'sub-{:04d}'.format(ix)
+        func = os.path.join(root, sub, 'func')
+        deriv_func = os.path.join(deriv, sub, 'func')
+        os.makedirs(func)
+        os.makedirs(deriv_func)
+        for run in range(1, n_runs + 1):
+            prefix = '{}_task-x_run-{}'.format(sub, run)
+            names = [(func, prefix + '_bold.nii.gz'),
+                     (func, prefix + '_events.tsv'),
+                     (deriv_func, prefix + '_desc-confounds_regressors.tsv'),
+                     (deriv_func, '{}_{}_desc-preproc_bold.nii.gz'.format(prefix, space)),
+                     (deriv_func, '{}_{}_desc-preproc_bold.json'.format(prefix, space)),
+                     (deriv_func, '{}_{}_desc-brain_mask.nii.gz'.format(prefix, space))]
+            for dirname, fname in names:
+                with open(os.path.join(dirname, fname), 'w') as fobj:
+                    fobj.write('{}' if fname.endswith('.json') else '')
+
+
+@contextmanager
+def scandir_latency(latency):
+    """ Delay every directory listing by ``latency`` seconds """
+    scandir = os.scandir
+
+    def delayed(*args, **kwargs):
+        time.sleep(latency)
+        return scandir(*args, **kwargs)
+
+    os.scandir = delayed
+    try:
+        yield
+    finally:
+        os.scandir = scandir
+
+
+def best_of(repeat, func, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def walk(root):
+    for dirpath, _, files in os.walk(root):
+        for fname in files:
+            os.stat(os.path.join(dirpath, fname))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--subjects', type=int, default=150)
+    parser.add_argument('--runs', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0., metavar='MS',
+                        help='delay of each directory listing (ms)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-layout', action='store_false', dest='layout',
+                        help='only time the walk and the scan')
+    opts = parser.parse_args()
+
+    from bids.layout import BIDSLayout
+    from fitlins.utils.bids import _derivative_roots, _scan_tree, init_layout
+
+    tmp_dir = tempfile.mkdtemp()
+    root = os.path.join(tmp_dir, 'ds')
+    db_dir = os.path.join(tmp_dir, 'db')
+    try:
+        make_tree(root, opts.subjects, opts.runs)
+        roots = [root] + _derivative_roots(root, True)
+
+        def reset_db():
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+        results = []
+        with scandir_latency(opts.latency / 1000):
+            results.append(('walk (serial)', best_of(opts.repeat, lambda: walk(root))))
+            results.append(('scan ({} threads)'.format(opts.workers), best_of(
+                opts.repeat,
+                lambda: [_scan_tree(path, n_workers=opts.workers) for path in roots])))
+            if opts.layout:
+                results.append(('layout: BIDSLayout', best_of(
+                    opts.repeat,
+                    lambda: BIDSLayout(root, derivatives=True, database_path=db_dir,
+                                       reset_database=True),
+                    reset_db)))
+                results.append(('layout: scan + walk', best_of(
+                    opts.repeat,
+                    lambda: ([_scan_tree(path, n_workers=opts.workers) for path in roots],
+                             BIDSLayout(root, derivatives=True, database_path=db_dir,
+                                        reset_database=True)),
+                    reset_db)))
+                results.append(('layout: scan + listing', best_of(
+                    opts.repeat,
+                    lambda: init_layout(root, derivatives=True, database_path=db_dir,
+                                        n_workers=opts.workers),
+                    reset_db)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('{} subjects, {} runs, {} ms latency per listing, best of {}'.format(
+        opts.subjects, opts.runs, opts.latency, opts.repeat))
+    for name, elapsed in results:
+        print('  {:<28}{:8.2f} s'.format(name, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,6 @@ from argparse import ArgumentParser
 from argparse import RawTextHelpFormatter
 from multiprocessing import cpu_count
 
-from bids.layout import BIDSLayout
 from bids.analysis import auto_model, Analysis
 
 from .. import __version__
@@ -51,6 +50,13 @@ def default_path(arg, base_dir, default_name):
     return path
 
 
+def _sampling_rate(value):
+    """Parse a sampling rate in Hz, or 'TR'"""
+    if value.upper() == 'TR':
+        return 'TR'
+    return float(value)
+
+
 def get_parser():
     """Build parser object"""
     verstr = 'fitlins v{}'.format(__version__)
@@ -103,10 +109,49 @@ def get_parser():
                              "Optional smoothing TYPE (default: iso) must be one of: `iso` (isotropic). "
                              "e.g., `--smoothing 5:dataset:iso` will perform a 5mm FWHM isotropic "
                              "smoothing on subject-level maps, before evaluating the dataset level.")
+    g_prep.add_argument('--shared-mask', action='store_true', default=False,
+                        help="fit all runs of a subject within a single mask per space: the "
+                             "intersection of their brain masks, computed from mean BOLD "
+                             "images where missing")
 
     g_perfm = parser.add_argument_group('Options to handle performance')
     g_perfm.add_argument('--n-cpus', action='store', default=0, type=int,
                          help='maximum number of threads across all processes')
+    g_perfm.add_argument('--index-workers', action='store', type=int,
+                         help='number of threads used to scan the dataset for indexing '
+                              '(default: --n-cpus)')
+    g_perfm.add_argument('--subjects-per-loader', action='store', type=int,
+                         help='load the model for this many subjects at a time, in '
+                              'separate processes, and validate and fit the runs of each '
+                              'batch as soon as it is loaded (default: all subjects at once)')
+    g_perfm.add_argument('--design-engine', action='store',
+                         choices=['nistats', 'native', 'native-tr'], default='nistats',
+                         help='build design matrices with nistats, one run at a time, or with '
+                              'the native engine, convolving all runs with a shared TR and '
+                              'length at once; native-tr evaluates event regressors at '
+                              'acquisition times, without an oversampled grid')
+    g_perfm.add_argument('--estimator', action='store', choices=['nistats', 'native'],
+                         default='nistats',
+                         help='fit first-level models with nistats, or with the native '
+                              'vectorized OLS/AR(1) estimator')
+    g_perfm.add_argument('--max-node-mem', action='store', type=float, metavar='GB',
+                         help='memory budget of each first-level fit; BOLD series are '
+                              'read and fit in chunks within it (requires --estimator native)')
+    g_perfm.add_argument('--bold-cache', action='store_true', default=False,
+                         help='decompress each BOLD series once into the working directory, '
+                              'and fit models to the uncompressed copies')
+    g_perfm.add_argument('--bold-cache-gb', action='store', type=float, metavar='GB',
+                         help='maximum size of the BOLD cache; least recently used series '
+                              'are removed beyond it (default: unlimited)')
+    g_perfm.add_argument('--precision', action='store', choices=['float64', 'float32'],
+                         default='float64',
+                         help='floating point precision of written maps, at all levels; '
+                              'only the native first-level estimator also holds data and '
+                              'estimates at this precision, while nistats and higher-level '
+                              'models estimate in double precision')
+    g_perfm.add_argument('--sampling-rate', action='store', type=_sampling_rate,
+                         help="rate (Hz) at which transformations densify sparse variables, "
+                              "or 'TR' for the acquisition rate of each run (default: 10)")
     g_perfm.add_argument('--debug', action='store_true', default=False,
                          help='run debug version of workflow')
     g_perfm.add_argument('--reports-only', action='store_true', default=False,
@@ -117,23 +162,25 @@ def get_parser():
                          help='path where intermediate results should be stored')
     g_other.add_argument('--drop-missing', action='store_true', default=False,
                          help='drop missing inputs/contrasts in model fitting.')
+    g_other.add_argument('--no-validate-model', action='store_false', dest='validate_model',
+                         help='do not check the model against all runs before fitting '
+                              'any (by default, all problems are reported at once, for all '
+                              'subjects or, with --subjects-per-loader, for each batch)')
     return parser
 
 
 def run_fitlins(argv=None):
     warnings.showwarning = _warn_redirect
-    opts = get_parser().parse_args(argv)
+    parser = get_parser()
+    opts = parser.parse_args(argv)
+    if opts.max_node_mem is not None and opts.estimator != 'native':
+        parser.error('--max-node-mem requires --estimator native')
     if opts.debug:
         logger.setLevel(logging.DEBUG)
     if not opts.space:
         # make it an explicit None
         opts.space = None
 
-    subject_list = None
-    if opts.participant_label is not None:
-        subject_list = bids.collect_participants(
-            opts.bids_dir, participant_label=opts.participant_label)
-
     ncpus = opts.n_cpus
     if ncpus < 1:
         ncpus = cpu_count()
@@ -147,6 +194,40 @@ def run_fitlins(argv=None):
         }
     }
 
+    derivatives = True if not opts.derivatives else opts.derivatives
+    # Need this when specifying args directly (i.e. neuroscout)
+    # god bless neuroscout, but let's make it work for others!
+    if isinstance(derivatives, list) and len(derivatives) == 1:
+        # WRONG AND EVIL to those who have spaces in their paths... bad bad practice
+        # TODO - fix neuroscout
+        derivatives = derivatives[0].split(" ")
+
+    work_dir = mkdtemp() if opts.work_dir is None else opts.work_dir
+
+    # Avoid indexing subjects, spaces and BOLD series that will never be selected
+    ignore = bids.add_selector_patterns(
+        opts.ignore, opts.bids_dir, derivatives=derivatives,
+        participants=opts.participant_label, space=opts.space, desc=opts.desc_label)
+
+    # Index the dataset once; all interfaces and reports reuse this snapshot
+    # The index persists in the working directory, and is incrementally
+    # updated when rerunning with the same dataset and indexing options
+    database_path = bids.layout_cache_path(
+        op.join(work_dir, 'dbcache'), opts.bids_dir, derivatives=derivatives,
+        ignore=ignore, force_index=opts.force_index)
+    layout = bids.init_layout(
+        opts.bids_dir, derivatives=derivatives,
+        ignore=ignore, force_index=opts.force_index,
+        database_path=database_path, n_workers=opts.index_workers or ncpus)
+    # Parsed events and confounds are shared by all models fit to the dataset
+    variable_cache = op.join(work_dir, 'dbcache', 'variables')
+    bold_cache = op.join(work_dir, 'dbcache', 'bold') if opts.bold_cache else None
+
+    subject_list = None
+    if opts.participant_label is not None or opts.subjects_per_loader:
+        subject_list = bids.collect_participants(
+            layout, participant_label=opts.participant_label)
+
     # Build main workflow
     logger.log(25, INIT_MSG(
         version=__version__,
@@ -157,14 +238,6 @@ def run_fitlins(argv=None):
     if opts.model in (None, 'default') and not op.exists(model):
         model = 'default'
 
-    derivatives = True if not opts.derivatives else opts.derivatives
-    # Need this when specifying args directly (i.e. neuroscout)
-    # god bless neuroscout, but let's make it work for others!
-    if isinstance(derivatives, list) and len(derivatives) == 1:
-        # WRONG AND EVIL to those who have spaces in their paths... bad bad practice
-        # TODO - fix neuroscout
-        derivatives = derivatives[0].split(" ")
-
     pipeline_name = 'fitlins'
     if opts.derivative_label:
         pipeline_name += '_' + opts.derivative_label
@@ -173,15 +246,20 @@ def run_fitlins(argv=None):
 
     bids.write_derivative_description(opts.bids_dir, deriv_dir)
 
-    work_dir = mkdtemp() if opts.work_dir is None else opts.work_dir
-
     fitlins_wf = init_fitlins_wf(
         opts.bids_dir, derivatives, deriv_dir,
         analysis_level=opts.analysis_level, model=model,
         space=opts.space, desc=opts.desc_label,
         participants=subject_list, base_dir=work_dir,
-        force_index=opts.force_index, ignore=opts.ignore,
+        force_index=opts.force_index, ignore=ignore,
         smoothing=opts.smoothing, drop_missing=opts.drop_missing,
+        database_path=database_path, design_engine=opts.design_engine,
+        estimator=opts.estimator, max_node_mem=opts.max_node_mem,
+        bold_cache=bold_cache, bold_cache_gb=opts.bold_cache_gb,
+        precision=opts.precision, shared_mask=opts.shared_mask,
+        validate_model=opts.validate_model,
+        n_procs=ncpus, subjects_per_loader=opts.subjects_per_loader,
+        variable_cache=variable_cache, sampling_rate=opts.sampling_rate,
         )
 
     if opts.work_dir:
@@ -196,7 +274,6 @@ def run_fitlins(argv=None):
         except Exception:
             retcode = 1
 
-    layout = BIDSLayout(opts.bids_dir, derivatives=derivatives)
     models = auto_model(layout) if model == 'default' else [model]
 
     run_context = {'version': __version__,
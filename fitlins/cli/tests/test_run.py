@@ -0,0 +1,128 @@
+import json
+
+import pandas as pd
+import pytest
+
+from ...conftest import SPACE
+from ...interfaces.bids import LoadBIDSModel
+from ...utils.bids import compile_patterns, format_patterns
+from ... import workflows
+from .. import run
+
+
+class _Stop(Exception):
+    pass
+
+
+def test_run_fitlins_ignore(bids_dir, tmp_path, monkeypatch):
+    calls = {}
+
+    def init_fitlins_wf(*args, **kwargs):
+        calls.update(kwargs)
+        raise _Stop
+
+    monkeypatch.setattr(run, 'init_fitlins_wf', init_fitlins_wf)
+    with pytest.raises(_Stop):
+        run.run_fitlins([str(bids_dir), str(tmp_path / 'out'), 'participant',
+                         '--participant-label', '01', '--space', SPACE,
+                         '--ignore', '/_echo-2_/', '-w', str(tmp_path / 'work')])
+
+    # The workflow uses the same patterns as the index, including those
+    # excluding subjects and spaces that will not be selected
+    ignore = calls['ignore']
+    assert compile_patterns('/_echo-2_/')[0] in ignore
+    ignored = [patt for patt in ignore if hasattr(patt, 'search')]
+    assert any(patt.search(str(bids_dir / 'sub-02')) for patt in ignored)
+    assert any(patt.search('sub-01_space-T1w_desc-preproc_bold.nii.gz') for patt in ignored)
+    assert not any(patt.search(str(bids_dir / 'sub-01')) for patt in ignored)
+
+    # Loaders take the patterns as strings
+    loader = LoadBIDSModel(ignore=format_patterns(ignore))
+    assert compile_patterns(loader.inputs.ignore) == ignore
+
+
+MODEL = {'Name': 'test', 'Input': {'Task': 'x'},
+         'Steps': [{'Level': 'run',
+                    'Transformations': [{'Name': 'Factor', 'Input': ['trial_type']}],
+                    'Model': {'X': ['trial_type.a', 'trial_type.b', 'trans_x']},
+                    'Contrasts': [{'Name': 'a_vs_b', 'ConditionList': ['trial_type.a',
+                                                                       'trial_type.b'],
+                                   'Weights': [1, -1], 'Type': 't'}]}]}
+
+
+def _build_workflow(bids_dir, tmp_path, monkeypatch, *args):
+    """ Build the workflow ``run_fitlins`` would run with additional ``args`` """
+    model = tmp_path / 'model.json'
+    model.write_text(json.dumps(MODEL))
+    argv = [str(bids_dir), str(tmp_path / 'out'), 'run', '--space', SPACE,
+            '-m', str(model), '-w', str(tmp_path / 'work')] + list(args)
+    built = {}
+
+    def init_fitlins_wf(*args, **kwargs):
+        built['wf'] = workflows.init_fitlins_wf(*args, **kwargs)
+        raise _Stop
+
+    monkeypatch.setattr(run, 'init_fitlins_wf', init_fitlins_wf)
+    with pytest.raises(_Stop):
+        run.run_fitlins(argv)
+    return built['wf']
+
+
+def test_run_fitlins_single_loader(bids_dir, tmp_path, monkeypatch):
+    wf = _build_workflow(bids_dir, tmp_path, monkeypatch)
+
+    # By default, all subjects are loaded by a single loader feeding a single
+    # set of first-level nodes
+    names = wf.list_node_names()
+    assert 'loader' in names and 'l1_model' in names
+    assert not any(name.startswith(('loader_', 'l1_model_', 'merge_')) for name in names)
+
+    wf = _build_workflow(bids_dir, tmp_path, monkeypatch, '--subjects-per-loader', '1')
+    names = wf.list_node_names()
+    assert {'loader_0', 'loader_1', 'merge_loaders', 'l1_model_0', 'l1_model_1'} <= set(names)
+
+    # Each shard is validated, designed and fit independently of later shards
+    import networkx as nx
+    upstream = {node.name for node in nx.ancestors(wf._graph, wf.get_node('l1_model_0'))}
+    assert 'validate_model_0' in upstream
+    assert not any(name.endswith('_1') for name in upstream)
+
+
+def test_run_fitlins_validates_each_shard(bids_dir, tmp_path, monkeypatch):
+    # The second subject has an empty regressor
+    for confounds in bids_dir.glob('derivatives/fmriprep/sub-02/func/*_regressors.tsv'):
+        data = pd.read_csv(str(confounds), sep='\t')
+        data['trans_x'] = 'n/a'
+        data.to_csv(str(confounds), sep='\t', index=False)
+    wf = _build_workflow(bids_dir, tmp_path, monkeypatch, '--subjects-per-loader', '1')
+    wf.config['execution']['stop_on_first_crash'] = True
+
+    # The runs of the second subject are validated together, and none of them
+    # is fit
+    with pytest.raises(RuntimeError, match="Regressor 'trans_x' is empty in 2 of 2 runs"):
+        wf.run(plugin='Linear')
+    work_dir = tmp_path / 'work' / wf.name
+    assert (work_dir / 'validate_model_1').exists()
+    assert not list(work_dir.glob('design_matrix_1')) and not list(work_dir.glob('l1_model_1'))
+
+
+def test_run_fitlins_parallel_loader(bids_dir, tmp_path, monkeypatch):
+    from concurrent import futures
+
+    wf = _build_workflow(bids_dir, tmp_path, monkeypatch, '--n-cpus', '2')
+    loader = wf.get_node('loader')
+    assert loader.n_procs == loader.inputs.n_procs == 2
+
+    # The subjects of the single default loader are loaded by two workers
+    workers = []
+
+    class Pool(futures.ProcessPoolExecutor):
+        def __init__(self, max_workers=None, *args, **kwargs):
+            workers.append(max_workers)
+            super(Pool, self).__init__(max_workers, *args, **kwargs)
+
+    monkeypatch.setattr(futures, 'ProcessPoolExecutor', Pool)
+    monkeypatch.chdir(tmp_path)
+    outputs = loader.interface.run().outputs
+    assert workers == [2]
+    assert {ents['subject'] for ents in outputs.entities[0]} == {'01', '02'}
@@ -0,0 +1,63 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+SPACE = 'MNI152NLin2009cAsym'
+CONFOUNDS = ['framewise_displacement', 'a_comp_cor_00', 'a_comp_cor_01', 'trans_x',
+             'trans_y', 'white_matter', 'non_steady_state_outlier00']
+
+
+def make_dataset(root, subjects=('01', '02'), runs=(1, 2), n_vols=40, shape=(3, 3, 3),
+                 seed=0):
+    """ Write a small BIDS dataset with fMRIPrep-like derivatives to ``root``
+
+    Each run has ``a``/``b`` events, a confounds file with the columns in
+    ``CONFOUNDS``, and a preprocessed BOLD series and brain mask in ``SPACE``.
+    """
+    import nibabel as nb
+
+    rng = np.random.RandomState(seed)
+    deriv = root / 'derivatives' / 'fmriprep'
+    deriv.mkdir(parents=True)
+    (root / 'dataset_description.json').write_text(
+        json.dumps({'Name': 'test', 'BIDSVersion': '1.1.1'}))
+    (deriv / 'dataset_description.json').write_text(
+        json.dumps({'Name': 'test', 'BIDSVersion': '1.1.1',
+                    'PipelineDescription': {'Name': 'fmriprep'}}))
+    (root / 'task-x_bold.json').write_text(json.dumps({'RepetitionTime': 2.0,
+                                                       'TaskName': 'x'}))
+    affine = np.diag([3., 3., 3., 1.])
+    for sub in subjects:
+        func = root / 'sub-{}'.format(sub) / 'func'
+        deriv_func = deriv / 'sub-{}'.format(sub) / 'func'
+        func.mkdir(parents=True)
+        deriv_func.mkdir(parents=True)
+        for run in runs:
+            prefix = 'sub-{}_task-x_run-{}'.format(sub, run)
+            data = (1000 + rng.randn(*shape, n_vols) * 10).astype(np.float32)
+            nb.Nifti1Image(data, affine).to_filename(str(func / (prefix + '_bold.nii.gz')))
+            onsets = np.arange(0, n_vols * 2 - 10, 10.)
+            pd.DataFrame({'onset': onsets,
+                          'duration': 2.,
+                          'trial_type': np.resize(['a', 'b'], len(onsets))}).to_csv(
+                str(func / (prefix + '_events.tsv')), sep='\t', index=False)
+
+            confounds = pd.DataFrame(rng.randn(n_vols, len(CONFOUNDS)), columns=CONFOUNDS)
+            confounds['non_steady_state_outlier00'] = np.eye(n_vols)[0]
+            confounds.loc[0, 'framewise_displacement'] = np.nan
+            confounds.to_csv(str(deriv_func / (prefix + '_desc-confounds_regressors.tsv')),
+                             sep='\t', index=False, na_rep='n/a')
+            bold = '{}_space-{}_desc-preproc_bold'.format(prefix, SPACE)
+            nb.Nifti1Image(data, affine).to_filename(str(deriv_func / (bold + '.nii.gz')))
+            (deriv_func / (bold + '.json')).write_text(json.dumps({'RepetitionTime': 2.0}))
+            nb.Nifti1Image(np.ones(shape, dtype=np.uint8), affine).to_filename(
+                str(deriv_func / '{}_space-{}_desc-brain_mask.nii.gz'.format(prefix, SPACE)))
+    return root
+
+
+@pytest.fixture
+def bids_dir(tmp_path):
+    """ A small BIDS dataset with derivatives, which tests may modify """
+    return make_dataset(tmp_path / 'ds')
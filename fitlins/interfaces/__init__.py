@@ -6,6 +6,7 @@ fall into three primary categories:
 
 * The :mod:`~.bids` interfaces are for interacting with BIDS_ datasets and models_.
 * :mod:`~.nistats` interfaces make the Nistats_ estimators available to Nipype workflows.
+* :mod:`~.native` interfaces wrap the batched routines of :mod:`fitlins.stats`.
 * :mod:`.visualizations` interfaces wrap matplotlib_, Seaborn_ and nilearn_ to produce
   figures for reports.
 
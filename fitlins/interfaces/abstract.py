@@ -8,7 +8,7 @@ subclass can be written and swapped in without demanding that an estimator
 also be written.
 """
 
-from nipype.interfaces.base import BaseInterface, TraitedSpec, File, traits
+from nipype.interfaces.base import BaseInterface, TraitedSpec, File, Directory, traits
 
 
 class DesignMatrixInputSpec(TraitedSpec):
@@ -29,10 +29,16 @@ class DesignMatrixInterface(BaseInterface):
 
 class FirstLevelEstimatorInputSpec(TraitedSpec):
     bold_file = File(exists=True, mandatory=True)
+    session_info = traits.Dict()
     mask_file = File(exists=True)
     design_matrix = File(exists=True, mandatory=True)
     contrast_info = traits.List(traits.Dict)
     smoothing_fwhm = traits.Float(desc='Full-width half max (FWHM) in mm for smoothing in mask')
+    bold_cache = Directory(desc='Directory in which compressed BOLD series are decompressed '
+                                'once, and shared across fits (see ``cached_bold``)')
+    bold_cache_gb = traits.Float(desc='Maximum size of the BOLD cache (GB)')
+    precision = traits.Enum('float64', 'float32', usedefault=True,
+                            desc='Floating point precision of estimates and written maps')
 
 
 class EstimatorOutputSpec(TraitedSpec):
@@ -55,6 +61,9 @@ class SecondLevelEstimatorInputSpec(TraitedSpec):
     stat_metadata = traits.List(traits.List(traits.Dict), mandatory=True)
     contrast_info = traits.List(traits.Dict, mandatory=True)
     smoothing_fwhm = traits.Float(desc='Full-width half max (FWHM) in mm for smoothing in mask')
+    precision = traits.Enum('float64', 'float32', usedefault=True,
+                            desc='Floating point precision of written maps; models are '
+                                 'estimated in double precision')
 
 
 class SecondLevelEstimatorOutputSpec(EstimatorOutputSpec):
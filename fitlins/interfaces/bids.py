@@ -1,4 +1,6 @@
 import os
+from collections import defaultdict
+from itertools import product
 from pathlib import Path
 from gzip import GzipFile
 import json
@@ -9,13 +11,18 @@ import nibabel as nb
 from nipype import logging
 from nipype.utils.filemanip import makedirs, copyfile
 from nipype.interfaces.base import (
-    BaseInterfaceInputSpec, TraitedSpec, SimpleInterface,
+    BaseInterfaceInputSpec, TraitedSpec, DynamicTraitedSpec, SimpleInterface,
     InputMultiPath, OutputMultiPath, File, Directory,
     traits, isdefined
     )
-from nipype.interfaces.io import IOBase
+from nipype.interfaces.io import IOBase, add_traits
 
 from ..utils import snake_to_camel
+from ..utils.bids import compile_patterns, get_file_entities
+from ..utils.contrasts import CompiledContrasts, contrast_key, save_contrast_store
+from ..utils.design import save_design_store
+from ..utils.images import scan_geometry
+from ..utils.variables import IMPLICIT_PREFIXES, ProjectedLayout, model_variables
 
 iflogger = logging.getLogger('nipype.interface')
 
@@ -84,6 +91,8 @@ class ModelSpecLoaderInputSpec(BaseInterfaceInputSpec):
     model = traits.Either('default', InputMultiPath(File(exists=True)),
                           desc='Model filename')
     selectors = traits.Dict(desc='Limit models to those with matching inputs')
+    database_path = Directory(exists=True,
+                              desc='Persisted BIDSLayout index (see ``init_layout``)')
 
 
 class ModelSpecLoaderOutputSpec(TraitedSpec):
@@ -103,8 +112,11 @@ class ModelSpecLoader(SimpleInterface):
         from bids.analysis import auto_model
         models = self.inputs.model
         if not isinstance(models, list):
-            # model is not yet standardized, so validate=False
-            layout = bids.BIDSLayout(self.inputs.bids_dir, validate=False)
+            if isdefined(self.inputs.database_path):
+                layout = bids.BIDSLayout.load(self.inputs.database_path)
+            else:
+                # model is not yet standardized, so validate=False
+                layout = bids.BIDSLayout(self.inputs.bids_dir, validate=False)
 
             if not isdefined(models):
                 models = layout.get(suffix='smdl', return_type='file')
@@ -150,6 +162,18 @@ class LoadBIDSModelInputSpec(BaseInterfaceInputSpec):
     ignore = InputMultiPath(
         traits.Str,
         desc='Patterns to ignore sub-directories of BIDS root')
+    database_path = Directory(exists=True,
+                              desc='Persisted BIDSLayout index (see ``init_layout``); '
+                                   'if provided, other indexing options are ignored')
+    n_procs = traits.Int(1, usedefault=True,
+                         desc='Number of processes loading run-level variables; '
+                              'parallel loading requires database_path')
+    variable_cache = Directory(desc='Directory in which to cache parsed run-level variables, '
+                                    'shared by all models (see ``load_run_index``)')
+    sampling_rate = traits.Either(
+        traits.Float, traits.Enum('TR'),
+        desc="Rate (Hz) at which sparse run-level variables are densified by "
+             "transformations, or 'TR' for the acquisition rate of each run")
 
 
 class LoadBIDSModelOutputSpec(TraitedSpec):
@@ -172,11 +196,15 @@ class LoadBIDSModel(SimpleInterface):
     -------
     design_info : list of dictionaries
         At the first level, a dictionary per-run containing the following keys:
-            'sparse' : HDF5 file containing sparse representation of events
-                       (onset, duration, amplitude)
-            'dense'  : HDF5 file containing dense representation of events
-                       regressors
+            'design_store' : design store (see :mod:`fitlins.utils.design`)
+                             shared by all runs, containing sparse representations
+                             of events (onset, duration, amplitude) and dense
+                             representations of regressors
+            'run' : key of the run in the design store
             'repetition_time'   : float (in seconds)
+            'contrast_store' : compiled contrast store
+                               (see :mod:`fitlins.utils.contrasts`) shared by all runs
+            'contrast_key' : key of the run's contrasts in the contrast store
 
     entities : list of list of dictionaries
         The entities list contains a list for each level of analysis.
@@ -211,28 +239,37 @@ class LoadBIDSModel(SimpleInterface):
     def _run_interface(self, runtime):
         from bids.analysis import Analysis
         from bids.layout import BIDSLayout
-        import re
-
-        force_index = [
-            # If entry looks like `/<pattern>/`, treat `<pattern>` as a regex
-            re.compile(ign[1:-1]) if (ign[0], ign[-1]) == ('/', '/') else ign
-            # Iterate over empty tuple if undefined
-            for ign in self.inputs.force_index or ()]
-        ignore = [
-            # If entry looks like `/<pattern>/`, treat `<pattern>` as a regex
-            re.compile(ign[1:-1]) if (ign[0], ign[-1]) == ('/', '/') else ign
-            # Iterate over empty tuple if undefined
-            for ign in self.inputs.ignore or ()]
 
-        # If empty, then None
-        derivatives = self.inputs.derivatives or None
+        database_path = None
+        if isdefined(self.inputs.database_path):
+            database_path = self.inputs.database_path
+            layout = BIDSLayout.load(database_path)
+        else:
+            # If empty, then None
+            derivatives = self.inputs.derivatives or None
 
-        layout = BIDSLayout(self.inputs.bids_dir, force_index=force_index,
-                            ignore=ignore, derivatives=derivatives)
+            layout = BIDSLayout(self.inputs.bids_dir,
+                                force_index=compile_patterns(self.inputs.force_index),
+                                ignore=compile_patterns(self.inputs.ignore),
+                                derivatives=derivatives)
 
         selectors = self.inputs.selectors
+        variable_cache = None
+        if isdefined(self.inputs.variable_cache):
+            variable_cache = self.inputs.variable_cache
+        sampling_rate = None
+        if isdefined(self.inputs.sampling_rate):
+            sampling_rate = self.inputs.sampling_rate
 
         analysis = Analysis(model=self.inputs.model, layout=layout)
+        # Only read confound columns the model may refer to; subjects are
+        # loaded in parallel from the persisted index
+        projected = ProjectedLayout(
+            layout, model_variables(self.inputs.model), n_procs=self.inputs.n_procs,
+            database_path=database_path, cache_dir=variable_cache,
+            sampling_rate=sampling_rate)
+        for step in analysis.steps:
+            step.layout = projected
         analysis.setup(drop_na=False, **selectors)
         self._load_level1(runtime, analysis)
         self._load_higher_level(runtime, analysis)
@@ -248,19 +285,18 @@ class LoadBIDSModel(SimpleInterface):
         design_info = []
         contrast_info = []
         warnings = []
-        for sparse, dense, ents in step.get_design_matrix():
+        designs = {}
+        design_store = step_subdir / 'design.npz'
+        compiled = {}
+        contrast_store = step_subdir / 'contrasts.npz'
+        runs = list(step.get_design_matrix())
+        run_metadata = self._load_run_metadata(analysis, [ents for _, _, ents in runs])
+        for (sparse, dense, ents), metadata in zip(runs, run_metadata):
             info = {}
 
             # Metadata is now included in entities
-            TR = ents.pop('RepetitionTime', None)  # Required field in seconds
-            if TR is None: # But is unreliable (for now?)
-                preproc_files = analysis.layout.get(
-                    extension=['.nii', '.nii.gz'], **ents)
-                if len(preproc_files) != 1:
-                    raise ValueError('Too many BOLD files found')
-
-                fname = preproc_files[0].path
-                TR = analysis.layout.get_metadata(fname)['RepetitionTime']
+            ents.pop('RepetitionTime', None)
+            TR = metadata['repetition_time']
 
             # ents is now pretty populous
             ents.pop('suffix', None)
@@ -275,29 +311,12 @@ class LoadBIDSModel(SimpleInterface):
                 ents.pop('session', None)
             if step.level == 'dataset':
                 ents.pop('subject', None)
-            space = ents.get('space')
-            if space is None:
-                spaces = analysis.layout.get_spaces(
-                    suffix='bold',
-                    extension=['.nii', '.nii.gz'])
-                if spaces:
-                    spaces = sorted(spaces)
-                    space = spaces[0]
-                    if len(spaces) > 1:
-                        iflogger.warning(
-                            'No space was provided, but multiple spaces were detected: %s. '
-                            'Selecting the first (ordered lexicographically): %s'
-                            % (', '.join(spaces), space))
-                ents['space'] = space
+            if ents.get('space') is None:
+                ents['space'] = metadata['space']
 
             ent_string = '_'.join('{}-{}'.format(key, val)
                                   for key, val in ents.items())
 
-            sparse_file = None
-            if sparse is not None:
-                sparse_file = step_subdir / '{}_sparse.h5'.format(ent_string)
-                sparse.to_hdf(sparse_file, key='sparse')
-
             imputed = []
             if dense is not None:
                 # Note that FMRIPREP includes CosineXX columns to accompany
@@ -305,7 +324,7 @@ class LoadBIDSModel(SimpleInterface):
                 # We may want to add criteria to include HPF columns that are not
                 # explicitly listed in the model
                 names = [var for var in step.model['x'] if var in dense.columns]
-                names.extend(col for col in dense.columns if col.startswith('non_steady_state'))
+                names.extend(col for col in dense.columns if col.startswith(IMPLICIT_PREFIXES))
                 dense = dense[names]
 
                 # These confounds are defined pairwise with the current volume
@@ -326,14 +345,9 @@ class LoadBIDSModel(SimpleInterface):
                         dense[imputable][0] = np.nanmean(vals[vals != 0])
                         imputed.append(imputable)
 
-                dense_file = step_subdir / '{}_dense.h5'.format(ent_string)
-                dense.to_hdf(dense_file, key='dense')
-
-            else:
-                dense_file = None
-
-            info['sparse'] = str(sparse_file) if sparse_file else None
-            info['dense'] = str(dense_file) if dense_file else None
+            designs[ent_string] = (sparse, dense)
+            info['design_store'] = str(design_store)
+            info['run'] = ent_string
             info['repetition_time'] = TR
 
             contrasts = [dict(c._asdict()) for c in step.get_contrasts(**ents)[0]]
@@ -349,6 +363,13 @@ class LoadBIDSModel(SimpleInterface):
                 if step.level == 'dataset':
                     con['entities'].pop('subject', None)
 
+            # Runs generally share a contrast set, which need only be compiled once
+            key = contrast_key(contrasts)
+            if key not in compiled:
+                compiled[key] = CompiledContrasts.from_contrast_info(contrasts)
+            info['contrast_store'] = str(contrast_store)
+            info['contrast_key'] = key
+
             warning_file = step_subdir / '{}_warning.html'.format(ent_string)
             with warning_file.open('w') as fobj:
                 if imputed:
@@ -359,11 +380,79 @@ class LoadBIDSModel(SimpleInterface):
             contrast_info.append(contrasts)
             warnings.append(str(warning_file))
 
+        save_design_store(design_store, designs)
+        save_contrast_store(contrast_store, compiled)
         self._results['design_info'] = design_info
         self._results['warnings'] = warnings
         self._results.setdefault('entities', []).append(entities)
         self._results.setdefault('contrast_info', []).append(contrast_info)
 
+    @staticmethod
+    def _load_run_metadata(analysis, run_entities):
+        """ Resolve repetition time and space for all runs at once
+
+        BOLD files are matched to runs through an entity index built from a single
+        query, and metadata is only fetched for runs whose entities lack it.
+        Every entity of a run must match, as in :meth:`BIDSLayout.get`; entities
+        that are not indexed are matched against the metadata of the BOLD files
+        matching the others.
+        """
+        layout = analysis.layout
+
+        # Metadata is now included in entities
+        # Required field in seconds, but is unreliable (for now?)
+        queries = {ix: {key: val for key, val in ents.items() if key != 'RepetitionTime'}
+                   for ix, ents in enumerate(run_entities)
+                   if ents.get('RepetitionTime') is None}
+        bold_files = {}
+        file_metadata = {}
+        if queries:
+            bold_index = _EntityIndex(get_file_entities(
+                layout, layout.get(return_type='file', suffix='bold',
+                                   extension=['.nii', '.nii.gz'])))
+            candidates = set()
+            for query in queries.values():
+                candidates.update(bold_index.get(**{key: val for key, val in query.items()
+                                                    if key in bold_index.dtypes}))
+            file_metadata = get_file_entities(layout, sorted(candidates), metadata=None)
+            full_index = _EntityIndex(file_metadata)
+            for ix, query in queries.items():
+                bold_files[ix] = full_index.get(**query)
+                if not bold_files[ix]:
+                    unmatched = sorted(key for key, val in query.items()
+                                       if val is not None and key not in bold_index.dtypes
+                                       and key not in full_index.dtypes)
+                    raise ValueError(
+                        'No BOLD file found for run with entities {}{}'.format(
+                            query, '; no file has {}'.format(', '.join(unmatched))
+                            if unmatched else ''))
+
+        default_space = None
+        if any(ents.get('space') is None for ents in run_entities):
+            spaces = layout.get_spaces(
+                suffix='bold',
+                extension=['.nii', '.nii.gz'])
+            if spaces:
+                spaces = sorted(spaces)
+                default_space = spaces[0]
+                if len(spaces) > 1:
+                    iflogger.warning(
+                        'No space was provided, but multiple spaces were detected: %s. '
+                        'Selecting the first (ordered lexicographically): %s'
+                        % (', '.join(spaces), default_space))
+
+        run_metadata = []
+        for ix, ents in enumerate(run_entities):
+            TR = ents.get('RepetitionTime')
+            if TR is None:
+                files = bold_files[ix]
+                if len(files) != 1:
+                    raise ValueError('Too many BOLD files found')
+                TR = file_metadata[files[0]]['RepetitionTime']
+            run_metadata.append({'repetition_time': TR,
+                                 'space': ents.get('space', default_space)})
+        return run_metadata
+
     def _load_higher_level(self, runtime, analysis):
         for step in analysis.steps[1:]:
             contrast_info = []
@@ -389,6 +478,83 @@ class LoadBIDSModel(SimpleInterface):
             self._results['contrast_info'].append(contrast_info)
 
 
+class MergeModelShards(SimpleInterface):
+    """
+    Merge the outputs of :class:`LoadBIDSModel` run on disjoint sets of subjects
+
+    Inputs are the ``design_info``, ``contrast_info``, ``entities`` and ``warnings``
+    outputs of each loader, suffixed with the index of the loader
+    (e.g., ``design_info0``, ``design_info1``, ...).
+    Outputs are as for :class:`LoadBIDSModel`.
+
+    First-level outputs describe one run each, and are concatenated.
+    At higher levels, units of analysis with the same entities (such as the
+    single unit of a dataset-level step, which every loader produces) are
+    merged, in both ``entities`` and ``contrast_info``.
+    Contrasts of the same name must have the same definition (weights, type
+    and any other field but the entities) in every loader, or an error is
+    raised.
+    """
+    input_spec = DynamicTraitedSpec
+    output_spec = LoadBIDSModelOutputSpec
+    _fields = ('design_info', 'contrast_info', 'entities', 'warnings')
+
+    def __init__(self, n_shards=None, **kwargs):
+        super(MergeModelShards, self).__init__(**kwargs)
+        if not n_shards:
+            raise ValueError("n_shards must be a positive integer")
+        self._n_shards = n_shards
+        add_traits(self.inputs, ['{}{:d}'.format(field, ix)
+                                 for field in self._fields
+                                 for ix in range(n_shards)])
+
+    def _run_interface(self, runtime):
+        shards = [{field: getattr(self.inputs, '{}{:d}'.format(field, ix))
+                   for field in self._fields}
+                  for ix in range(self._n_shards)]
+
+        self._results['design_info'] = [info for shard in shards
+                                        for info in shard['design_info']]
+        self._results['warnings'] = [warning for shard in shards
+                                     for warning in shard['warnings']]
+        entities = [[ents for shard in shards for ents in shard['entities'][0]]]
+        contrast_info = [[contrasts for shard in shards
+                          for contrasts in shard['contrast_info'][0]]]
+        for level in range(1, len(shards[0]['contrast_info'])):
+            # Entities are merged by the same key as contrasts, so that both
+            # lists describe the same units, in the same order
+            units = {}
+            unit_entities = {}
+            for shard in shards:
+                for ents, contrasts in zip(shard['entities'][level],
+                                           shard['contrast_info'][level]):
+                    key = json.dumps(contrasts[0]['entities'], sort_keys=True)
+                    unit_entities.setdefault(key, ents)
+                    merged = units.setdefault(key, {})
+                    for con in contrasts:
+                        if con['name'] not in merged:
+                            merged[con['name']] = con
+                            continue
+                        first, other = (_contrast_definition(merged[con['name']]),
+                                        _contrast_definition(con))
+                        if first != other:
+                            raise ValueError(
+                                "Contrast {!r} for {} differs between subsets of subjects: "
+                                "{} vs. {}".format(con['name'], key, first, other))
+            contrast_info.append([list(merged.values()) for merged in units.values()])
+            entities.append(list(unit_entities.values()))
+        self._results['entities'] = entities
+        self._results['contrast_info'] = contrast_info
+
+        return runtime
+
+
+def _contrast_definition(contrast):
+    """ Serialize the fields of a contrast that must agree across loaders """
+    return json.dumps({key: val for key, val in contrast.items() if key != 'entities'},
+                      sort_keys=True, default=str)
+
+
 class BIDSSelectInputSpec(BaseInterfaceInputSpec):
     bids_dir = Directory(exists=True,
                          mandatory=True,
@@ -398,12 +564,24 @@ class BIDSSelectInputSpec(BaseInterfaceInputSpec):
     entities = InputMultiPath(traits.Dict(), mandatory=True)
     selectors = traits.Dict(desc='Additional selectors to be applied',
                             usedefault=True)
+    database_path = Directory(exists=True,
+                              desc='Persisted BIDSLayout index (see ``init_layout``)')
+    index_entities = traits.Bool(
+        True, usedefault=True,
+        desc='Resolve all entities through an in-memory index built from one query '
+             'for BOLD files and one for masks, rather than querying per run')
+    design_info = traits.List(traits.Dict,
+                              desc='Design information corresponding to each entity '
+                                   'dictionary, to be updated with BOLD file geometry')
 
 
 class BIDSSelectOutputSpec(TraitedSpec):
     bold_files = OutputMultiPath(File)
     mask_files = OutputMultiPath(traits.Either(File, None))
     entities = OutputMultiPath(traits.Dict)
+    design_info = traits.List(traits.Dict,
+                              desc='Design information, including the geometry of each '
+                                   'BOLD file (see ``scan_geometry``)')
 
 
 class BIDSSelect(SimpleInterface):
@@ -413,15 +591,32 @@ class BIDSSelect(SimpleInterface):
     def _run_interface(self, runtime):
         from bids.layout import BIDSLayout
 
-        derivatives = self.inputs.derivatives
-        layout = BIDSLayout(self.inputs.bids_dir, derivatives=derivatives)
+        if isdefined(self.inputs.database_path):
+            layout = BIDSLayout.load(self.inputs.database_path)
+        else:
+            derivatives = self.inputs.derivatives
+            layout = BIDSLayout(self.inputs.bids_dir, derivatives=derivatives)
+
+        mask_query = {'suffix': 'mask', 'desc': 'brain', 'extension': ['.nii', '.nii.gz']}
+        if self.inputs.index_entities:
+            # Selectors overridden by some entities cannot narrow the initial query
+            overridden = set().union(*self.inputs.entities)
+            base_query = {key: val for key, val in self.inputs.selectors.items()
+                          if key not in overridden}
+            # Entities of runs include the metadata of their BOLD files, such as
+            # EchoTime or SliceTiming, which must be matched as well
+            bold_index = _EntityIndex(get_file_entities(
+                layout, layout.get(return_type='file', **base_query), metadata=None))
+            mask_index = _EntityIndex(get_file_entities(
+                layout, layout.get(return_type='file', **mask_query)))
 
         bold_files = []
-        mask_files = []
-        entities = []
         for ents in self.inputs.entities:
             selectors = {**self.inputs.selectors, **ents}
-            bold_file = layout.get(**selectors)
+            if self.inputs.index_entities:
+                bold_file = bold_index.get(**selectors)
+            else:
+                bold_file = layout.get(return_type='file', **selectors)
 
             if len(bold_file) == 0:
                 raise FileNotFoundError(
@@ -434,30 +629,102 @@ class BIDSSelect(SimpleInterface):
                     "".format(self.inputs.bids_dir, selectors,
                               "\n\t".join(
                                   '{} ({})'.format(
-                                      f.path,
-                                      layout.files[f.path].entities)
+                                      f,
+                                      layout.files[f].entities)
                                   for f in bold_file)))
+            bold_files.append(bold_file[0])
+
+        if self.inputs.index_entities:
+            # Masks are matched on the entities in the file names of BOLD series
+            name_ents = get_file_entities(layout, bold_files)
 
+        mask_files = []
+        entities = []
+        for bold_file in bold_files:
             # Select exactly matching mask file (may be over-cautious)
-            bold_ents = layout.parse_file_entities(bold_file[0].path)
-            bold_ents['suffix'] = 'mask'
-            bold_ents['desc'] = 'brain'
-            bold_ents['extension'] = ['.nii', '.nii.gz']
-            mask_file = layout.get(**bold_ents)
-            bold_ents.pop('suffix')
-            bold_ents.pop('desc')
-
-            bold_files.append(bold_file[0].path)
-            mask_files.append(mask_file[0].path if mask_file else None)
+            if self.inputs.index_entities:
+                bold_ents = dict(name_ents[bold_file])
+                mask_file = mask_index.get(**{key: val for key, val in bold_ents.items()
+                                              if key not in mask_query})
+                bold_ents['extension'] = list(mask_query['extension'])
+            else:
+                bold_ents = layout.parse_file_entities(bold_file)
+                bold_ents.update(mask_query)
+                mask_file = layout.get(return_type='file', **bold_ents)
+            bold_ents.pop('suffix', None)
+            bold_ents.pop('desc', None)
+
+            mask_files.append(mask_file[0] if mask_file else None)
             entities.append(bold_ents)
 
         self._results['bold_files'] = bold_files
         self._results['mask_files'] = mask_files
         self._results['entities'] = entities
 
+        # Scan headers once, so downstream nodes need not load images to inspect them
+        design_info = self.inputs.design_info
+        if not isdefined(design_info):
+            design_info = [{} for _ in bold_files]
+        elif len(design_info) != len(bold_files):
+            raise ValueError("Received {} design_info entries for {} BOLD files"
+                             "".format(len(design_info), len(bold_files)))
+        self._results['design_info'] = []
+        for info, bold_file in zip(design_info, bold_files):
+            geometry = scan_geometry(bold_file)
+            self._results['design_info'].append(
+                {**info, 'n_vols': geometry['n_vols'], 'geometry': geometry})
+
         return runtime
 
 
+class _EntityIndex(object):
+    """ Hash index of files by entity values
+
+    ``get`` reproduces the exact matching of ``BIDSLayout.get``: list values
+    match any of their elements, ``None`` matches files lacking the entity,
+    and values are cast to the dtype of the indexed entity before comparison.
+    One table is built for each distinct set of queried entities.
+    """
+    def __init__(self, file_ents):
+        self.file_ents = file_ents
+        self.dtypes = {}
+        for ents in file_ents.values():
+            for name, value in ents.items():
+                self.dtypes.setdefault(name, type(value))
+        self._tables = {}
+
+    def _key(self, name, value):
+        if value is None:
+            return None
+        if isinstance(value, (list, dict)):
+            # As metadata are encoded in the entities of pybids variables
+            value = json.dumps(value)
+        elif name == 'extension':
+            value = str(value).lstrip('.')
+        elif self.dtypes.get(name) in (int, float):
+            try:
+                value = self.dtypes[name](value)
+            except (TypeError, ValueError):
+                pass
+        return str(value)
+
+    def get(self, **filters):
+        names = tuple(sorted(filters))
+        if names not in self._tables:
+            table = self._tables[names] = defaultdict(list)
+            for path, ents in self.file_ents.items():
+                table[tuple(self._key(name, ents.get(name)) for name in names)].append(path)
+        table = self._tables[names]
+
+        choices = []
+        for name in names:
+            values = filters[name]
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            choices.append({self._key(name, value) for value in values})
+        return sorted({path for key in product(*choices) for path in table.get(key, ())})
+
+
 def _copy_or_convert(in_file, out_file):
     in_ext = bids_split_filename(in_file)[2]
     out_ext = bids_split_filename(out_file)[2]
@@ -511,15 +778,15 @@ class BIDSDataSink(IOBase):
     _always_run = True
 
     def _list_outputs(self):
-        from bids.layout import BIDSLayout
+        from bids.layout.writing import build_path
         base_dir = self.inputs.base_directory
 
         os.makedirs(base_dir, exist_ok=True)
 
-        layout = BIDSLayout(base_dir, validate=False)
         path_patterns = self.inputs.path_patterns
         if not isdefined(path_patterns):
-            path_patterns = None
+            from bids.layout.models import Config
+            path_patterns = Config.load('bids').default_path_patterns
 
         out_files = []
         for entities, in_file in zip(self.inputs.entities,
@@ -529,9 +796,12 @@ class BIDSDataSink(IOBase):
 
             ents = {k: snake_to_camel(str(v)) for k, v in ents.items()}
 
-            out_fname = os.path.join(
-                base_dir, layout.build_path(
-                    ents, path_patterns, validate=False))
+            # Building paths needs no index, so avoid walking the output directory
+            out_path = build_path(ents, path_patterns)
+            if out_path is None:
+                raise ValueError(
+                    "Unable to construct build path with source {}".format(ents))
+            out_fname = os.path.join(base_dir, out_path)
             makedirs(os.path.dirname(out_fname), exist_ok=True)
 
             _copy_or_convert(in_file, out_fname)
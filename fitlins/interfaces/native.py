@@ -0,0 +1,520 @@
+"""
+Interfaces to the estimators implemented in :mod:`fitlins.stats`
+
+These interfaces operate on all runs at once, rather than being mapped over runs.
+"""
+import os
+from collections import OrderedDict
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+from nipype import logging
+from nipype.interfaces.base import (
+    TraitedSpec, SimpleInterface, InputMultiPath, OutputMultiPath, File, traits, isdefined)
+
+from .abstract import (
+    DesignMatrixInterface, FirstLevelEstimatorInputSpec, FirstLevelEstimatorInterface)
+from ..utils.contrasts import load_contrasts, run_contrasts
+from ..utils.design import (
+    load_dense, load_design_matrix, load_run_design, load_sparse, open_design_stores,
+    prepare_run_design, save_design_matrix)
+from ..utils.images import (
+    cached_bold, crop_to_mask, downcast_scaling, iter_slabs, load_indexed, mean_image,
+    read_dtype, smoothing_radius, uncrop)
+
+iflogger = logging.getLogger('nipype.interface')
+
+
+class BatchDesignMatrixInputSpec(TraitedSpec):
+    bold_file = InputMultiPath(File(exists=True),
+                               desc='BOLD files, used if volume counts are missing '
+                                    'from session_info')
+    session_info = traits.List(traits.Dict, mandatory=True)
+    drop_missing = traits.Bool(
+            desc='Drop columns in design matrix with all missing values')
+    hrf_model = traits.Enum('glover', 'spm', usedefault=True,
+                            desc='Hemodynamic response function model')
+    tr_grid = traits.Bool(False, usedefault=True,
+                          desc='Evaluate event regressors at acquisition times only, '
+                               'rather than on an oversampled grid')
+
+
+class BatchDesignMatrixOutputSpec(TraitedSpec):
+    design_matrix = OutputMultiPath(File)
+
+
+class DesignMatrix(DesignMatrixInterface, SimpleInterface):
+    """ Build the design matrices of all runs at once
+
+    Runs sharing a repetition time and number of volumes are convolved together
+    (see :func:`fitlins.stats.hrf.make_design_matrices`).
+    With ``tr_grid``, events are taken straight to acquisition times
+    (see :func:`fitlins.stats.hrf.integrate_events`).
+    Inputs and outputs are lists, one entry per run.
+    """
+    input_spec = BatchDesignMatrixInputSpec
+    output_spec = BatchDesignMatrixOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nb
+        from ..stats.hrf import make_design_matrices
+
+        drop_missing = bool(self.inputs.drop_missing)
+        bold_files = self.inputs.bold_file if isdefined(self.inputs.bold_file) else []
+
+        runs = []
+        with open_design_stores(self.inputs.session_info) as stores:
+            for ix, info in enumerate(self.inputs.session_info):
+                vols = info.get('n_vols')
+                if vols is None:
+                    vols = nb.load(bold_files[ix]).shape[3]
+                sparse, dense, drift_model = load_run_design(
+                    info, drop_missing, store=stores[info['design_store']])
+                runs.append({'repetition_time': info['repetition_time'],
+                             'n_vols': vols,
+                             'events': sparse,
+                             'regressors': dense,
+                             'drift_model': drift_model})
+
+        design_matrices = []
+        mats = make_design_matrices(runs, hrf_model=self.inputs.hrf_model,
+                                    tr_grid=self.inputs.tr_grid)
+        for ix, mat in enumerate(mats):
+            fname = os.path.join(runtime.cwd, 'design_{:04d}.npz'.format(ix))
+            save_design_matrix(fname, mat)
+            design_matrices.append(fname)
+        self._results['design_matrix'] = design_matrices
+        return runtime
+
+
+class FirstLevelModelInputSpec(FirstLevelEstimatorInputSpec):
+    noise_model = traits.Enum('ar1', 'ols', usedefault=True,
+                              desc='Temporal noise model')
+    block_size = traits.Int(desc='Number of voxels to fit at once (default: all)')
+    max_mem_gb = traits.Float(desc='Memory budget (GB); if set, BOLD series are read '
+                                   'and fit in slabs of slices that fit within it')
+
+
+class FirstLevelModel(FirstLevelEstimatorInterface, SimpleInterface):
+    """ Fit a first-level model with :func:`fitlins.stats.glm.fit_glm`
+
+    Data are masked, smoothed and scaled to percent signal change as by
+    :class:`nistats.first_level_model.FirstLevelModel` with its default
+    parameters.
+
+    Only the bounding box of the mask is read (see
+    :func:`fitlins.utils.images.crop_to_mask`), unless the mask must be
+    resampled to the BOLD series.
+    With ``max_mem_gb``, BOLD series are streamed through their data proxy
+    (see :func:`fitlins.utils.images.iter_slabs`) rather than loaded at once,
+    unless the mask must be resampled.
+    Compressed series are read through a seek-point index, if available
+    (see :func:`fitlins.utils.images.load_indexed`).
+
+    With ``precision='float32'``, data, parameter estimates and output maps
+    are held in single precision.
+    """
+    input_spec = FirstLevelModelInputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nb
+
+        with ExitStack() as stack:
+            bold_file = self.inputs.bold_file
+            if isdefined(self.inputs.bold_cache):
+                max_size_gb = self.inputs.bold_cache_gb
+                if not isdefined(max_size_gb):
+                    max_size_gb = None
+                # The cached series is locked against eviction until the fit is complete
+                bold_file = stack.enter_context(
+                    cached_bold(bold_file, self.inputs.bold_cache, max_size_gb))
+            self._index_bytes = 0
+            if isdefined(self.inputs.max_mem_gb) and bold_file.endswith('.gz'):
+                # Compressed series are streamed through a seek-point index, which is
+                # released with its file handle once the fit is complete
+                self._index_bytes = self.inputs.max_mem_gb * 1024 ** 3 / 4
+                img = stack.enter_context(load_indexed(bold_file, self._index_bytes))
+            else:
+                img = nb.load(bold_file)
+            return self._fit(runtime, img)
+
+    def _fit(self, runtime, img):
+        from nilearn.input_data import NiftiMasker
+        from ..stats.glm import compute_contrast, fit_glm
+
+        mat = load_design_matrix(self.inputs.design_matrix)
+        info = {}
+        if isdefined(self.inputs.session_info):
+            info = self.inputs.session_info
+        img = downcast_scaling(img, info.get('geometry'))
+
+        mask_file = self.inputs.mask_file
+        if not isdefined(mask_file):
+            mask_file = None
+        smoothing_fwhm = self.inputs.smoothing_fwhm
+        if not isdefined(smoothing_fwhm):
+            smoothing_fwhm = None
+
+        mask_img = None
+        if isdefined(self.inputs.max_mem_gb) and len(img.shape) == 4:
+            mask_img = self._streaming_mask(img, mask_file)
+
+        if mask_img is not None:
+            results = self._fit_streaming(img, mask_img, mat, smoothing_fwhm)
+
+            def unmask(values):
+                from nilearn.masking import unmask
+                return unmask(values, mask_img)
+        else:
+            full_img, bounds = img, None
+            if mask_file is not None:
+                cropped = crop_to_mask(img, mask_file, smoothing_fwhm)
+                if cropped is not None:
+                    img, mask_file, bounds = cropped
+            masker = NiftiMasker(mask_img=mask_file, smoothing_fwhm=smoothing_fwhm,
+                                 mask_strategy='epi', standardize=False)
+            data = self._scale(masker.fit_transform(img))
+            del img
+
+            block_size = self.inputs.block_size if isdefined(self.inputs.block_size) else None
+            results = fit_glm(data, mat.to_numpy(), noise_model=self.inputs.noise_model,
+                              block_size=block_size, dtype=self.inputs.precision)
+            del data
+
+            def unmask(values):
+                out_img = masker.inverse_transform(values)
+                if bounds is not None:
+                    out_img = uncrop(out_img, full_img, bounds)
+                return out_img
+
+        effect_maps = []
+        variance_maps = []
+        stat_maps = []
+        zscore_maps = []
+        pvalue_maps = []
+        contrast_metadata = []
+        out_ents = self.inputs.contrast_info[0]['entities']
+        fname_fmt = os.path.join(runtime.cwd, '{}_{}.nii.gz').format
+        for name, weights, contrast_type in run_contrasts(
+                info, self.inputs.contrast_info, mat.columns):
+            contrast_metadata.append(
+                {'contrast': name,
+                 'stat': contrast_type,
+                 **out_ents}
+                )
+            maps = compute_contrast(results, weights, contrast_type)
+
+            for map_type, map_list in (('effect_size', effect_maps),
+                                       ('effect_variance', variance_maps),
+                                       ('z_score', zscore_maps),
+                                       ('p_value', pvalue_maps),
+                                       ('stat', stat_maps)):
+
+                fname = fname_fmt(name, map_type)
+                unmask(maps[map_type]).to_filename(fname)
+                map_list.append(fname)
+
+        self._results['effect_maps'] = effect_maps
+        self._results['variance_maps'] = variance_maps
+        self._results['stat_maps'] = stat_maps
+        self._results['zscore_maps'] = zscore_maps
+        self._results['pvalue_maps'] = pvalue_maps
+        self._results['contrast_metadata'] = contrast_metadata
+
+        return runtime
+
+    def _n_slices(self, img, n_voxels, n_regressors, halo=0, smoothing=False):
+        """ Number of slices per slab that keeps memory within ``max_mem_gb``
+
+        Slices cost the largest number of bytes per voxel and time point held at
+        once while a slab is read and smoothed, with ``halo`` slices on either
+        side, and then fit.
+        """
+        precision = np.dtype(self.inputs.precision)
+        # Parameter estimates, labels, the five maps of a contrast and any
+        # seek-point index are held for all voxels
+        fixed = ((n_regressors + 6) * precision.itemsize + 8) * n_voxels + self._index_bytes
+        read = read_dtype(img)
+        # Raw and scaled data, or data, smoothed copy and mask of finite values
+        read_cost = img.get_data_dtype().itemsize + read.itemsize
+        if smoothing:
+            read_cost = max(read_cost, 2 * read.itemsize + 1)
+        # Masked data, a copy at the estimation precision if cast, and the
+        # residuals and two temporaries of the fit
+        fit_cost = read.itemsize + 3 * precision.itemsize
+        if read != precision:
+            fit_cost += precision.itemsize
+
+        plane = img.shape[0] * img.shape[1] * img.shape[3]
+        budget = self.inputs.max_mem_gb * 1024 ** 3 - fixed
+        n_slices = min(int(budget // (plane * read_cost)) - 2 * halo,
+                       int(budget // (plane * fit_cost)))
+        if n_slices < 1:
+            iflogger.warning('Fitting %s one slice at a time exceeds the memory budget '
+                             'of %g GB', self.inputs.bold_file, self.inputs.max_mem_gb)
+        return max(n_slices, 1)
+
+    def _streaming_mask(self, img, mask_file):
+        """ Load or compute a mask in the space of ``img``, if not resampled """
+        import nibabel as nb
+        from nilearn.masking import compute_epi_mask
+
+        if mask_file is None:
+            # Masks are computed from the mean image, as by nilearn
+            n_slices = self._n_slices(img, 0, 0)
+            return compute_epi_mask(mean_image(img, n_slices))
+
+        mask_img = nb.load(mask_file)
+        if (mask_img.shape[:3] != img.shape[:3] or
+                not np.allclose(mask_img.affine, img.affine)):
+            return None
+        mask = np.asanyarray(mask_img.dataobj) != 0
+        return nb.Nifti1Image(mask.astype(np.int8), img.affine)
+
+    def _fit_streaming(self, img, mask_img, mat, smoothing_fwhm):
+        from ..stats.glm import fit_glm_chunks
+
+        mask = np.asanyarray(mask_img.dataobj) != 0
+        n_voxels = int(mask.sum())
+        halo = 0
+        if smoothing_fwhm is not None:
+            halo = smoothing_radius(img.affine, smoothing_fwhm)
+        n_slices = self._n_slices(img, n_voxels, mat.shape[1], halo,
+                                  smoothing=smoothing_fwhm is not None)
+
+        chunks = ((index, self._scale(data))
+                  for index, data in iter_slabs(img, mask, n_slices, smoothing_fwhm))
+        return fit_glm_chunks(chunks, mat.to_numpy(), n_voxels,
+                              noise_model=self.inputs.noise_model,
+                              dtype=self.inputs.precision)
+
+    def _scale(self, data):
+        """ Scale masked data to percent signal change, at the requested precision """
+        from ..stats.glm import percent_signal_change
+
+        if self.inputs.precision == 'float32':
+            data = data.astype(np.float32, copy=False)
+        return percent_signal_change(data)
+
+
+class SubjectMaskInputSpec(TraitedSpec):
+    bold_file = InputMultiPath(File(exists=True), mandatory=True,
+                               desc='BOLD series of each run')
+    mask_file = traits.List(traits.Either(File(exists=True), None),
+                            desc='Brain mask of each run, or None if missing')
+    entities = traits.List(traits.Dict, mandatory=True, desc='Entities of each run')
+    max_mem_gb = traits.Float(desc='Memory budget (GB); if set, BOLD series are averaged '
+                                   'in slabs of slices that fit within it')
+
+
+class SubjectMaskOutputSpec(TraitedSpec):
+    mask_file = OutputMultiPath(traits.Either(File, None), desc='Shared mask of each run')
+
+
+class SubjectMask(SimpleInterface):
+    """ Compute a single brain mask for the runs of each subject and space
+
+    Masks of the runs sharing a subject, space and voxel grid are intersected,
+    so that the first-level maps of these runs are voxel-aligned.
+    Runs without a mask contribute a mask computed from their mean image, as
+    :class:`nilearn.input_data.NiftiMasker` computes EPI masks, once rather
+    than in every first-level model.
+
+    Surface (GIFTI) runs are passed through unchanged.
+    """
+    input_spec = SubjectMaskInputSpec
+    output_spec = SubjectMaskOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nb
+        from nilearn.masking import compute_epi_mask
+
+        bold_files = self.inputs.bold_file
+        mask_files = self.inputs.mask_file
+        if not isdefined(mask_files):
+            mask_files = [None] * len(bold_files)
+        out_files = list(mask_files)
+
+        # Masks are on the grid of the given mask, or else of the BOLD series
+        groups = OrderedDict()
+        for ix, (bold_file, mask_file, ents) in enumerate(zip(bold_files, mask_files,
+                                                              self.inputs.entities)):
+            if str(bold_file).endswith('.gii'):
+                continue
+            ref = nb.load(mask_file or bold_file)
+            grid = (tuple(ref.shape[:3]), tuple(np.round(ref.affine, 4).ravel()))
+            groups.setdefault((ents.get('subject'), ents.get('space'), grid), []).append(ix)
+
+        for group_ix, runs in enumerate(groups.values()):
+            mask = None
+            for ix in runs:
+                if mask_files[ix] is not None:
+                    mask_img = nb.load(mask_files[ix])
+                else:
+                    img = downcast_scaling(nb.load(bold_files[ix]))
+                    if len(img.shape) == 4:
+                        img = mean_image(img, self._n_slices(img))
+                    mask_img = compute_epi_mask(img)
+                run_mask = np.asanyarray(mask_img.dataobj) != 0
+                mask = run_mask if mask is None else mask & run_mask
+            if not mask.any():
+                raise RuntimeError('Masks of runs {} have no voxels in common'.format(
+                    ', '.join(str(bold_files[ix]) for ix in runs)))
+            fname = os.path.join(runtime.cwd, 'mask{:d}.nii.gz'.format(group_ix))
+            nb.Nifti1Image(mask.astype(np.uint8), mask_img.affine).to_filename(fname)
+            for ix in runs:
+                out_files[ix] = fname
+
+        self._results['mask_file'] = out_files
+        return runtime
+
+    def _n_slices(self, img):
+        """ Number of slices averaged at once, within ``max_mem_gb`` """
+        if not isdefined(self.inputs.max_mem_gb):
+            return img.shape[2]
+        # Raw and scaled data of a slab
+        per_slice = img.shape[0] * img.shape[1] * img.shape[3] * (
+            img.get_data_dtype().itemsize + read_dtype(img).itemsize)
+        return max(int(self.inputs.max_mem_gb * 1024 ** 3 // per_slice), 1)
+
+
+class ValidateModelInputSpec(TraitedSpec):
+    design_info = traits.List(traits.Dict, mandatory=True,
+                              desc='Design information of all runs')
+    bold_file = InputMultiPath(File(exists=True),
+                               desc='BOLD files, used if volume counts are missing '
+                                    'from design_info')
+    drop_missing = traits.Bool(
+            desc='Report empty columns as warnings, as they will be dropped during '
+                 'model fitting')
+    hrf_model = traits.Enum('glover', 'spm', usedefault=True,
+                            desc='Hemodynamic response function model')
+
+
+class ValidateModelOutputSpec(TraitedSpec):
+    design_info = traits.List(traits.Dict, desc='Validated design information')
+
+
+class ValidateModel(SimpleInterface):
+    """ Check the model of every run before fitting any
+
+    The following are collected over all runs, and reported together:
+
+    * empty regressors, which :class:`DesignMatrix` would reject, and
+      regressors with missing values;
+    * conditions weighted by a contrast but absent from a run, in which case
+      the contrast would be silently skipped;
+    * rank-deficient designs, and contrasts that are not estimable from them.
+
+    Rank and estimability are assessed on designs evaluated at acquisition
+    times (see :func:`fitlins.stats.hrf.integrate_events`), which are cheap to
+    build and share the columns of the designs that are fit.
+
+    Empty regressors are errors, unless ``drop_missing`` is set, in which case
+    they are logged as warnings, as they will be dropped. Regressors with
+    missing values are always errors, as no missing values are filled in
+    before fitting.
+    Missing conditions, rank deficiency and non-estimable contrasts, which do
+    not prevent fitting, are logged as warnings.
+    ``design_info`` is passed through, so that fitting may be made to wait on
+    validation.
+    """
+    input_spec = ValidateModelInputSpec
+    output_spec = ValidateModelOutputSpec
+
+    def _run_interface(self, runtime):
+        import nibabel as nb
+        from ..stats.hrf import make_design_matrices
+
+        infos = self.inputs.design_info
+        drop_missing = bool(self.inputs.drop_missing)
+        bold_files = self.inputs.bold_file if isdefined(self.inputs.bold_file) else []
+        errors = OrderedDict()
+        warnings = OrderedDict()
+
+        def report(problems, message, run):
+            problems.setdefault(message, []).append(run)
+
+        runs = []
+        with open_design_stores(infos) as stores:
+            for ix, info in enumerate(infos):
+                vols = info.get('n_vols')
+                if vols is None:
+                    vols = nb.load(bold_files[ix]).shape[3]
+                store = stores[info['design_store']]
+                dense = load_dense(store, info['run'])
+                if dense is not None:
+                    for column in dense.columns[dense.isna().all()]:
+                        report(warnings if drop_missing else errors,
+                               'Regressor {!r} is empty'.format(column), info['run'])
+                sparse, dense, drift_model = prepare_run_design(
+                    load_sparse(store, info['run']), dense, drop_missing=True)
+                if dense is not None and dense.isna().any().any():
+                    columns = ', '.join(map(repr, dense.columns[dense.isna().any()]))
+                    report(errors, 'Regressors {} have missing values'.format(columns),
+                           info['run'])
+                    # Fill in, so that the remaining problems can be found
+                    dense = dense.fillna(0)
+                runs.append({'repetition_time': info['repetition_time'],
+                             'n_vols': vols,
+                             'events': sparse,
+                             'regressors': dense,
+                             'drift_model': drift_model})
+        mats = make_design_matrices(runs, hrf_model=self.inputs.hrf_model, tr_grid=True)
+
+        # Conditions weighted by each contrast set and missing from its runs,
+        # from a boolean table of runs by design columns
+        names = pd.Index(sorted(set().union(*(mat.columns for mat in mats))))
+        present = pd.DataFrame([names.isin(mat.columns) for mat in mats], columns=names)
+        keys = pd.Series([info.get('contrast_key') for info in infos])
+        contrasts = {}
+        for key, members in keys.groupby(keys).groups.items():
+            compiled = load_contrasts(infos[members[0]]['contrast_store'], key)
+            contrasts[key] = compiled
+            weighted = compiled.weights != 0
+            missing = ~present.loc[members].reindex(columns=compiled.conditions,
+                                                    fill_value=False).to_numpy()
+            for cond_ix in np.flatnonzero((weighted & missing.any(axis=0)).any(axis=0)):
+                users = [compiled.names[con_ix] for con_ix in np.flatnonzero(
+                    np.add.reduceat(weighted[:, cond_ix], compiled.rows[:-1]))]
+                message = ('Condition {!r} is missing; contrasts {} will be skipped'
+                           ''.format(compiled.conditions[cond_ix], ', '.join(users)))
+                for run_ix in members[missing[:, cond_ix]]:
+                    report(warnings, message, infos[run_ix]['run'])
+
+        # Rank and estimability
+        for info, mat in zip(infos, mats):
+            X = mat.to_numpy()
+            _, s, vh = np.linalg.svd(X, full_matrices=False)
+            rank = int((s > s.max() * max(X.shape) * np.finfo(float).eps).sum())
+            if rank == X.shape[1]:
+                continue
+            report(warnings, 'Design is rank deficient', info['run'])
+            if info.get('contrast_key') is None:
+                continue
+            # A contrast is estimable if it lies in the row space of the design
+            basis = vh[:rank]
+            for name, weights, _ in contrasts[info['contrast_key']].weights_for(mat.columns):
+                residual = weights - weights @ basis.T @ basis
+                if np.abs(residual).max() > 1e-6 * np.abs(weights).max():
+                    report(warnings, 'Contrast {!r} is not estimable'.format(name),
+                           info['run'])
+
+        for message, runs in warnings.items():
+            iflogger.warning(_describe(message, runs, len(infos)))
+        if errors:
+            raise RuntimeError(
+                'Model validation failed:\n' +
+                '\n'.join(_describe(message, runs, len(infos))
+                          for message, runs in errors.items()))
+
+        self._results['design_info'] = infos
+        return runtime
+
+
+def _describe(message, runs, n_runs, max_runs=5):
+    listed = ', '.join(runs[:max_runs])
+    if len(runs) > max_runs:
+        listed += ', ... ({} more)'.format(len(runs) - max_runs)
+    return '{} in {} of {} runs: {}'.format(message, len(runs), n_runs, listed)
@@ -6,6 +6,9 @@ from nipype.interfaces.base import LibraryBaseInterface, SimpleInterface, isdefi
 
 from .abstract import (
     DesignMatrixInterface, FirstLevelEstimatorInterface, SecondLevelEstimatorInterface)
+from ..utils.contrasts import CompiledContrasts, run_contrasts
+from ..utils.design import load_design_matrix, load_run_design, save_design_matrix
+from ..utils.images import cached_bold, crop_to_mask, downcast_scaling, uncrop
 
 
 class NistatsBaseInterface(LibraryBaseInterface):
@@ -19,23 +22,7 @@ def prepare_contrasts(contrasts, all_regressors):
     if not isdefined(contrasts):
         return []
 
-    out_contrasts = []
-    for contrast in contrasts:
-        # Are any necessary values missing for contrast estimation?
-        missing = any([[n for n, v in row.items()
-                        if v != 0 and n not in all_regressors]
-                       for row in contrast['weights']])
-        if not missing:
-            # Fill in zeros
-            weights = np.array([
-                [row[col] if col in row else 0 for col in all_regressors]
-                for row in contrast['weights']
-                ])
-
-            out_contrasts.append(
-                (contrast['name'], weights, contrast['type']))
-
-    return out_contrasts
+    return CompiledContrasts.from_contrast_info(contrasts).weights_for(all_regressors)
 
 
 class DesignMatrix(NistatsBaseInterface, DesignMatrixInterface, SimpleInterface):
@@ -44,44 +31,14 @@ class DesignMatrix(NistatsBaseInterface, DesignMatrixInterface, SimpleInterface)
         import nibabel as nb
         from nistats import design_matrix as dm
         info = self.inputs.session_info
-        img = nb.load(self.inputs.bold_file)
-        vols = img.shape[3]
+        vols = info.get('n_vols')
+        if vols is None:
+            vols = nb.load(self.inputs.bold_file).shape[3]
 
         drop_missing = bool(self.inputs.drop_missing)
 
-        if info['sparse'] not in (None, 'None'):
-            sparse = pd.read_hdf(info['sparse'], key='sparse').rename(
-                columns={'condition': 'trial_type',
-                         'amplitude': 'modulation'})
-            sparse = sparse.dropna(subset=['modulation'])  # Drop NAs
-        else:
-            sparse = None
-
-        if info['dense'] not in (None, 'None'):
-            dense = pd.read_hdf(info['dense'], key='dense')
-
-            missing_columns = dense.isna().all()
-            if drop_missing:
-                # Remove columns with NaNs
-                dense = dense[dense.columns[missing_columns == False]]
-            elif missing_columns.any():
-                missing_names = ', '.join(
-                    dense.columns[missing_columns].tolist())
-                raise RuntimeError(
-                    f'The following columns are empty: {missing_names}. '
-                    'Use --drop-missing to drop before model fitting.')
-
-            column_names = dense.columns.tolist()
-            drift_model = None if (('cosine00' in column_names) |
-                                   ('cosine_00' in column_names)) else 'cosine'
-
-            if dense.empty:
-                dense = None
-                column_names = None
-        else:
-            dense = None
-            column_names = None
-            drift_model = 'cosine'
+        sparse, dense, drift_model = load_run_design(info, drop_missing)
+        column_names = None if dense is None else dense.columns.tolist()
 
         mat = dm.make_first_level_design_matrix(
             frame_times=np.arange(vols) * info['repetition_time'],
@@ -91,30 +48,34 @@ class DesignMatrix(NistatsBaseInterface, DesignMatrixInterface, SimpleInterface)
             drift_model=drift_model,
         )
 
-        mat.to_csv('design.tsv', sep='\t')
-        self._results['design_matrix'] = os.path.join(runtime.cwd,
-                                                      'design.tsv')
+        fname = os.path.join(runtime.cwd, 'design.npz')
+        save_design_matrix(fname, mat)
+        self._results['design_matrix'] = fname
         return runtime
 
 
 class FirstLevelModel(NistatsBaseInterface, FirstLevelEstimatorInterface, SimpleInterface):
     def _run_interface(self, runtime):
+        if not isdefined(self.inputs.bold_cache):
+            return self._fit(runtime, self.inputs.bold_file)
+        max_size_gb = self.inputs.bold_cache_gb
+        if not isdefined(max_size_gb):
+            max_size_gb = None
+        # The cached series is locked against eviction until the fit is complete
+        with cached_bold(self.inputs.bold_file, self.inputs.bold_cache,
+                         max_size_gb) as bold_file:
+            return self._fit(runtime, bold_file)
+
+    def _fit(self, runtime, bold_file):
         import nibabel as nb
         from nistats import first_level_model as level1
-        mat = pd.read_csv(self.inputs.design_matrix, delimiter='\t', index_col=0)
-        img = nb.load(self.inputs.bold_file)
-        if isinstance(img, nb.dataobj_images.DataobjImage):
-            # Ugly hack to ensure that retrieved data isn't cast to float64 unless
-            # necessary to prevent an overflow
-            # For NIfTI-1 files, slope and inter are 32-bit floats, so this is
-            # "safe". For NIfTI-2 (including CIFTI-2), these fields are 64-bit,
-            # so include a check to make sure casting doesn't lose too much.
-            slope32 = np.float32(img.dataobj._slope)
-            inter32 = np.float32(img.dataobj._inter)
-            if max(np.abs(slope32 - img.dataobj._slope),
-                   np.abs(inter32 - img.dataobj._inter)) < 1e-7:
-                img.dataobj._slope = slope32
-                img.dataobj._inter = inter32
+        mat = load_design_matrix(self.inputs.design_matrix)
+        img = nb.load(bold_file)
+        info = {}
+        if isdefined(self.inputs.session_info):
+            info = self.inputs.session_info
+        # Avoid casting retrieved data to float64 unless necessary
+        downcast_scaling(img, info.get('geometry'))
 
         mask_file = self.inputs.mask_file
         if not isdefined(mask_file):
@@ -122,9 +83,16 @@ class FirstLevelModel(NistatsBaseInterface, FirstLevelEstimatorInterface, Simple
         smoothing_fwhm = self.inputs.smoothing_fwhm
         if not isdefined(smoothing_fwhm):
             smoothing_fwhm = None
+        # Only the bounding box of the mask is read and fit, and maps are
+        # padded back to the field of view of the BOLD series
+        full_img, bounds = img, None
+        cropped = None if mask_file is None else crop_to_mask(img, mask_file, smoothing_fwhm)
+        if cropped is not None:
+            img, mask_file, bounds = cropped
         flm = level1.FirstLevelModel(
             mask_img=mask_file, smoothing_fwhm=smoothing_fwhm)
         flm.fit(img, design_matrices=mat)
+        del img
 
         effect_maps = []
         variance_maps = []
@@ -134,8 +102,8 @@ class FirstLevelModel(NistatsBaseInterface, FirstLevelEstimatorInterface, Simple
         contrast_metadata = []
         out_ents = self.inputs.contrast_info[0]['entities']
         fname_fmt = os.path.join(runtime.cwd, '{}_{}.nii.gz').format
-        for name, weights, contrast_type in prepare_contrasts(
-                self.inputs.contrast_info, mat.columns.tolist()):
+        for name, weights, contrast_type in run_contrasts(
+                info, self.inputs.contrast_info, mat.columns):
             contrast_metadata.append(
                 {'contrast': name,
                  'stat': contrast_type,
@@ -143,6 +111,9 @@ class FirstLevelModel(NistatsBaseInterface, FirstLevelEstimatorInterface, Simple
                 )
             maps = flm.compute_contrast(
                 weights, contrast_type, output_type='all')
+            if bounds is not None:
+                maps = {map_type: uncrop(map_img, full_img, bounds)
+                        for map_type, map_img in maps.items()}
 
             for map_type, map_list in (('effect_size', effect_maps),
                                        ('effect_variance', variance_maps),
@@ -151,6 +122,8 @@ class FirstLevelModel(NistatsBaseInterface, FirstLevelEstimatorInterface, Simple
                                        ('stat', stat_maps)):
 
                 fname = fname_fmt(name, map_type)
+                if self.inputs.precision == 'float32':
+                    maps[map_type].set_data_dtype(np.float32)
                 maps[map_type].to_filename(fname)
                 map_list.append(fname)
 
@@ -228,6 +201,8 @@ class SecondLevelModel(NistatsBaseInterface, SecondLevelEstimatorInterface, Simp
                                        ('p_value', pvalue_maps),
                                        ('stat', stat_maps)):
                 fname = fname_fmt(name, map_type)
+                if self.inputs.precision == 'float32':
+                    maps[map_type].set_data_dtype(np.float32)
                 maps[map_type].to_filename(fname)
                 map_list.append(fname)
 
@@ -0,0 +1,167 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from ...conftest import SPACE
+from ...utils.bids import get_file_entities
+from ..bids import BIDSSelect, LoadBIDSModel, MergeModelShards, _EntityIndex
+
+
+def test_load_run_metadata(bids_dir):
+    from bids.layout import BIDSLayout
+
+    sidecar = (bids_dir / 'derivatives' / 'fmriprep' / 'sub-01' / 'func' /
+               'sub-01_task-x_run-1_space-{}_desc-preproc_bold.json'.format(SPACE))
+    sidecar.write_text(json.dumps({'RepetitionTime': 1.5, 'TaskName': 'x',
+                                   'SliceTiming': [0, 0.5, 1]}))
+    analysis = SimpleNamespace(layout=BIDSLayout(str(bids_dir), derivatives=True,
+                                                 validate=False))
+    run = {'subject': '01', 'task': 'x', 'run': 1, 'suffix': 'bold', 'datatype': 'func',
+           'extension': 'nii.gz', 'desc': 'preproc', 'space': SPACE}
+
+    def load(**ents):
+        return LoadBIDSModel._load_run_metadata(analysis, [dict(run, **ents)])
+
+    # Repetition times are read from entities, or else from the matching BOLD file
+    assert load(RepetitionTime=3.) == [{'repetition_time': 3., 'space': SPACE}]
+    assert load() == [{'repetition_time': 1.5, 'space': SPACE}]
+    # Metadata are matched exactly, including those encoded by pybids variables
+    assert load(TaskName='x', SliceTiming='[0, 0.5, 1]')[0]['repetition_time'] == 1.5
+
+    with pytest.raises(ValueError, match='No BOLD file found'):
+        load(TaskName='y')
+    with pytest.raises(ValueError, match='no file has EchoTime'):
+        load(EchoTime=0.03)
+    # None matches files lacking an entity
+    assert load(desc=None, space=None) == [
+        {'repetition_time': 2., 'space': None}]
+    # Without these entities, raw and preprocessed series both match
+    unspecific = {key: val for key, val in run.items() if key not in ('desc', 'space')}
+    with pytest.raises(ValueError, match='Too many BOLD files found'):
+        LoadBIDSModel._load_run_metadata(analysis, [unspecific])
+
+
+def _shard(subject, dataset_weights):
+    run_contrasts = [{'name': 'a', 'type': 't', 'weights': [{'a': 1}],
+                      'entities': {'subject': subject, 'run': 1}}]
+    subject_contrasts = [{'name': 'a', 'type': 't', 'weights': [{'a': 1}],
+                          'entities': {'subject': subject}}]
+    dataset_contrasts = [{'name': 'a', 'type': 't', 'weights': dataset_weights,
+                          'entities': {}}]
+    return {'design_info': [{'subject': subject, 'run': 1}],
+            'contrast_info': [[run_contrasts], [subject_contrasts], [dataset_contrasts]],
+            'entities': [[{'subject': subject, 'run': 1}], [{'subject': subject}], [{}]],
+            'warnings': ['warnings-{}.html'.format(subject)]}
+
+
+def _merge(*shards):
+    merge = MergeModelShards(n_shards=len(shards))
+    for ix, shard in enumerate(shards):
+        for field, value in shard.items():
+            setattr(merge.inputs, '{}{:d}'.format(field, ix), value)
+    return merge.run().outputs
+
+
+def test_merge_model_shards(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shards = [_shard('01', [{'a': 1}]), _shard('02', [{'a': 1}])]
+    merged = _merge(*shards)
+
+    assert merged.design_info == [{'subject': '01', 'run': 1}, {'subject': '02', 'run': 1}]
+    assert merged.warnings == ['warnings-01.html', 'warnings-02.html']
+    assert merged.entities[0] == [{'subject': '01', 'run': 1}, {'subject': '02', 'run': 1}]
+    # Runs and subjects are concatenated, and the dataset is merged
+    assert [len(level) for level in merged.contrast_info] == [2, 2, 1]
+    assert merged.contrast_info[2] == shards[0]['contrast_info'][2]
+    # Entities describe the same units as contrasts
+    assert merged.entities[1:] == [[{'subject': '01'}, {'subject': '02'}], [{}]]
+
+    with pytest.raises(ValueError, match="Contrast 'a' for {} differs"):
+        _merge(shards[0], _shard('02', [{'a': 2}]))
+
+
+def test_entity_index(bids_dir):
+    from bids.layout import BIDSLayout
+
+    layout = BIDSLayout(str(bids_dir), derivatives=True, validate=False)
+    paths = layout.get(return_type='file')
+    file_ents = get_file_entities(layout, paths)
+    assert file_ents == {path: layout.files[path].get_entities() for path in paths}
+
+    index = _EntityIndex(file_ents)
+    # Matches as BIDSLayout.get does
+    for query in ({'subject': '01', 'run': 2},
+                  {'subject': ['01', '02'], 'run': '1', 'suffix': 'bold'},
+                  {'subject': '02', 'space': None, 'extension': '.nii.gz'},
+                  {'desc': 'brain', 'suffix': 'mask', 'extension': ['.nii', '.nii.gz']},
+                  {'space': SPACE, 'desc': 'confounds'},
+                  {'subject': '03'}):
+        assert index.get(**query) == sorted(layout.get(return_type='file', **query))
+
+
+@pytest.mark.parametrize('index_entities', [True, False])
+def test_bids_select(bids_dir, tmp_path, monkeypatch, index_entities):
+    monkeypatch.chdir(tmp_path)
+    # Runs without a brain mask are selected with none
+    mask = (bids_dir / 'derivatives' / 'fmriprep' / 'sub-02' / 'func' /
+            'sub-02_task-x_run-2_space-{}_desc-brain_mask.nii.gz'.format(SPACE))
+    mask.unlink()
+    runs = [{'subject': subject, 'run': run, 'task': 'x'}
+            for subject in ('01', '02') for run in (1, 2)]
+    select = BIDSSelect(bids_dir=str(bids_dir), derivatives=True, entities=runs,
+                        selectors={'suffix': 'bold', 'extension': ['nii.gz', 'nii'],
+                                   'desc': 'preproc', 'space': SPACE},
+                        index_entities=index_entities)
+    outputs = select.run().outputs
+
+    deriv = bids_dir / 'derivatives' / 'fmriprep'
+    prefixes = [str(deriv / 'sub-{subject}' / 'func' /
+                    'sub-{subject}_task-x_run-{run}_space-{space}_desc-').format(
+                        space=SPACE, **run) for run in runs]
+    assert outputs.bold_files == [prefix + 'preproc_bold.nii.gz' for prefix in prefixes]
+    assert outputs.mask_files == [prefix + 'brain_mask.nii.gz' for prefix in prefixes[:3]] + [
+        None]
+    assert [{key: ents[key] for key in ('subject', 'run', 'space')}
+            for ents in outputs.entities] == [dict(subject=run['subject'], run=run['run'],
+                                                   space=SPACE) for run in runs]
+
+    select.inputs.entities = [{'subject': '01', 'run': 3}]
+    with pytest.raises(FileNotFoundError):
+        select.run()
+    select.inputs.entities = [{'subject': '01', 'run': 1}]
+    select.inputs.selectors = {'suffix': 'bold'}
+    with pytest.raises(ValueError, match='Non-unique BOLD file'):
+        select.run()
+
+
+@pytest.mark.parametrize('index_entities', [True, False])
+def test_bids_select_metadata(bids_dir, tmp_path, monkeypatch, index_entities):
+    monkeypatch.chdir(tmp_path)
+    # fMRIPrep sidecars carry metadata, which the loader includes in run entities
+    deriv = bids_dir / 'derivatives' / 'fmriprep'
+    for sidecar in deriv.glob('sub-*/func/*_desc-preproc_bold.json'):
+        sidecar.write_text(json.dumps({'RepetitionTime': 2.0, 'EchoTime': 0.03,
+                                       'SliceTiming': [0, 0.5, 1]}))
+    model = {'Name': 'test', 'Input': {'Task': 'x'},
+             'Steps': [{'Level': 'run',
+                        'Transformations': [{'Name': 'Factor', 'Input': ['trial_type']}],
+                        'Model': {'X': ['trial_type.a', 'trans_x']}}]}
+    loader = LoadBIDSModel(bids_dir=str(bids_dir), derivatives=True, model=model,
+                           selectors={'desc': 'preproc', 'space': SPACE})
+    entities = loader.run().outputs.entities[0]
+    assert {'EchoTime', 'SliceTiming'} <= set(entities[0])
+
+    select = BIDSSelect(bids_dir=str(bids_dir), derivatives=True, entities=entities,
+                        selectors={'suffix': 'bold', 'extension': ['nii.gz', 'nii']},
+                        index_entities=index_entities)
+    outputs = select.run().outputs
+    assert outputs.bold_files == sorted(
+        str(path) for path in deriv.glob('sub-*/func/*_desc-preproc_bold.nii.gz'))
+    assert all(mask is not None for mask in outputs.mask_files)
+    # Output entities are those of the file names
+    assert not {'EchoTime', 'SliceTiming'} & set(outputs.entities[0])
+
+    select.inputs.entities = [dict(entities[0], EchoTime=0.05)]
+    with pytest.raises(FileNotFoundError):
+        select.run()
@@ -0,0 +1,292 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ...utils.contrasts import CompiledContrasts, contrast_key, save_contrast_store
+from ...utils.design import load_design_matrix, save_design_store
+from ..native import SubjectMask, ValidateModel
+
+CONTRASTS = [{'name': 'a', 'type': 't', 'weights': [{'a': 1}]},
+             {'name': 'a-b', 'type': 't', 'weights': [{'a': 1, 'b': -1}]}]
+
+
+def _events(conditions, n_events=4):
+    return pd.DataFrame({'onset': np.arange(n_events * len(conditions)) * 10.,
+                         'duration': 2.,
+                         'condition': list(conditions) * n_events,
+                         'amplitude': 1.})
+
+
+def _design_info(path, designs, contrasts=CONTRASTS, n_vols=60):
+    store = str(path / 'design.npz')
+    save_design_store(store, designs)
+    key = contrast_key(contrasts)
+    save_contrast_store(str(path / 'contrasts.npz'),
+                        {key: CompiledContrasts.from_contrast_info(contrasts)})
+    return [{'run': run, 'design_store': store, 'repetition_time': 2.0, 'n_vols': n_vols,
+             'contrast_store': str(path / 'contrasts.npz'), 'contrast_key': key}
+            for run in designs]
+
+
+def test_validate_model_passes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    infos = _design_info(tmp_path, {'r1': (_events('ab'), None),
+                                    'r2': (_events('ab'), None)})
+    result = ValidateModel(design_info=infos).run()
+    assert result.outputs.design_info == infos
+
+
+def test_validate_model_reports_all_problems(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    partial = rng.randn(60)
+    partial[3] = np.nan
+    dense = pd.DataFrame({'empty': np.nan, 'partial': partial, 'ok': rng.randn(60)})
+    infos = _design_info(tmp_path, {'r1': (_events('ab'), dense),
+                                    'r2': (_events('a'), None)})
+
+    with pytest.raises(RuntimeError) as excinfo:
+        ValidateModel(design_info=infos).run()
+    message = str(excinfo.value)
+    assert "Regressor 'empty' is empty in 1 of 2 runs: r1" in message
+    assert "Regressors 'partial' have missing values in 1 of 2 runs: r1" in message
+    # Contrasts are skipped where conditions are missing, as they always were
+    assert "Condition 'b' is missing" not in message
+
+    # Empty regressors are only warnings with drop_missing, but missing values
+    # are not filled in before fitting
+    with pytest.raises(RuntimeError) as excinfo:
+        ValidateModel(design_info=infos, drop_missing=True).run()
+    assert str(excinfo.value).splitlines()[1:] == [
+        "Regressors 'partial' have missing values in 1 of 2 runs: r1"]
+    infos = _design_info(tmp_path, {'r1': (_events('ab'), dense.drop(columns='partial')),
+                                    'r2': (_events('a'), None)})
+    result = ValidateModel(design_info=infos, drop_missing=True).run()
+    assert result.outputs.design_info == infos
+
+
+def test_validate_model_rank_deficient(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Conditions a and b always co-occur, so a-b is not estimable
+    events = _events('a')
+    events = pd.concat([events, events.assign(condition='b')], ignore_index=True)
+    infos = _design_info(tmp_path, {'r1': (events, None)})
+    # Fitting proceeds from the pseudo-inverse; this is not an error
+    ValidateModel(design_info=infos).run()
+
+
+def test_validate_model_reads_volume_count(tmp_path, monkeypatch):
+    import nibabel as nb
+
+    monkeypatch.chdir(tmp_path)
+    infos = _design_info(tmp_path, {'r1': (_events('ab'), None)})
+    del infos[0]['n_vols']
+    bold_file = str(tmp_path / 'bold.nii')
+    nb.Nifti1Image(np.zeros((2, 2, 2, 60), dtype=np.float32), np.eye(4)).to_filename(bold_file)
+    ValidateModel(design_info=infos, bold_file=[bold_file]).run()
+
+
+def test_design_matrix_matches_nistats(tmp_path, monkeypatch):
+    import nibabel as nb
+    from .. import native, nistats
+
+    rng = np.random.RandomState(0)
+    dense = pd.DataFrame(rng.randn(60, 2), columns=['x', 'y'])
+    infos = _design_info(tmp_path, {'r1': (_events('ab'), dense), 'r2': (_events('abc'), None)})
+    bold_file = str(tmp_path / 'bold.nii')
+    nb.Nifti1Image(np.zeros((2, 2, 2, 60), dtype=np.float32), np.eye(4)).to_filename(bold_file)
+
+    monkeypatch.chdir(tmp_path)
+    ours = native.DesignMatrix(session_info=infos).run().outputs.design_matrix
+    assert len(ours) == 2
+    for info, fname in zip(infos, ours):
+        (tmp_path / info['run']).mkdir()
+        monkeypatch.chdir(tmp_path / info['run'])
+        theirs = nistats.DesignMatrix(session_info=info, bold_file=bold_file).run()
+        expected = load_design_matrix(theirs.outputs.design_matrix)
+        mat = load_design_matrix(fname)
+        assert fname.endswith('.npz') and theirs.outputs.design_matrix.endswith('.npz')
+        assert mat.columns.tolist() == expected.columns.tolist()
+        assert np.array_equal(mat.index, expected.index)
+        assert np.allclose(mat, expected)
+
+
+CONTRAST_INFO = [{'name': 'a-b', 'type': 't', 'weights': [{'a': 1, 'b': -1}],
+                  'entities': {'subject': '01'}},
+                 {'name': 'abc', 'type': 'F', 'weights': [{'a': 1}, {'b': 1}, {'c': 1}],
+                  'entities': {'subject': '01'}}]
+MAPS = ('effect_maps', 'variance_maps', 'stat_maps', 'zscore_maps', 'pvalue_maps')
+
+
+def _first_level_inputs(path, shape=(5, 5, 4), n_vols=80, mask=None, ext='.nii', seed=0):
+    """ Write a BOLD series with effects of a random design, a mask and the design """
+    import nibabel as nb
+    from ...utils.design import save_design_matrix
+
+    rng = np.random.RandomState(seed)
+    mat = pd.DataFrame(rng.randn(n_vols, 3), columns=['a', 'b', 'c']).assign(constant=1.)
+    data = 1000 + np.einsum('tr,xyzr->xyzt', mat.to_numpy(), rng.randn(*shape, 4))
+    data += rng.randn(*data.shape)
+    if mask is None:
+        mask = np.ones(shape, dtype=np.uint8)
+    affine = np.diag([3., 3., 3., 1.])
+    inputs = {'bold_file': str(path / ('bold' + ext)), 'mask_file': str(path / 'mask.nii'),
+              'design_matrix': str(path / 'design.npz'), 'contrast_info': CONTRAST_INFO}
+    nb.Nifti1Image(data.astype(np.float32), affine).to_filename(inputs['bold_file'])
+    nb.Nifti1Image(mask.astype(np.uint8), affine).to_filename(inputs['mask_file'])
+    save_design_matrix(inputs['design_matrix'], mat)
+    return inputs
+
+
+def _first_level_maps(cwd, monkeypatch, interface, **inputs):
+    import nibabel as nb
+
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+    outputs = interface(**inputs).run().outputs
+    return {maps: [nb.load(fname).get_fdata() for fname in getattr(outputs, maps)]
+            for maps in MAPS}
+
+
+def test_first_level_model_matches_nistats(tmp_path, monkeypatch):
+    from .. import native, nistats
+
+    inputs = _first_level_inputs(tmp_path)
+    ours = _first_level_maps(tmp_path / 'native', monkeypatch, native.FirstLevelModel,
+                             **inputs)
+    theirs = _first_level_maps(tmp_path / 'nistats', monkeypatch, nistats.FirstLevelModel,
+                               **inputs)
+    for maps in MAPS:
+        for our_map, their_map in zip(ours[maps], theirs[maps]):
+            assert our_map.shape == their_map.shape
+            assert np.allclose(our_map, their_map, rtol=1e-4, atol=1e-6)
+    # F contrasts have a single effect map, of the first row
+    assert ours['effect_maps'][1].shape == (5, 5, 4)
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+@pytest.mark.parametrize('smoothing_fwhm', [None, 6.])
+def test_first_level_model_streaming(tmp_path, monkeypatch, ext, smoothing_fwhm):
+    from ..native import FirstLevelModel
+
+    mask = np.zeros((12, 10, 9), dtype=np.uint8)
+    mask[2:10, 3:8, 1:8] = 1
+    mask[5, 5, 4] = 0
+    inputs = _first_level_inputs(tmp_path, shape=mask.shape, n_vols=60, mask=mask, ext=ext)
+    if smoothing_fwhm is not None:
+        inputs['smoothing_fwhm'] = smoothing_fwhm
+
+    in_memory = _first_level_maps(tmp_path / 'in_memory', monkeypatch, FirstLevelModel,
+                                  **inputs)
+    # Slabs of two slices, read with neighbouring slices for smoothing
+    monkeypatch.setattr(FirstLevelModel, '_n_slices', lambda self, *args, **kwargs: 2)
+    streamed = _first_level_maps(tmp_path / 'streamed', monkeypatch, FirstLevelModel,
+                                 max_mem_gb=1., **inputs)
+    for maps in MAPS:
+        for expected, value in zip(in_memory[maps], streamed[maps]):
+            assert np.allclose(value, expected)
+            assert not value[mask == 0].any()
+
+
+@pytest.mark.parametrize('interface', ['native', 'nistats'])
+def test_first_level_model_float32(tmp_path, monkeypatch, interface):
+    import nibabel as nb
+    from .. import native, nistats
+
+    FirstLevelModel = {'native': native, 'nistats': nistats}[interface].FirstLevelModel
+    inputs = _first_level_inputs(tmp_path)
+    double = _first_level_maps(tmp_path / 'double', monkeypatch, FirstLevelModel, **inputs)
+    (tmp_path / 'single').mkdir()
+    monkeypatch.chdir(tmp_path / 'single')
+    outputs = FirstLevelModel(precision='float32', **inputs).run().outputs
+    for maps in MAPS:
+        for fname, expected in zip(getattr(outputs, maps), double[maps]):
+            img = nb.load(fname)
+            assert img.get_data_dtype() == np.float32
+            assert np.abs(img.get_fdata() - expected).max() <= 1e-5 * np.abs(expected).max()
+
+
+@pytest.mark.parametrize('interface', ['native', 'nistats'])
+def test_first_level_model_crops_to_mask(tmp_path, monkeypatch, interface):
+    from .. import native, nistats
+
+    module = {'native': native, 'nistats': nistats}[interface]
+    mask = np.zeros((9, 8, 7), dtype=np.uint8)
+    mask[2:7, 3:6, 1:5] = 1
+    inputs = _first_level_inputs(tmp_path, shape=mask.shape, mask=mask)
+    inputs['smoothing_fwhm'] = 5.
+    cropped = _first_level_maps(tmp_path / 'cropped', monkeypatch, module.FirstLevelModel,
+                                **inputs)
+    monkeypatch.setattr(module, 'crop_to_mask', lambda *args: None)
+    full = _first_level_maps(tmp_path / 'full', monkeypatch, module.FirstLevelModel,
+                             **inputs)
+    for maps in MAPS:
+        for value, expected in zip(cropped[maps], full[maps]):
+            assert value.shape == expected.shape
+            assert np.allclose(value, expected)
+
+
+def test_subject_mask(tmp_path, monkeypatch):
+    import nibabel as nb
+    from nilearn.masking import compute_epi_mask
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    data = rng.uniform(0, 10, (12, 12, 12, 10)).astype(np.float32)
+    data[2:10, 2:10, 2:10] += 1000
+    masks = [np.zeros((12, 12, 12), dtype=np.uint8) for _ in range(2)]
+    masks[0][1:10, 2:10, 2:10] = 1
+    masks[1][3:11, 2:10, 2:10] = 1
+
+    def save(array, name, affine=np.eye(4)):
+        fname = str(tmp_path / name)
+        nb.Nifti1Image(array, affine).to_filename(fname)
+        return fname
+
+    bold_files = [save(data, 'bold{}.nii'.format(ix)) for ix in range(4)]
+    mask_files = [save(masks[0], 'mask0.nii'), save(masks[1], 'mask1.nii'), None,
+                  save(masks[0], 'mask3.nii', np.diag([2., 2., 2., 1.]))]
+    entities = [{'subject': '01', 'space': 'MNI'}, {'subject': '01', 'space': 'MNI'},
+                {'subject': '01', 'space': 'MNI'}, {'subject': '01', 'space': 'MNI'}]
+
+    out_files = SubjectMask(bold_file=bold_files, mask_file=mask_files,
+                            entities=entities, max_mem_gb=1e-6).run().outputs.mask_file
+    # Runs on a shared grid share the intersection of their (EPI) masks
+    assert out_files[0] == out_files[1] == out_files[2] != out_files[3]
+    shared = np.asanyarray(nb.load(out_files[0]).dataobj)
+    epi_mask = compute_epi_mask(nb.load(bold_files[2])).get_fdata().astype(bool)
+    assert shared.any()
+    assert np.array_equal(shared, masks[0] & masks[1] & epi_mask)
+    assert np.array_equal(np.asanyarray(nb.load(out_files[3]).dataobj), masks[0])
+
+    # Disjoint masks are an error
+    masks[1][:] = 0
+    masks[1][11, 11, 11] = 1
+    with pytest.raises(RuntimeError):
+        SubjectMask(bold_file=bold_files[:2],
+                    mask_file=[mask_files[0], save(masks[1], 'disjoint.nii')],
+                    entities=entities[:2]).run()
+
+
+def test_first_level_model_releases_bold(tmp_path, monkeypatch):
+    import nibabel as nb
+    from ...utils.design import save_design_matrix
+    from ...utils.tests.test_images import _open_files
+    from ..native import FirstLevelModel
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    mat = pd.DataFrame({'a': rng.randn(40), 'constant': 1.})
+    bold_file = str(tmp_path / 'bold.nii.gz')
+    nb.Nifti1Image(1000 + rng.randn(4, 4, 4, 40).astype(np.float32),
+                   np.eye(4)).to_filename(bold_file)
+    mask_file = str(tmp_path / 'mask.nii')
+    nb.Nifti1Image(np.ones((4, 4, 4), dtype=np.uint8), np.eye(4)).to_filename(mask_file)
+    design_matrix = str(tmp_path / 'design.npz')
+    save_design_matrix(design_matrix, mat)
+
+    FirstLevelModel(bold_file=bold_file, mask_file=mask_file, design_matrix=design_matrix,
+                    max_mem_gb=0.01,
+                    contrast_info=[{'name': 'a', 'type': 't', 'weights': [{'a': 1}],
+                                    'entities': {}}]).run()
+    assert not _open_files(bold_file)
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from ...utils.contrasts import CompiledContrasts, contrast_key, save_contrast_store
+from ...utils.design import save_design_matrix
+from .. import visualizations
+from ..visualizations import DesignCorrelationPlot
+
+CONTRASTS = [{'name': 'b', 'type': 't', 'weights': [{'b': 1}]},
+             {'name': 'a-b', 'type': 't', 'weights': [{'a': 1, 'b': -1}]}]
+
+
+def test_design_correlation_plot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    design = pd.DataFrame(rng.randn(20, 4), columns=['trans_x', 'a', 'b', 'constant'])
+    save_design_matrix(str(tmp_path / 'design.npz'), design)
+    key = contrast_key(CONTRASTS)
+    save_contrast_store(str(tmp_path / 'contrasts.npz'),
+                        {key: CompiledContrasts.from_contrast_info(CONTRASTS)})
+
+    plotted = []
+    monkeypatch.setattr(visualizations, 'plot_and_save',
+                        lambda fname, plotter, *args: plotted.append(args))
+    # Contrasts are read from the compiled store, rather than from contrast_info
+    DesignCorrelationPlot(
+        data=str(tmp_path / 'design.npz'), image_type='svg', contrast_info=[],
+        session_info={'contrast_store': str(tmp_path / 'contrasts.npz'),
+                      'contrast_key': key}).run()
+    (corr, n_evs), = plotted
+    # Explanatory variables are moved ahead of confounds
+    assert list(corr.columns) == ['a', 'b', 'trans_x']
+    assert n_evs == 2
@@ -10,6 +10,8 @@ from nipype.interfaces.base import (
     )
 from nipype.utils.filemanip import fname_presuffix, split_filename
 
+from ..utils.contrasts import load_run_contrasts
+from ..utils.design import load_design_matrix
 from ..viz import plot_and_save, plot_corr_matrix, plot_contrast_matrix
 
 
@@ -48,6 +50,8 @@ class Visualization(SimpleInterface):
         _, _, ext = split_filename(fname)
         if ext == '.tsv':
             return pd.read_table(fname, index_col=0)
+        elif ext == '.npz':
+            return load_design_matrix(fname)
         elif ext in ('.nii', '.nii.gz', '.gii'):
             return nb.load(fname)
         raise ValueError("Unknown file type!")
@@ -62,27 +66,29 @@ class DesignPlot(Visualization):
 
 class DesignCorrelationPlotInputSpec(VisualizationInputSpec):
     contrast_info = traits.List(traits.Dict)
+    session_info = traits.Dict(desc='Design information of the run, referring to its '
+                                    'compiled contrasts')
 
 
 class DesignCorrelationPlot(Visualization):
     input_spec = DesignCorrelationPlotInputSpec
 
     def _visualize(self, data, out_name):
-        contrast_matrix = pd.DataFrame({c['name']: c['weights'][0]
-                                        for c in self.inputs.contrast_info})
-        all_cols = list(data.columns)
-        evs = set(contrast_matrix.index)
-        if set(contrast_matrix.index) != all_cols[:len(evs)]:
-            ev_cols = [col for col in all_cols if col in evs]
-            confound_cols = [col for col in all_cols if col not in evs]
-            data = data[ev_cols + confound_cols]
+        info = self.inputs.session_info if isdefined(self.inputs.session_info) else {}
+        evs = load_run_contrasts(info, self.inputs.contrast_info).conditions
+        # Explanatory variables precede confounds
+        ev_cols = [col for col in data.columns if col in evs]
+        confound_cols = [col for col in data.columns if col not in evs]
+        data = data[ev_cols + confound_cols]
         plot_and_save(out_name, plot_corr_matrix,
                       data.drop(columns='constant').corr(),
-                      len(evs))
+                      len(ev_cols))
 
 
 class ContrastMatrixPlotInputSpec(VisualizationInputSpec):
     contrast_info = traits.List(traits.Dict)
+    session_info = traits.Dict(desc='Design information of the run, referring to its '
+                                    'compiled contrasts')
     orientation = traits.Enum('horizontal', 'vertical', usedefault=True,
                               desc='Display orientation of contrast matrix')
 
@@ -91,10 +97,9 @@ class ContrastMatrixPlot(Visualization):
     input_spec = ContrastMatrixPlotInputSpec
 
     def _visualize(self, data, out_name):
-        contrast_matrix = pd.DataFrame({c['name']: c['weights'][0]
-                                        for c in self.inputs.contrast_info},
-                                       index=data.columns)
-        contrast_matrix.fillna(value=0, inplace=True)
+        info = self.inputs.session_info if isdefined(self.inputs.session_info) else {}
+        contrast_matrix = load_run_contrasts(
+            info, self.inputs.contrast_info).matrix(data.columns)
         if 'constant' in contrast_matrix.index:
             contrast_matrix = contrast_matrix.drop(index='constant')
         plot_and_save(out_name, plot_contrast_matrix, contrast_matrix,
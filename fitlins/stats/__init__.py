@@ -0,0 +1,7 @@
+"""
+Statistical routines implemented natively in FitLins, operating on NumPy arrays.
+
+These are used by the :mod:`~fitlins.interfaces.native` interfaces, and are
+written to process many runs at once, where external estimators would process
+them one at a time.
+"""
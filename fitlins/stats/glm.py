@@ -0,0 +1,240 @@
+"""
+Vectorized general linear models
+
+Ordinary least squares and AR(1) prewhitened models are fit to a matrix of
+voxel time series, one block of voxels at a time, with a single matrix product
+per block (or per block and AR coefficient).
+
+Results follow :func:`nistats.first_level_model.run_glm` and
+:func:`nistats.contrasts.compute_contrast`: AR(1) coefficients are estimated
+from OLS residuals and truncated to ``1 / bins``, and voxels sharing a
+coefficient share a whitened design.
+
+Models may be estimated in single precision, halving the memory held by data
+and parameter estimates.
+Designs are pseudo-inverted in double precision, so that single precision
+maps of percent signal change data agree with double precision maps to within
+``1e-5`` of the largest magnitude of each map:
+
+>>> rng = np.random.RandomState(0)
+>>> X = np.column_stack([rng.randn(200, 3), np.ones(200)])
+>>> Y = percent_signal_change(1000 + X @ rng.randn(4, 500) + rng.randn(200, 500))
+>>> double = compute_contrast(fit_glm(Y, X), [1, -1, 0, 0])
+>>> single = compute_contrast(fit_glm(Y.astype(np.float32), X, dtype=np.float32),
+...                           [1, -1, 0, 0])
+>>> single['z_score'].dtype
+dtype('float32')
+>>> all(np.abs(single[k] - double[k]).max() < 1e-5 * np.abs(double[k]).max()
+...     for k in double)
+True
+"""
+import numpy as np
+
+# Bounds on variance and degrees of freedom, as in nistats
+TINY = 1e-50
+DOFMAX = 1e10
+
+
+class GLMResults(object):
+    """ Parameter estimates of a GLM fit to many voxels
+
+    Attributes
+    ----------
+    beta : array of shape (n_regressors, n_voxels)
+    dispersion : array of shape (n_voxels,)
+        Residual variance, from whitened residuals
+    labels : array of shape (n_voxels,)
+        Index into ``cov`` of the model of each voxel
+    cov : array of shape (n_models, n_regressors, n_regressors)
+        Normalized covariance of the parameters, for each (whitened) design
+    rho : array of shape (n_models,)
+        AR(1) coefficient of each design (0 for OLS)
+    df_residuals : int
+    """
+    def __init__(self, beta, dispersion, labels, cov, rho, df_residuals):
+        self.beta = beta
+        self.dispersion = dispersion
+        self.labels = labels
+        self.cov = cov
+        self.rho = rho
+        self.df_residuals = df_residuals
+
+
+def _blocks(n_voxels, block_size):
+    if not block_size:
+        block_size = max(n_voxels, 1)
+    for start in range(0, n_voxels, block_size):
+        yield slice(start, min(start + block_size, n_voxels))
+
+
+def percent_signal_change(Y):
+    """ Scale the columns of ``Y`` to percent change from their means, in place if possible """
+    if not np.issubdtype(Y.dtype, np.floating):
+        Y = Y.astype(np.float64)
+    mean = np.maximum(Y.mean(axis=0), 1)
+    Y /= mean
+    Y -= 1
+    Y *= 100
+    return Y
+
+
+def ar1_whiten(X, rho):
+    """ Whiten the rows of ``X`` for an AR(1) process with coefficient ``rho`` """
+    whitened = X.copy()
+    whitened[1:] -= rho * X[:-1]
+    return whitened
+
+
+def fit_glm(Y, X, noise_model='ar1', bins=100, block_size=None, dtype=np.float64):
+    """ Fit a GLM to the columns of ``Y``
+
+    Parameters
+    ----------
+    Y : array of shape (n_timepoints, n_voxels)
+    X : array of shape (n_timepoints, n_regressors)
+    noise_model : ``'ar1'`` or ``'ols'``
+    bins : int
+        AR(1) coefficients are truncated to multiples of ``1 / bins``
+    block_size : int
+        Maximum number of voxels processed at once (default: all)
+    dtype : dtype
+        Precision of data and parameter estimates; pseudo-inverses and
+        covariances of the design are computed in double precision
+
+    Returns
+    -------
+    results : :class:`GLMResults`
+    """
+    if noise_model not in ('ar1', 'ols'):
+        raise ValueError("Unknown noise model: {!r}".format(noise_model))
+    if Y.shape[0] != X.shape[0]:
+        raise ValueError("Design has {} rows for {} time points"
+                         "".format(X.shape[0], Y.shape[0]))
+
+    X = np.asarray(X, dtype=np.float64)
+    dtype = np.dtype(dtype)
+    n_timepoints, n_regressors = X.shape
+    n_voxels = Y.shape[1]
+    df_model = np.linalg.matrix_rank(X, np.abs(X).sum() * np.finfo(float).eps)
+    denom = n_timepoints - n_regressors
+
+    beta = np.zeros((n_regressors, n_voxels), dtype=dtype)
+    dispersion = np.zeros(n_voxels, dtype=dtype)
+
+    pinv = np.linalg.pinv(X)
+    pinv_, X_ = pinv.astype(dtype), X.astype(dtype)
+    labels = np.zeros(n_voxels, dtype=int)
+    rhos = np.zeros(n_voxels)
+    for block in _blocks(n_voxels, block_size):
+        Yb = np.asarray(Y[:, block], dtype=dtype)
+        beta[:, block] = pinv_ @ Yb
+        resid = Yb - X_ @ beta[:, block]
+        if noise_model == 'ols':
+            dispersion[block] = (resid ** 2).sum(0) / denom
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rho = ((resid[1:] * resid[:-1]).sum(0, dtype=np.float64) /
+                       (resid ** 2).sum(0, dtype=np.float64))
+            rhos[block] = np.trunc(np.nan_to_num(rho) * bins) / bins
+
+    if noise_model == 'ols':
+        return GLMResults(beta, dispersion, labels, (pinv @ pinv.T)[np.newaxis],
+                          np.zeros(1), n_timepoints - df_model)
+
+    # Voxels with identical coefficients share a whitened design
+    values, labels = np.unique(rhos, return_inverse=True)
+    cov = np.zeros((len(values), n_regressors, n_regressors))
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(len(values) + 1))
+    for label, rho in enumerate(values):
+        wX = ar1_whiten(X, rho)
+        wpinv = np.linalg.pinv(wX)
+        cov[label] = wpinv @ wpinv.T
+        wpinv, wX = wpinv.astype(dtype), wX.astype(dtype)
+        voxels = order[bounds[label]:bounds[label + 1]]
+        for block in _blocks(len(voxels), block_size):
+            idx = voxels[block]
+            wY = ar1_whiten(np.asarray(Y[:, idx], dtype=dtype), dtype.type(rho))
+            beta[:, idx] = wpinv @ wY
+            dispersion[idx] = ((wY - wX @ beta[:, idx]) ** 2).sum(0) / denom
+    return GLMResults(beta, dispersion, labels, cov, values, n_timepoints - df_model)
+
+
+def fit_glm_chunks(chunks, X, n_voxels, noise_model='ar1', bins=100, dtype=np.float64):
+    """ Fit a GLM to chunks of voxels, as they are read
+
+    ``chunks`` yields ``(index, Y)`` pairs, where ``index`` is the position of
+    the columns of ``Y`` among ``n_voxels`` voxels.
+    Only one chunk is held in memory at a time, and its parameter estimates are
+    written into arrays allocated for all voxels.
+    Results are those of :func:`fit_glm` on the complete data.
+    """
+    n_regressors = X.shape[1]
+    beta = np.zeros((n_regressors, n_voxels), dtype=dtype)
+    dispersion = np.zeros(n_voxels, dtype=dtype)
+    labels = np.zeros(n_voxels, dtype=int)
+    models = {}
+    cov = []
+    df_residuals = X.shape[0]
+    for index, Y in chunks:
+        chunk = fit_glm(Y, X, noise_model=noise_model, bins=bins, dtype=dtype)
+        # Relabel the models of the chunk, shared with other chunks by coefficient
+        relabel = np.zeros(len(chunk.rho), dtype=int)
+        for label, rho in enumerate(chunk.rho):
+            if rho not in models:
+                models[rho] = len(models)
+                cov.append(chunk.cov[label])
+            relabel[label] = models[rho]
+        beta[:, index] = chunk.beta
+        dispersion[index] = chunk.dispersion
+        labels[index] = relabel[chunk.labels]
+        df_residuals = chunk.df_residuals
+    if not cov:
+        cov = [np.zeros((n_regressors, n_regressors))]
+    return GLMResults(beta, dispersion, labels, np.stack(cov), np.array(list(models)),
+                      df_residuals)
+
+
+def compute_contrast(results, con_val, contrast_type='t'):
+    """ Estimate a contrast from GLM results
+
+    Returns a dictionary of ``effect_size``, ``effect_variance``, ``stat``,
+    ``p_value`` and ``z_score`` arrays, with one value per voxel, of the
+    precision of the parameter estimates.
+    For F contrasts, ``effect_size`` is the first row of the whitened effect,
+    as returned by :meth:`nistats.contrasts.Contrast.effect_size`.
+    """
+    from scipy import stats as sps
+    from scipy.linalg import sqrtm
+
+    con_val = np.atleast_2d(np.asarray(con_val, dtype=np.float64))
+    dim = con_val.shape[0]
+    if contrast_type == 't' and dim > 1:
+        contrast_type = 'F'
+    cbeta = con_val @ results.beta
+    # Contrast covariance for each whitened design
+    con_cov = np.einsum('ij,ljk,mk->lim', con_val, results.cov, con_val)
+    dof = min(float(results.df_residuals), DOFMAX)
+    dtype = results.beta.dtype
+
+    if contrast_type == 't':
+        effect = cbeta[0]
+        variance = con_cov[:, 0, 0][results.labels] * results.dispersion
+        stat = effect / np.sqrt(np.maximum(variance, TINY))
+        p_value = sps.t.sf(stat, dof)
+    elif contrast_type == 'F':
+        weights = np.stack([np.real(sqrtm(np.linalg.inv(cov))) for cov in con_cov])
+        wcbeta = np.einsum('vij,jv->iv', weights[results.labels], cbeta)
+        effect = wcbeta[0]
+        variance = results.dispersion
+        stat = (wcbeta ** 2).sum(0) / dim / np.maximum(variance, TINY)
+        p_value = sps.f.sf(stat, dim, dof)
+    else:
+        raise ValueError("Unknown contrast type: {!r}".format(contrast_type))
+
+    z_score = sps.norm.isf(np.clip(p_value, 1e-300, 1 - 1e-16))
+    return {'effect_size': effect.astype(dtype, copy=False),
+            'effect_variance': variance.astype(dtype, copy=False),
+            'stat': stat.astype(dtype, copy=False),
+            'p_value': p_value.astype(dtype, copy=False),
+            'z_score': z_score.astype(dtype, copy=False)}
@@ -0,0 +1,308 @@
+"""
+Batched construction of first-level design matrices
+
+Runs that share a repetition time and length share a sampling grid, HRF kernel
+and drift basis.
+The design matrices of such runs are built together: event regressors for
+every condition of every run are sampled into the columns of an array, which
+is convolved with the HRF and resampled in vectorized passes over blocks of
+columns of bounded size.
+
+Results follow :func:`nistats.design_matrix.make_first_level_design_matrix`
+with its default parameters, for the ``glover`` and ``spm`` HRF models.
+Alternatively, event regressors may be evaluated directly at acquisition
+times (see :func:`integrate_events`), without an oversampled grid.
+"""
+from collections import OrderedDict
+from functools import lru_cache
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+@lru_cache()
+def hrf_kernel(hrf_model, tr, oversampling=50, time_length=32.):
+    """ Sample an HRF on a grid ``oversampling`` times finer than ``tr``
+
+    Kernels are cached, as runs typically share a handful of repetition times.
+    """
+    from scipy.stats import gamma
+
+    params = {'glover': dict(delay=6, undershoot=12., dispersion=.9,
+                             u_dispersion=.9, ratio=.35),
+              'spm': dict(delay=6, undershoot=16., dispersion=1.,
+                          u_dispersion=1., ratio=0.167)}
+    if hrf_model not in params:
+        raise ValueError("Unsupported HRF model {!r}; use one of {}".format(
+            hrf_model, sorted(params)))
+    p = params[hrf_model]
+
+    dt = tr / oversampling
+    time_stamps = np.linspace(0, time_length, np.rint(float(time_length) / dt).astype(int))
+    hrf = (gamma.pdf(time_stamps, p['delay'] / p['dispersion'], dt / p['dispersion']) -
+           p['ratio'] * gamma.pdf(time_stamps, p['undershoot'] / p['u_dispersion'],
+                                  dt / p['u_dispersion']))
+    hrf /= hrf.sum()
+    hrf.setflags(write=False)
+    return hrf
+
+
+def cosine_drift(high_pass, frame_times):
+    """ Discrete cosine basis below ``high_pass`` Hz, plus a constant regressor """
+    n_frames = len(frame_times)
+    n_times = np.arange(n_frames)
+    dt = (frame_times[-1] - frame_times[0]) / (n_frames - 1)
+    if high_pass * dt >= .5:
+        warnings.warn('High-pass filter will span all accessible frequencies '
+                      'and saturate the design matrix. '
+                      'You may want to reduce the high_pass value.'
+                      'The provided value is {0} Hz'.format(high_pass))
+    order = np.minimum(n_frames - 1, int(np.floor(2 * n_frames * high_pass * dt)))
+    drift = np.zeros((n_frames, order + 1))
+    normalizer = np.sqrt(2.0 / n_frames)
+    for k in range(1, order + 1):
+        drift[:, k - 1] = normalizer * np.cos((np.pi / n_frames) * (n_times + .5) * k)
+    drift[:, -1] = 1.
+    return drift
+
+
+def make_drift(drift_model, frame_times, high_pass=.01):
+    if drift_model == 'cosine':
+        drift = cosine_drift(high_pass, frame_times)
+    elif drift_model is None:
+        drift = np.ones((len(frame_times), 1))
+    else:
+        raise ValueError("Unsupported drift model {!r}".format(drift_model))
+    names = ['drift_%d' % k for k in range(1, drift.shape[1])] + ['constant']
+    return drift, names
+
+
+def _hr_frame_times(frame_times, oversampling, min_onset):
+    n = frame_times.size
+    n_hr = ((n - 1) * 1. / (frame_times.max() - frame_times.min()) *
+            (frame_times.max() * (1 + 1. / (n - 1)) - frame_times.min() - min_onset) *
+            oversampling) + 1
+    return np.linspace(frame_times.min() + min_onset,
+                       frame_times.max() * (1 + 1. / (n - 1)),
+                       np.rint(n_hr).astype(int))
+
+
+def _interpolation_weights(source, target):
+    """ Indices and weights for linear interpolation of ``source`` samples at ``target`` """
+    idx = np.clip(np.searchsorted(source, target, side='right') - 1, 0, len(source) - 2)
+    weights = (target - source[idx]) / (source[idx + 1] - source[idx])
+    return idx, weights[:, np.newaxis]
+
+
+def convolve_events(events, frame_times, hrf_model='glover', oversampling=50, min_onset=-24.,
+                    max_bytes=2 ** 27):
+    """ Convolve the conditions of many runs sharing ``frame_times``
+
+    Parameters
+    ----------
+    events : list of tuples
+        ``(onset, duration, modulation, column)`` arrays for each run, where
+        ``column`` indexes the output column of each event
+    frame_times : array of shape (n_scans,)
+        Acquisition times shared by all runs
+    max_bytes : int
+        Approximate size of the oversampled array of regressors; columns are
+        convolved in blocks that fit within it
+
+    Returns
+    -------
+    regressors : array of shape (n_scans, n_columns)
+        Convolved regressors of all runs, for all columns indexed in ``events``
+    """
+    from scipy.signal import fftconvolve
+
+    hr_frame_times = _hr_frame_times(frame_times, oversampling, float(min_onset))
+    tmax = len(hr_frame_times)
+    n_columns = max((int(column.max()) + 1 for _, _, _, column in events if len(column)),
+                    default=0)
+
+    # Positions of event onsets and offsets on the oversampled grid
+    bins = []
+    for onsets, durations, values, column in events:
+        if (onsets < frame_times[0] + min_onset).any():
+            warnings.warn(('Some stimulus onsets are earlier than %s in the'
+                           ' experiment and are thus not considered in the model'
+                           % (frame_times[0] + min_onset)), UserWarning)
+        t_onset = np.minimum(np.searchsorted(hr_frame_times, onsets), tmax - 1)
+        t_offset = np.minimum(np.searchsorted(hr_frame_times, onsets + durations), tmax - 1)
+        # Handle the case where duration is 0 by offsetting at t + 1
+        t_offset[(t_offset < tmax - 1) & (t_offset == t_onset)] += 1
+        bins.append((t_onset, t_offset, values, column))
+
+    # Runs can be shorter than one repetition; nistats infers the TR the same way
+    tr = float(frame_times.max()) / (np.size(frame_times) - 1)
+    kernel = hrf_kernel(hrf_model, tr, oversampling)
+    idx, weights = _interpolation_weights(hr_frame_times, frame_times)
+
+    output = np.zeros((len(frame_times), n_columns))
+    block_size = max(int(max_bytes // (tmax * 8)), 1)
+    for first in range(0, n_columns, block_size):
+        last = min(first + block_size, n_columns)
+        regressors = np.zeros((tmax, last - first))
+        for t_onset, t_offset, values, column in bins:
+            in_block = (column >= first) & (column < last)
+            block_column = column[in_block] - first
+            for index, sign in ((t_onset[in_block], 1), (t_offset[in_block], -1)):
+                # nistats assigns through fancy indexing, so only the last of several
+                # events of one condition falling in the same bin takes effect
+                _, latest = np.unique((index * (last - first) + block_column)[::-1],
+                                      return_index=True)
+                latest = len(index) - 1 - latest
+                regressors[index[latest], block_column[latest]] += \
+                    sign * values[in_block][latest]
+        np.cumsum(regressors, axis=0, out=regressors)
+        convolved = fftconvolve(regressors, kernel[:, np.newaxis], axes=0)[:tmax]
+        del regressors
+        output[:, first:last] = convolved[idx] * (1 - weights) + convolved[idx + 1] * weights
+    return output
+
+
+def integrate_events(events, frame_times, hrf_model='glover', oversampling=50,
+                     min_onset=-24.):
+    """ Evaluate convolved event regressors of many runs at ``frame_times`` only
+
+    The response to an event of onset ``o``, duration ``d`` and modulation
+    ``a`` is ``a * (G(t - o) - G(t - o - d))``, where ``G`` is the cumulative
+    HRF, so regressors are computed at acquisition times without sampling
+    events on an oversampled grid.
+    Memory use scales with the number of scans rather than
+    ``oversampling`` times the number of scans, and event timing is not
+    rounded to the oversampled grid.
+    Events of zero duration are given a duration of ``tr / oversampling``,
+    events starting more than ``-min_onset`` seconds before the first scan are
+    truncated to start then, and regressors are scaled as by
+    :func:`convolve_events`, which they approximate closely.
+
+    Parameters and return values are as for :func:`convolve_events`.
+    """
+    tr = float(frame_times.max()) / (np.size(frame_times) - 1)
+    dt = tr / oversampling
+    kernel = hrf_kernel(hrf_model, tr, oversampling)
+    support = np.arange(len(kernel)) * dt
+    cumulative = np.cumsum(kernel)
+
+    def response(lag):
+        return np.interp(lag, support, cumulative, left=0., right=cumulative[-1])
+
+    n_scans = len(frame_times)
+    n_columns = max((int(column.max()) + 1 for _, _, _, column in events if len(column)),
+                    default=0)
+    regressors = np.zeros(n_scans * n_columns)
+    for onsets, durations, values, column in events:
+        if (onsets < frame_times[0] + min_onset).any():
+            warnings.warn(('Some stimulus onsets are earlier than %s in the'
+                           ' experiment and are thus not considered in the model'
+                           % (frame_times[0] + min_onset)), UserWarning)
+        # As on the oversampled grid, earlier events start at the first time sampled
+        offsets = onsets + durations
+        onsets = np.maximum(onsets, frame_times[0] + min_onset)
+        durations = np.maximum(offsets - onsets, dt)
+
+        # Pair each event with the scans between its onset and the end of its response
+        start = np.searchsorted(frame_times, onsets)
+        stop = np.searchsorted(frame_times, onsets + durations + support[-1], side='right')
+        counts = stop - start
+        event = np.repeat(np.arange(len(onsets)), counts)
+        scan = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        scan += start[event]
+
+        lag = frame_times[scan] - onsets[event]
+        contrib = values[event] * (response(lag) - response(lag - durations[event]))
+        regressors += np.bincount(scan * n_columns + column[event], weights=contrib,
+                                  minlength=n_scans * n_columns)
+    return regressors.reshape(n_scans, n_columns)
+
+
+def full_rank(X, cmax=1e15):
+    """ Regularize ``X`` to a condition number of at most ``cmax`` """
+    from scipy import linalg
+
+    U, s, V = linalg.svd(X, full_matrices=False)
+    smax, smin = s.max(), s.min()
+    if smax / smin < cmax:
+        return X
+    warnings.warn('Matrix is singular at working precision, regularizing...')
+    lda = (smax - cmax * smin) / (cmax - 1)
+    return np.dot(U, np.dot(np.diag(s + lda), V))
+
+
+def make_design_matrices(runs, hrf_model='glover', high_pass=.01, oversampling=50,
+                         min_onset=-24., tr_grid=False):
+    """ Build the first-level design matrices of many runs
+
+    Parameters
+    ----------
+    runs : list of dicts
+        Each run is described by its ``repetition_time`` and ``n_vols``, and
+        optional ``events`` (a data frame with ``onset``, ``duration``,
+        ``trial_type`` and ``modulation`` columns), ``regressors`` (a data frame
+        of additional regressors) and ``drift_model`` (``'cosine'``, the default,
+        or ``None``).
+    tr_grid : bool
+        Evaluate event regressors at acquisition times only
+        (:func:`integrate_events`), rather than convolving them on a grid
+        ``oversampling`` times finer (:func:`convolve_events`)
+
+    Returns
+    -------
+    design_matrices : list of data frames
+        The design matrix of each run, indexed by frame time
+    """
+    groups = OrderedDict()
+    for ix, run in enumerate(runs):
+        groups.setdefault((float(run['repetition_time']), int(run['n_vols'])), []).append(ix)
+
+    design_matrices = [None] * len(runs)
+    for (tr, n_vols), members in groups.items():
+        frame_times = np.arange(n_vols) * tr
+
+        # Assign a column of the group's regressor array to each condition of each run
+        events = []
+        conditions = {}
+        n_columns = 0
+        for ix in members:
+            run_events = runs[ix].get('events')
+            if run_events is None:
+                continue
+            trial_type = np.asarray(run_events['trial_type'])
+            names, column = np.unique(trial_type, return_inverse=True)
+            conditions[ix] = (names.tolist(), n_columns)
+            events.append((np.asarray(run_events['onset'], dtype=float),
+                           np.asarray(run_events['duration'], dtype=float),
+                           np.asarray(run_events['modulation'], dtype=float),
+                           column.reshape(-1) + n_columns))
+            n_columns += len(names)
+        convolve = integrate_events if tr_grid else convolve_events
+        regressors = convolve(events, frame_times, hrf_model, oversampling, min_onset)
+
+        drifts = {}
+        for ix in members:
+            run = runs[ix]
+            matrices = []
+            names = []
+            if ix in conditions:
+                cond_names, start = conditions[ix]
+                matrices.append(regressors[:, start:start + len(cond_names)])
+                names.extend(cond_names)
+            add_regs = run.get('regressors')
+            if add_regs is not None:
+                matrices.append(np.asarray(add_regs, dtype=float).reshape(n_vols, -1))
+                names.extend(add_regs.columns)
+            drift_model = run.get('drift_model', 'cosine')
+            if drift_model not in drifts:
+                drifts[drift_model] = make_drift(drift_model, frame_times, high_pass)
+            drift, drift_names = drifts[drift_model]
+            matrices.append(drift)
+            names.extend(drift_names)
+
+            if len(set(names)) != len(names):
+                raise ValueError('Design matrix columns do not have unique names')
+            matrix = full_rank(np.hstack(matrices))
+            design_matrices[ix] = pd.DataFrame(matrix, columns=names, index=frame_times)
+    return design_matrices
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from ..glm import compute_contrast, fit_glm, fit_glm_chunks, percent_signal_change
+
+
+def _data(rng, n_timepoints=150, n_voxels=300):
+    X = np.column_stack([rng.randn(n_timepoints, 3), np.ones(n_timepoints)])
+    noise = rng.randn(n_timepoints, n_voxels)
+    # Autocorrelated noise, so voxels are spread over many AR(1) models
+    noise[1:] += rng.uniform(0, .6, n_voxels) * noise[:-1]
+    Y = X @ rng.randn(4, n_voxels) + noise
+    return Y, X
+
+
+def _assert_contrast_equal(maps, contrast):
+    assert maps['effect_size'].shape == contrast.effect_size().shape
+    assert np.allclose(maps['effect_size'], contrast.effect_size())
+    assert np.allclose(maps['effect_variance'], contrast.effect_variance())
+    assert np.allclose(maps['stat'], contrast.stat())
+    assert np.allclose(maps['p_value'], contrast.p_value())
+    assert np.allclose(maps['z_score'], contrast.z_score())
+
+
+@pytest.mark.parametrize('noise_model', ['ols', 'ar1'])
+def test_fit_glm_matches_nistats(noise_model):
+    from nistats.contrasts import compute_contrast as nistats_contrast
+    from nistats.first_level_model import run_glm
+
+    Y, X = _data(np.random.RandomState(0))
+    labels, results = run_glm(Y, X, noise_model=noise_model)
+    fit = fit_glm(Y, X, noise_model=noise_model, block_size=64)
+
+    for label, result in results.items():
+        voxels = labels == label
+        assert np.allclose(fit.beta[:, voxels], result.theta)
+        assert np.allclose(fit.dispersion[voxels], result.dispersion)
+    if noise_model == 'ar1':
+        assert len(fit.rho) > 1
+
+    for con_val, contrast_type in [([1, -1, 0, 0], 't'),
+                                   (np.eye(4)[:3], 'F'),
+                                   ([[0, 1, 0, 0]], 'F')]:
+        maps = compute_contrast(fit, con_val, contrast_type)
+        _assert_contrast_equal(maps, nistats_contrast(labels, results, con_val,
+                                                      contrast_type))
+
+
+def test_fit_glm_chunks():
+    Y, X = _data(np.random.RandomState(2))
+    fit = fit_glm(Y, X)
+    chunks = ((np.arange(start, start + 50), Y[:, start:start + 50])
+              for start in range(0, Y.shape[1], 50))
+    chunked = fit_glm_chunks(chunks, X, Y.shape[1])
+
+    assert np.allclose(chunked.beta, fit.beta)
+    assert np.allclose(chunked.dispersion, fit.dispersion)
+    assert np.allclose(chunked.rho[chunked.labels], fit.rho[fit.labels])
+    for con_val in ([1, 0, 0, 0], np.eye(4)[:2]):
+        expected = compute_contrast(fit, con_val)
+        for key, value in compute_contrast(chunked, con_val).items():
+            assert np.allclose(value, expected[key])
+
+
+@pytest.mark.parametrize('noise_model', ['ols', 'ar1'])
+def test_fit_glm_float32(noise_model):
+    Y, X = _data(np.random.RandomState(3))
+    Y = percent_signal_change(1000 + Y)
+    double = fit_glm(Y, X, noise_model=noise_model)
+    single = fit_glm(Y.astype(np.float32), X, noise_model=noise_model, dtype=np.float32)
+    chunks = ((np.arange(start, start + 100), Y[:, start:start + 100].astype(np.float32))
+              for start in range(0, Y.shape[1], 100))
+    chunked = fit_glm_chunks(chunks, X, Y.shape[1], noise_model=noise_model,
+                             dtype=np.float32)
+
+    for fit in (single, chunked):
+        assert fit.beta.dtype == fit.dispersion.dtype == np.float32
+        assert np.allclose(fit.beta, double.beta, rtol=0, atol=1e-5 * np.abs(double.beta).max())
+        for con_val in ([1, -1, 0, 0], np.eye(4)[:3]):
+            expected = compute_contrast(double, con_val)
+            for key, value in compute_contrast(fit, con_val).items():
+                assert value.dtype == np.float32
+                assert np.abs(value - expected[key]).max() <= 1e-5 * np.abs(expected[key]).max()
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ..hrf import convolve_events, integrate_events, make_design_matrices
+
+
+def _random_events(rng, conditions, n_events, duration):
+    events = pd.DataFrame({
+        'onset': np.sort(rng.uniform(0, duration - 20, n_events)),
+        'duration': rng.choice([0., 1., 2.5], n_events),
+        'trial_type': rng.choice(conditions, n_events),
+        'modulation': rng.uniform(.5, 2, n_events)})
+    return events
+
+
+@pytest.mark.parametrize('hrf_model', ['glover', 'spm'])
+@pytest.mark.parametrize('max_bytes', [1, 2 ** 27])
+def test_convolve_events_matches_nistats(hrf_model, max_bytes):
+    from nistats.hemodynamic_models import compute_regressor
+
+    rng = np.random.RandomState(0)
+    frame_times = np.arange(120) * 2.
+    runs = [_random_events(rng, conditions, 30, 240)
+            for conditions in (['a', 'b'], ['a', 'b', 'c'], ['d'])]
+
+    events = []
+    expected = []
+    n_columns = 0
+    for run in runs:
+        names, column = np.unique(run['trial_type'], return_inverse=True)
+        events.append((run['onset'].to_numpy(), run['duration'].to_numpy(),
+                       run['modulation'].to_numpy(), column + n_columns))
+        n_columns += len(names)
+        for name in names:
+            cond = run[run['trial_type'] == name]
+            regressor, _ = compute_regressor(
+                cond[['onset', 'duration', 'modulation']].to_numpy().T,
+                hrf_model, frame_times)
+            expected.append(regressor[:, 0])
+
+    # Columns are convolved in blocks of a single column with max_bytes=1
+    regressors = convolve_events(events, frame_times, hrf_model, max_bytes=max_bytes)
+    assert regressors.shape == (len(frame_times), n_columns)
+    assert np.allclose(regressors, np.column_stack(expected))
+
+
+def test_make_design_matrices_matches_nistats():
+    from nistats.design_matrix import make_first_level_design_matrix
+
+    rng = np.random.RandomState(1)
+    runs = []
+    for tr, n_vols in ((2., 100), (2., 100), (1.5, 80)):
+        runs.append({'repetition_time': tr,
+                     'n_vols': n_vols,
+                     'events': _random_events(rng, ['a', 'b'], 20, tr * n_vols),
+                     'regressors': pd.DataFrame(rng.randn(n_vols, 2), columns=['x', 'y'])})
+    runs.append({'repetition_time': 2., 'n_vols': 100, 'events': None,
+                 'regressors': None, 'drift_model': None})
+
+    for run, mat in zip(runs, make_design_matrices(runs)):
+        regs = run['regressors']
+        expected = make_first_level_design_matrix(
+            frame_times=np.arange(run['n_vols']) * run['repetition_time'],
+            events=run['events'],
+            add_regs=regs,
+            add_reg_names=None if regs is None else regs.columns.tolist(),
+            drift_model=run.get('drift_model', 'cosine'))
+        assert mat.columns.tolist() == expected.columns.tolist()
+        assert np.allclose(mat.index, expected.index)
+        assert np.allclose(mat.to_numpy(), expected.to_numpy())
+
+
+@pytest.mark.parametrize('hrf_model', ['glover', 'spm'])
+def test_integrate_events_approximates_convolution(hrf_model):
+    rng = np.random.RandomState(2)
+    frame_times = np.arange(100) * 2.
+    runs = [_random_events(rng, ['a', 'b'], 30, 200) for _ in range(2)]
+    # Events starting before the oversampled grid are truncated, not dropped
+    runs.append(pd.DataFrame({'onset': [-40., -30., -26., 10.],
+                              'duration': [0., 20., 4., 1.],
+                              'trial_type': ['c', 'd', 'e', 'f'],
+                              'modulation': 1.}))
+    events = []
+    n_columns = 0
+    for run in runs:
+        names, column = np.unique(run['trial_type'], return_inverse=True)
+        events.append((run['onset'].to_numpy(), run['duration'].to_numpy(),
+                       run['modulation'].to_numpy(), column + n_columns))
+        n_columns += len(names)
+
+    with pytest.warns(UserWarning, match='earlier than -24'):
+        expected = convolve_events(events, frame_times, hrf_model)
+    with pytest.warns(UserWarning, match='earlier than -24'):
+        regressors = integrate_events(events, frame_times, hrf_model)
+    assert regressors.shape == expected.shape
+    assert np.abs(expected[:, -3:-1]).max() > .1
+    # Onsets are not rounded to the oversampled grid
+    assert np.allclose(regressors, expected, atol=.02 * np.abs(expected).max())
+    assert np.allclose(regressors[:, -4:], expected[:, -4:])
+
+
+def test_make_design_matrices_tr_grid():
+    rng = np.random.RandomState(3)
+    runs = [{'repetition_time': tr, 'n_vols': n_vols,
+             'events': _random_events(rng, ['a', 'b'], 20, tr * n_vols),
+             'regressors': pd.DataFrame(rng.randn(n_vols, 2), columns=['x', 'y'])}
+            for tr, n_vols in ((2., 100), (1.5, 80))]
+
+    for mat, expected in zip(make_design_matrices(runs, tr_grid=True),
+                             make_design_matrices(runs)):
+        assert mat.columns.tolist() == expected.columns.tolist()
+        assert np.array_equal(mat.index, expected.index)
+        # Only event regressors differ, by the rounding of onsets to the grid
+        assert np.array_equal(mat.drop(columns=['a', 'b']), expected.drop(columns=['a', 'b']))
+        assert np.allclose(mat, expected, atol=.02 * np.abs(expected[['a', 'b']]).max().max())
@@ -15,10 +15,18 @@ Fetch some test data
 
 """
 import os
+import re
 import json
+import hashlib
 import warnings
+from contextlib import contextmanager
 from bids.layout import BIDSLayout
 
+MANIFEST_FILENAME = 'fitlins_manifest.json'
+MANIFEST_VERSION = 2
+# Versions of pybids whose index internals are used to update indexes in place
+INCREMENTAL_PYBIDS_VERSIONS = ('0.10',)
+
 
 class BIDSError(ValueError):
     def __init__(self, message, bids_root):
@@ -37,12 +45,565 @@ class BIDSWarning(RuntimeWarning):
     pass
 
 
+def compile_patterns(patterns):
+    """Prepare ``--ignore``/``--force-index`` patterns for :class:`BIDSLayout`
+
+    Entries that look like ``/<pattern>/`` are compiled into regular
+    expressions; other entries are passed through as strings.
+
+    >>> compile_patterns(None)
+    >>> compile_patterns('code')
+    ['code']
+    >>> compile_patterns(['code', '/.*_echo-2_.*/'])
+    ['code', re.compile('.*_echo-2_.*')]
+    """
+    if not patterns:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return [re.compile(patt[1:-1])
+            if isinstance(patt, str) and (patt[0], patt[-1]) == ('/', '/') else patt
+            for patt in patterns]
+
+
+def format_patterns(patterns):
+    """Inverse of :func:`compile_patterns`, for interface inputs that take strings
+
+    >>> format_patterns(None)
+    >>> format_patterns(['code', re.compile('.*_echo-2_.*')])
+    ['code', '/.*_echo-2_.*/']
+    >>> compile_patterns(format_patterns(['code', re.compile('.*_echo-2_.*')]))
+    ['code', re.compile('.*_echo-2_.*')]
+    """
+    if patterns is None:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return ['/{}/'.format(patt.pattern) if hasattr(patt, 'pattern') else patt
+            for patt in patterns]
+
+
+def add_selector_patterns(ignore, bids_dir, derivatives=None, participants=None,
+                          space=None, desc=None):
+    """
+    Extend ``ignore`` patterns to skip files that cannot match query selectors
+
+    Subject directories of participants that were not requested are excluded
+    from the BIDS root and each derivatives root, as are files in spaces other
+    than ``space`` and BOLD series with descriptions other than ``desc``.
+    Files without ``space`` or ``desc`` entities, such as confounds, are
+    unaffected.
+
+    >>> patterns = add_selector_patterns(None, '/data', participants=['sub-01'],
+    ...                                  space='MNI152NLin2009cAsym', desc='preproc')
+    >>> def ignored(path):
+    ...     return any(patt.search(path) for patt in patterns if not isinstance(patt, str))
+    >>> ignored('/data/sub-01/func/sub-01_task-a_bold.nii.gz')
+    False
+    >>> ignored('/data/sub-010')
+    True
+    >>> ignored('/data/sub-01/func/sub-01_task-a_space-T1w_desc-preproc_bold.nii.gz')
+    True
+    >>> ignored('/data/sub-01/func/sub-01_space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz')
+    False
+    >>> ignored('/data/sub-01/func/sub-01_space-MNI152NLin2009cAsym_desc-smooth_bold.nii.gz')
+    True
+    >>> ignored('/data/sub-01/func/sub-01_task-a_desc-confounds_regressors.tsv')
+    False
+    """
+    patterns = []
+    if participants:
+        labels = sorted(re.escape(sub[4:] if sub.startswith('sub-') else sub)
+                        for sub in participants)
+        roots = [os.path.abspath(bids_dir)] + _derivative_roots(bids_dir, derivatives)
+        # Subject directories (and files, such as reports) immediately below a root
+        patterns.append(re.compile(r'^(?:{})/sub-(?!(?:{})(?:[/_.]|$))'.format(
+            '|'.join(re.escape(root) for root in roots), '|'.join(labels))))
+    if space:
+        patterns.append(re.compile(
+            r'_space-(?!{}_)[a-zA-Z0-9]+_[^/]*$'.format(re.escape(space))))
+    if desc:
+        patterns.append(re.compile(
+            r'_desc-(?!{}_)[a-zA-Z0-9]+_bold\.[^/]*$'.format(re.escape(desc))))
+
+    if not patterns:
+        return ignore
+    ignore = compile_patterns(ignore)
+    if ignore is None:
+        ignore = list(BIDSLayout._default_ignore)
+    return ignore + patterns
+
+
+def _derivative_roots(bids_dir, derivatives):
+    """ Derivative dataset roots, as discovered by :class:`BIDSLayout` """
+    if derivatives is True:
+        derivatives = [os.path.join(bids_dir, 'derivatives')]
+    elif not derivatives:
+        return []
+    elif isinstance(derivatives, str):
+        derivatives = [derivatives]
+
+    def has_description(path):
+        return os.path.exists(os.path.join(path, 'dataset_description.json'))
+
+    roots = []
+    for path in derivatives:
+        path = os.path.abspath(path)
+        if has_description(path):
+            roots.append(path)
+        elif os.path.isdir(path):
+            roots.extend(os.path.join(path, subdir) for subdir in sorted(os.listdir(path))
+                         if has_description(os.path.join(path, subdir)))
+    return roots
+
+
+def layout_cache_path(cache_dir, bids_dir, derivatives=None, ignore=None,
+                      force_index=None):
+    """
+    Select a persistent index directory for a dataset and its indexing options
+
+    Each combination of BIDS root, derivatives and ``--ignore``/``--force-index``
+    patterns is given its own subdirectory of ``cache_dir``, so that indexes
+    built with different options are never confused with one another.
+    """
+    if isinstance(derivatives, (list, tuple)):
+        derivatives = sorted(os.path.abspath(deriv) for deriv in derivatives)
+    key = json.dumps([os.path.abspath(bids_dir), derivatives,
+                      ignore, force_index], default=str)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def init_layout(bids_dir, derivatives=None, ignore=None, force_index=None,
+                database_path=None, n_workers=1):
+    """
+    Index a BIDS dataset and its derivatives a single time
+
+    If ``database_path`` is provided, the index is persisted there, and all
+    consumers within a FitLins run can open the same snapshot with
+    ``BIDSLayout.load(database_path)`` instead of re-walking the dataset.
+
+    A manifest of file modification times and sizes is saved alongside the index.
+    If a previous index is found at ``database_path``, every file is ``stat``-ed
+    again, and only the rows of files that have been added, removed or modified
+    (including files rewritten in place) are updated.
+
+    The manifest is collected by ``n_workers`` threads, and a new index is built
+    from the files it lists rather than by the serial walk of :class:`BIDSLayout`.
+    On network storage, ``stat``/``scandir`` latency dominates a cold index, so
+    the dataset is only walked once, concurrently.
+
+    Updates and the threaded scan rely on the internals of pybids 0.10
+    (see ``INCREMENTAL_PYBIDS_VERSIONS``). With other versions of pybids, the
+    index is rebuilt by :class:`BIDSLayout` at every call.
+    """
+    ignore = compile_patterns(ignore)
+    force_index = compile_patterns(force_index)
+
+    if database_path is None:
+        return BIDSLayout(bids_dir, derivatives=derivatives,
+                          ignore=ignore, force_index=force_index)
+
+    manifest_file = os.path.join(database_path, MANIFEST_FILENAME)
+    if not _incremental_indexing():
+        # A manifest cannot describe an index this version of pybids built
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        return BIDSLayout(bids_dir, derivatives=derivatives,
+                          ignore=ignore, force_index=force_index,
+                          database_path=database_path, reset_database=True)
+
+    previous = {}
+    if os.path.exists(manifest_file) and os.path.exists(
+            os.path.join(database_path, 'layout_index.sqlite')):
+        with open(manifest_file) as fobj:
+            previous = json.load(fobj)
+    if previous.get('version') != MANIFEST_VERSION:
+        previous = {'roots': {}}
+
+    roots = [os.path.abspath(bids_dir)] + _derivative_roots(bids_dir, derivatives)
+    manifest = {'version': MANIFEST_VERSION, 'roots': {}}
+    for root in roots:
+        manifest['roots'][root] = _scan_tree(
+            root,
+            exclude=_root_patterns(root, BIDSLayout._default_ignore
+                                   if ignore is None else ignore),
+            include=_root_patterns(root, force_index or []),
+            n_workers=n_workers)
+
+    if previous['roots']:
+        layout = BIDSLayout.load(database_path)
+        for sublayout in [layout] + list(layout.derivatives.values()):
+            # Regular expressions do not survive the round trip through the index
+            # sidecar, so restore the patterns that were used to build the index
+            sublayout.ignore = _root_patterns(
+                sublayout.root, sublayout._default_ignore if ignore is None else ignore)
+            sublayout.force_index = _root_patterns(sublayout.root, force_index or [])
+
+            old_tree = previous['roots'].get(sublayout.root)
+            new_tree = manifest['roots'].get(sublayout.root)
+            if old_tree is not None and new_tree is not None:
+                _update_index(sublayout, *_diff_trees(sublayout.root, old_tree, new_tree))
+    else:
+        with _index_listed_files(manifest['roots']):
+            layout = BIDSLayout(bids_dir, derivatives=derivatives,
+                                ignore=ignore, force_index=force_index,
+                                database_path=database_path, reset_database=True)
+
+    with open(manifest_file, 'w') as fobj:
+        json.dump(manifest, fobj)
+
+    return layout
+
+
+def _incremental_indexing():
+    """ Whether the installed pybids index can be updated in place """
+    from bids import __version__
+    return '.'.join(__version__.split('.')[:2]) in INCREMENTAL_PYBIDS_VERSIONS
+
+
+def _root_patterns(root, patterns):
+    """ Anchor string patterns at ``root``, as done by :class:`BIDSLayout` """
+    return [os.path.abspath(os.path.join(root, patt)) if isinstance(patt, str) else patt
+            for patt in patterns]
+
+
+def _scan_tree(root, exclude=(), include=(), n_workers=1):
+    """
+    Record the modification times and sizes of all files below ``root``
+
+    Every file is ``stat``-ed on every scan: directory modification times do not
+    change when a file is rewritten in place, so they cannot be used to skip
+    directories. The subtrees below ``root`` (typically ``sub-*`` directories)
+    are scanned concurrently by ``n_workers`` threads.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    rel, files, subdirs = _scan_dir(root, root, exclude, include)
+    tree = {rel: files}
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as pool:
+        for subtree in pool.map(
+                lambda subdir: _scan_subtree(subdir, root, exclude, include), subdirs):
+            tree.update(subtree)
+    return tree
+
+
+def _scan_subtree(top, root, exclude, include):
+    subtree = {}
+    pending = [top]
+    while pending:
+        rel, files, subdirs = _scan_dir(pending.pop(), root, exclude, include)
+        subtree[rel] = files
+        pending.extend(subdirs)
+    return subtree
+
+
+def _scan_dir(dirpath, root, exclude, include):
+    from bids.layout.index import _check_path_matches_patterns
+    rel = os.path.relpath(dirpath, root)
+    files = {}
+    subdirs = []
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                # Derivatives are indexed as separate layouts
+                if entry.path.startswith(os.path.join(root, 'derivatives')):
+                    continue
+                # Files may be forced into the index from excluded directories
+                if (_check_path_matches_patterns(entry.path, exclude) and not include):
+                    continue
+                subdirs.append(entry.path)
+            else:
+                stat = entry.stat()
+                files[entry.name] = [stat.st_mtime_ns, stat.st_size]
+    return rel, files, subdirs
+
+
+def _diff_trees(root, old_tree, new_tree):
+    """ Find files that have been added to or removed from a tree
+
+    Modified files are reported as both removed and added.
+    """
+    added, removed = [], []
+    for rel in old_tree.keys() | new_tree.keys():
+        old, new = old_tree.get(rel, {}), new_tree.get(rel, {})
+        dirpath = os.path.normpath(os.path.join(root, rel))
+        for fname, stat in new.items():
+            if old.get(fname) != stat:
+                added.append(os.path.join(dirpath, fname))
+                if fname in old:
+                    removed.append(os.path.join(dirpath, fname))
+        removed.extend(os.path.join(dirpath, fname) for fname in old.keys() - new.keys())
+    return added, removed
+
+
+@contextmanager
+def _index_listed_files(trees):
+    """ Have :class:`BIDSLayout` index the files listed by :func:`_scan_tree`
+
+    Within this context, layouts whose roots are keys of ``trees`` take their
+    files from those listings instead of walking their directories.
+    This replaces a method of the pybids 0.10 indexer, and is not thread-safe.
+    """
+    from bids.layout.index import BIDSLayoutIndexer
+    walk = BIDSLayoutIndexer.index_files
+
+    def index_files(indexer):
+        if indexer.root not in trees:
+            return walk(indexer)
+        entities = {}
+        for config in indexer.layout.config.values():
+            entities.update(config.entities)
+        for rel, files in sorted(trees[indexer.root].items()):
+            dirpath = os.path.normpath(os.path.join(indexer.root, rel))
+            default = _inherited_action(indexer, indexer.root, dirpath)
+            for fname in sorted(files):
+                if fname != indexer.config_filename:
+                    indexer._index_file(fname, dirpath, entities, default_action=default)
+        indexer.session.commit()
+
+    BIDSLayoutIndexer.index_files = index_files
+    try:
+        yield
+    finally:
+        BIDSLayoutIndexer.index_files = walk
+
+
+def _update_index(layout, added, removed):
+    """ Update the rows of a persisted layout index for changed files
+
+    File entities are only (re-)extracted for ``added`` files.
+    Metadata is inherited across directories from JSON sidecars, so if any
+    sidecar has changed, metadata is re-indexed for the whole layout.
+    Otherwise, it is only indexed for the added files.
+
+    These updates rely on the index schema of pybids 0.10.
+    """
+    from bids.layout.index import BIDSLayoutIndexer
+    from bids.layout.models import BIDSFile, Entity, FileAssociation, Tag
+
+    if not (added or removed):
+        return
+
+    session = layout.session
+    index_metadata = layout._init_args.get('index_metadata', True)
+    rebuild = any(path.endswith('.json') for path in set(added) | set(removed))
+    # Clear added files as well, in case they were indexed after the manifest was taken
+    # Stay well below SQLite's limit of 999 bound parameters per query
+    for chunk in _chunks(set(removed) | set(added), 400):
+        session.query(Tag).filter(Tag.file_path.in_(chunk)).delete(
+            synchronize_session=False)
+        session.query(FileAssociation).filter(
+            FileAssociation.src.in_(chunk) | FileAssociation.dst.in_(chunk)).delete(
+            synchronize_session=False)
+        session.query(BIDSFile).filter(BIDSFile.path.in_(chunk)).delete(
+            synchronize_session=False)
+
+    if index_metadata and rebuild:
+        # Metadata will be regenerated from scratch
+        metadata_entities = session.query(Entity).filter_by(is_metadata=True)
+        for chunk in _chunks([ent.name for ent in metadata_entities], 400):
+            session.query(Tag).filter(Tag.entity_name.in_(chunk)).delete(
+                synchronize_session=False)
+        metadata_entities.delete(synchronize_session=False)
+        session.query(FileAssociation).delete(synchronize_session=False)
+    session.commit()
+
+    indexer = BIDSLayoutIndexer(layout)
+    entities = {}
+    for config in layout.config.values():
+        entities.update(config.entities)
+    defaults = {}
+    for path in sorted(added):
+        dirpath, fname = os.path.split(path)
+        if dirpath not in defaults:
+            defaults[dirpath] = _inherited_action(indexer, layout.root, dirpath)
+        indexer._index_file(fname, dirpath, entities, default_action=defaults[dirpath])
+    session.commit()
+
+    if not index_metadata:
+        return
+    if rebuild:
+        # As when the layout was built, before any derivatives were added to it
+        derivatives, layout.derivatives = layout.derivatives, {}
+        try:
+            indexer.index_metadata()
+        finally:
+            layout.derivatives = derivatives
+    else:
+        _index_added_metadata(layout, added)
+
+
+# Files linked to the BOLD or DWI runs they share entities with
+_LINKED_SUFFIXES = {'bold': ['physio', 'stim', 'events', 'sbref'], 'dwi': ['sbref']}
+_LINKED_EXTENSIONS = {'dwi': ['bvec', 'bval']}
+
+
+def _index_added_metadata(layout, added):
+    """ Index the metadata and associations of files added to a layout
+
+    This follows :meth:`bids.layout.index.BIDSLayoutIndexer.index_metadata`,
+    for an index in which the metadata of all other files is current.
+    """
+    from collections import defaultdict
+    from bids.layout.models import BIDSFile, Entity, FileAssociation, Tag
+    from bids.utils import listify
+
+    session = layout.session
+    added = [bf for chunk in _chunks(added, 400)
+             for bf in session.query(BIDSFile).filter(BIDSFile.path.in_(chunk))]
+    if not added:
+        return
+
+    metadata_entities = {ent.name: ent for ent in session.query(Entity)}
+
+    def split(bf):
+        """ Suffix, extension and other entities in the name of a file """
+        ents = {name: val for name, val in bf.entities.items()
+                if not metadata_entities[name].is_metadata}
+        return ents.pop('suffix', None), ents.pop('extension', None), ents
+
+    def consumed(ents, file_ents):
+        return all(key in file_ents and file_ents[key] == val for key, val in ents.items())
+
+    # Files by directory, suffix and extension
+    files = defaultdict(list)
+    sidecars = {}
+    for bf in layout.get(scope='self', return_type='object'):
+        suffix, ext, ents = split(bf)
+        files[bf.dirname, suffix, ext].append((ents, bf.path))
+        if ext == 'json':
+            with open(bf.path) as fobj:
+                sidecars[bf.path] = json.load(fobj)
+
+    def find(suffixes=None, extensions=None, dirname=None):
+        return [(ents, path) for (dname, suffix, ext), found in files.items()
+                if (dirname is None or dname == dirname) and
+                (suffixes is None or suffix in suffixes) and
+                (extensions is None or ext in extensions)
+                for ents, path in found]
+
+    associations = set()
+
+    def associate(src, dst, kind, kind2=None):
+        for pair in ((src, dst, kind), (dst, src, kind2 or kind)):
+            if pair not in associations:
+                associations.add(pair)
+                session.merge(FileAssociation(src=pair[0], dst=pair[1], kind=pair[2]))
+
+    # Files associated with their sidecars
+    with_metadata = {assoc.dst for assoc in
+                     session.query(FileAssociation).filter_by(kind='Metadata')
+                     if assoc.src.endswith('.json')}
+    for bf in added:
+        suffix, ext, file_ents = split(bf)
+        if suffix is None or ext is None:
+            continue
+
+        # Sidecars and files of the same type this file inherits from
+        payloads = []
+        ancestors = []
+        dirname = bf.dirname
+        while True:
+            payloads.extend(path for ents, path in find([suffix], ['json'], dirname)
+                            if consumed(ents, file_ents))
+            ancestors.extend(path for ents, path in find([suffix], [ext], dirname)
+                             if consumed(ents, file_ents))
+            parent = os.path.dirname(dirname)
+            if parent == dirname:
+                break
+            dirname = parent
+
+        # Files linked to a run may have been indexed before it
+        for run_suffix, linked in _LINKED_SUFFIXES.items():
+            if suffix == run_suffix and ext in ('nii', 'nii.gz'):
+                for ents, path in find(linked) + find(
+                        extensions=_LINKED_EXTENSIONS.get(run_suffix, [])):
+                    if path in with_metadata and consumed(ents, bf.entities):
+                        associate(path, bf.path, 'IntendedFor', 'InformedBy')
+
+        # Only files with metadata are associated, as by pybids
+        if not payloads:
+            continue
+        with_metadata.add(bf.path)
+        associate(payloads[-1], bf.path, 'Metadata')
+        for child, parent in zip(payloads, payloads[1:]):
+            associate(child, parent, 'Child', 'Parent')
+        for src, dst in zip(ancestors, ancestors[1:]):
+            associate(src, dst, 'Child', 'Parent')
+        for run_suffix, linked in _LINKED_SUFFIXES.items():
+            if suffix in linked or ext in _LINKED_EXTENSIONS.get(run_suffix, []):
+                for ents, img in find([run_suffix], ['nii', 'nii.gz']):
+                    if consumed(file_ents, ents):
+                        associate(bf.path, img, 'IntendedFor', 'InformedBy')
+
+        file_md = {}
+        for path in payloads[::-1]:
+            file_md.update(sidecars[path])
+        for target in listify(file_md.get('IntendedFor', [])):
+            # Per spec, IntendedFor paths are relative to sub dir.
+            target = os.path.join(layout.root, 'sub-{}'.format(file_ents['subject']), target)
+            associate(bf.path, target, 'IntendedFor', 'InformedBy')
+
+        for key, val in file_md.items():
+            if key in bf.entities:
+                if str(val) != str(bf.entities[key]):
+                    raise ValueError(
+                        "Conflicting values found for entity '{}' in filename {} "
+                        "(value='{}') versus its JSON sidecar (value='{}'). Please "
+                        "reconcile this discrepancy.".format(key, bf.path,
+                                                             bf.entities[key], val))
+                continue
+            if key not in metadata_entities:
+                metadata_entities[key] = Entity(key, is_metadata=True)
+                session.add(metadata_entities[key])
+            session.add(Tag(bf, metadata_entities[key], val))
+    session.commit()
+
+
+def _inherited_action(indexer, root, dirpath):
+    """ Inclusion/exclusion directive a directory inherits from its ancestors """
+    default = indexer._validate_dir(root)
+    path = root
+    for part in os.path.relpath(dirpath, root).split(os.sep):
+        if part == '.':
+            continue
+        path = os.path.join(path, part)
+        default = indexer._validate_dir(path, default=default)
+    return default
+
+
+def _chunks(seq, size):
+    seq = list(seq)
+    return [seq[i:i + size] for i in range(0, len(seq), size)]
+
+
+def get_file_entities(layout, paths, metadata=False):
+    """ Retrieve the entities of many files at once
+
+    Equivalent to ``{path: layout.files[path].get_entities(metadata) for path in paths}``,
+    but tags are fetched in batches rather than with one query per file.
+    """
+    from bids.layout.models import Entity, Tag
+
+    paths = list(paths)
+    file_ents = {path: {} for path in paths}
+    for sublayout in layout._get_layouts_in_scope('all'):
+        for chunk in _chunks(paths, 400):
+            tags = (sublayout.session.query(Tag).join(Entity)
+                    .filter(Tag.file_path.in_(chunk)))
+            if metadata is not None:
+                tags = tags.filter(Entity.is_metadata.is_(metadata))
+            for tag in tags:
+                file_ents[tag.file_path][tag.entity_name] = tag.value
+    return file_ents
+
+
 def collect_participants(bids_dir, participant_label=None, strict=False):
     """
     List the participants under the BIDS root and checks that participants
     designated with the participant_label argument exist in that folder.
 
     Returns the list of participants to be finally processed.
+    ``bids_dir`` may be a path or an already-indexed :class:`BIDSLayout`.
 
     Requesting all subjects in a BIDS directory root:
 
@@ -72,7 +633,11 @@ def collect_participants(bids_dir, participant_label=None, strict=False):
 
 
     """
-    layout = BIDSLayout(bids_dir)
+    if isinstance(bids_dir, BIDSLayout):
+        layout = bids_dir
+        bids_dir = layout.root
+    else:
+        layout = BIDSLayout(bids_dir)
     all_participants = layout.get_subjects()
 
     # Error: bids_dir does not contain subjects
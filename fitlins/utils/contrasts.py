@@ -0,0 +1,136 @@
+"""
+Compiled contrasts
+^^^^^^^^^^^^^^^^^^
+
+A contrast specification (see :class:`~fitlins.interfaces.bids.LoadBIDSModel`)
+maps condition names to weights, one dictionary per row of the contrast.
+:class:`CompiledContrasts` holds a set of such contrasts as a single weight
+matrix over the conditions they refer to, which is mapped onto the columns of a
+design matrix with a single index lookup.
+
+Runs generally share a handful of contrast sets, so compiled contrasts are saved
+once per set in a NumPy archive, keyed by :func:`contrast_key`::
+
+    keys                  contrast set keys
+    <key>/names           contrast names
+    <key>/types           contrast types ('t' or 'F')
+    <key>/conditions      conditions referred to by any contrast
+    <key>/weights         weight matrix, one row per contrast row
+    <key>/rows            offsets of the rows of each contrast
+"""
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+
+def contrast_key(contrasts):
+    """ Hash the names, types and weights of a list of contrasts """
+    key = json.dumps([[con['name'], con['type'], con['weights']] for con in contrasts],
+                     sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+class CompiledContrasts(object):
+    """ A set of contrasts, as a weight matrix over the conditions they refer to
+
+    >>> compiled = CompiledContrasts.from_contrast_info([
+    ...     {'name': 'a', 'type': 't', 'weights': [{'a': 1}]},
+    ...     {'name': 'a-b', 'type': 't', 'weights': [{'a': 1, 'b': -1}]},
+    ...     {'name': 'ac', 'type': 'F', 'weights': [{'a': 1}, {'c': 1}]}])
+    >>> [(name, weights.tolist(), stat)
+    ...  for name, weights, stat in compiled.weights_for(['b', 'a', 'constant'])]
+    [('a', [[0.0, 1.0, 0.0]], 't'), ('a-b', [[-1.0, 1.0, 0.0]], 't')]
+    >>> compiled.matrix(['b', 'a', 'constant'])
+                a  a-b   ac
+    b         0.0 -1.0  0.0
+    a         1.0  1.0  1.0
+    constant  0.0  0.0  0.0
+    """
+    def __init__(self, names, types, conditions, weights, rows):
+        self.names = list(names)
+        self.types = list(types)
+        self.conditions = pd.Index(conditions)
+        self.rows = np.asarray(rows, dtype=int)
+        self.weights = np.asarray(weights, dtype=float).reshape(
+            self.rows[-1], len(self.conditions))
+
+    @classmethod
+    def from_contrast_info(cls, contrasts):
+        conditions = list(dict.fromkeys(cond for con in contrasts
+                                        for row in con['weights'] for cond in row))
+        weights = [[row.get(cond, 0) for cond in conditions]
+                   for con in contrasts for row in con['weights']]
+        rows = np.cumsum([0] + [len(con['weights']) for con in contrasts])
+        return cls([con['name'] for con in contrasts], [con['type'] for con in contrasts],
+                   conditions, weights, rows)
+
+    def _expand(self, columns):
+        index = pd.Index(columns).get_indexer(self.conditions)
+        present = index >= 0
+        full = np.zeros((len(self.weights), len(columns)))
+        full[:, index[present]] = self.weights[:, present]
+        # Rows that weight conditions missing from the design cannot be estimated
+        estimable = ~(self.weights[:, ~present] != 0).any(axis=1)
+        return full, estimable
+
+    def weights_for(self, columns):
+        """ List ``(name, weights, type)`` of the contrasts estimable from ``columns``
+
+        Weights are arrays with one column per design matrix column.
+        Contrasts with non-zero weights for conditions absent from ``columns``
+        are omitted.
+        """
+        full, estimable = self._expand(columns)
+        return [(name, full[start:stop], stat)
+                for name, stat, start, stop in zip(self.names, self.types,
+                                                   self.rows[:-1], self.rows[1:])
+                if estimable[start:stop].all()]
+
+    def matrix(self, columns):
+        """ Weights of the first row of each contrast, indexed by ``columns`` """
+        full, _ = self._expand(columns)
+        return pd.DataFrame(full[self.rows[:-1]].T, index=list(columns),
+                            columns=self.names)
+
+
+def save_contrast_store(fname, compiled):
+    """ Save ``{key: CompiledContrasts}`` to ``fname`` """
+    arrays = {'keys': np.array(list(compiled), dtype=str)}
+    for key, contrasts in compiled.items():
+        arrays['{}/names'.format(key)] = np.array(contrasts.names, dtype=str)
+        arrays['{}/types'.format(key)] = np.array(contrasts.types, dtype=str)
+        arrays['{}/conditions'.format(key)] = np.array(contrasts.conditions, dtype=str)
+        arrays['{}/weights'.format(key)] = contrasts.weights
+        arrays['{}/rows'.format(key)] = contrasts.rows
+    with open(fname, 'wb') as fobj:
+        np.savez(fobj, **arrays)
+
+
+def load_contrasts(fname, key):
+    """ Load the compiled contrasts saved under ``key`` """
+    with np.load(fname) as store:
+        return CompiledContrasts(*(store['{}/{}'.format(key, field)]
+                                   for field in ('names', 'types', 'conditions',
+                                                 'weights', 'rows')))
+
+
+def load_run_contrasts(info, contrasts):
+    """ Load the compiled contrasts of a run
+
+    ``info`` is a ``design_info`` entry produced by
+    :class:`~fitlins.interfaces.bids.LoadBIDSModel`, referring to compiled
+    contrasts if available; otherwise, ``contrasts`` are compiled.
+    """
+    if 'contrast_store' in info:
+        return load_contrasts(info['contrast_store'], info['contrast_key'])
+    return CompiledContrasts.from_contrast_info(contrasts)
+
+
+def run_contrasts(info, contrasts, columns):
+    """ List ``(name, weights, type)`` of the contrasts of a run estimable from ``columns``
+
+    Contrasts are loaded or compiled by :func:`load_run_contrasts`.
+    """
+    return load_run_contrasts(info, contrasts).weights_for(columns)
@@ -0,0 +1,222 @@
+"""
+Design stores
+^^^^^^^^^^^^^
+
+The sparse events and dense regressors of all runs at one level of a model are
+saved together in a single uncompressed NumPy archive, with one array per
+column (or per regressor matrix), keyed by a run identifier::
+
+    runs                      run keys
+    <run>/sparse/<column>     onset, duration, condition and amplitude of events
+    <run>/dense/values        regressors, one column per regressor
+    <run>/dense/columns       regressor names
+
+The archive is written uncompressed, so each member is a ``.npy`` file stored
+as is; members are memory-mapped in place when accessed (see
+:class:`DesignStore`), rather than read into memory, and loading the design of
+one run does not require reading those of the others. Data frames built from
+these arrays may still copy them. Opening a store reads the index of all of its
+members, however, so interfaces handling several runs open each store once
+(see :func:`open_design_stores`), and pass the opened store to the loaders.
+
+Design matrices are passed between interfaces as NumPy archives as well
+(see :func:`save_design_matrix`), preserving full precision; TSV files are
+only written for the published derivatives.
+"""
+import struct
+import zipfile
+from contextlib import ExitStack, contextmanager
+
+import numpy as np
+import pandas as pd
+
+SPARSE_COLUMNS = ('onset', 'duration', 'condition', 'amplitude')
+
+
+def save_design_store(fname, designs):
+    """ Save ``{run: (sparse, dense)}`` data frames to ``fname``
+
+    Either data frame may be ``None``.
+    """
+    arrays = {'runs': np.array(list(designs), dtype=str)}
+    for run, (sparse, dense) in designs.items():
+        if sparse is not None:
+            for column in SPARSE_COLUMNS:
+                dtype = str if column == 'condition' else float
+                arrays['{}/sparse/{}'.format(run, column)] = sparse[column].to_numpy(dtype=dtype)
+        if dense is not None:
+            arrays['{}/dense/values'.format(run)] = dense.to_numpy(dtype=float)
+            arrays['{}/dense/columns'.format(run)] = np.array(dense.columns, dtype=str)
+    with open(fname, 'wb') as fobj:
+        np.savez(fobj, **arrays)
+
+
+class DesignStore(object):
+    """ An opened design store, whose arrays are memory-mapped from the archive
+
+    Arrays are accessed by key, as with :func:`numpy.load`, and are read-only
+    :class:`numpy.memmap` views of the archive, except for empty arrays and
+    members that were compressed, which are read into memory.
+    """
+    def __init__(self, fname):
+        self.fname = str(fname)
+        with zipfile.ZipFile(self.fname) as archive:
+            self._members = {info.filename[:-len('.npy')]: info
+                             for info in archive.infolist()}
+        self.closed = False
+
+    def __contains__(self, key):
+        return key in self._members
+
+    def __getitem__(self, key):
+        if self.closed:
+            raise ValueError("Design store {} is closed".format(self.fname))
+        info = self._members[key]
+        if info.compress_type != zipfile.ZIP_STORED:
+            return self._read(key)
+        with open(self.fname, 'rb') as fobj:
+            # Skip the local file header, whose variable-length fields may differ
+            # from those of the central directory
+            fobj.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', fobj.read(30)[26:])
+            fobj.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(fobj)
+            read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                           else np.lib.format.read_array_header_2_0)
+            shape, fortran_order, dtype = read_header(fobj)
+            offset = fobj.tell()
+        if not shape or 0 in shape:
+            # Memory maps cannot be empty
+            return self._read(key)
+        return np.memmap(self.fname, dtype=dtype, mode='r', offset=offset, shape=shape,
+                         order='F' if fortran_order else 'C')
+
+    def _read(self, key):
+        with np.load(self.fname) as archive:
+            return archive[key]
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@contextmanager
+def open_design_stores(infos):
+    """ Open the design stores referred to by ``design_info`` entries, once each
+
+    Yields a dictionary of opened stores (see :class:`DesignStore`), keyed by
+    file name, which may be passed to :func:`load_sparse`, :func:`load_dense` and
+    :func:`load_run_design`.
+    """
+    with ExitStack() as stack:
+        yield {fname: stack.enter_context(DesignStore(fname))
+               for fname in dict.fromkeys(info['design_store'] for info in infos)}
+
+
+@contextmanager
+def _opened(store):
+    """ Open ``store``, unless it is already open """
+    if isinstance(store, DesignStore):
+        yield store
+    else:
+        with DesignStore(store) as opened:
+            yield opened
+
+
+def load_sparse(store, run):
+    """ Load the sparse events of ``run``, or ``None`` if there are none
+
+    ``store`` is a file name or an opened store.
+    """
+    with _opened(store) as store:
+        if '{}/sparse/onset'.format(run) not in store:
+            return None
+        return pd.DataFrame({column: store['{}/sparse/{}'.format(run, column)]
+                             for column in SPARSE_COLUMNS})
+
+
+def load_dense(store, run):
+    """ Load the dense regressors of ``run``, or ``None`` if there are none
+
+    ``store`` is a file name or an opened store.
+    """
+    with _opened(store) as store:
+        if '{}/dense/values'.format(run) not in store:
+            return None
+        return pd.DataFrame(store['{}/dense/values'.format(run)],
+                            columns=store['{}/dense/columns'.format(run)])
+
+
+def load_run_design(info, drop_missing=False, store=None):
+    """ Prepare the events, regressors and drift model of a run for design matrix construction
+
+    ``info`` is a ``design_info`` entry produced by
+    :class:`~fitlins.interfaces.bids.LoadBIDSModel`.
+    Its design store is opened once, unless an opened ``store`` is passed
+    (see :func:`open_design_stores`).
+    Events are returned with nistats column names, and regressors as ``None`` if
+    there are none.
+    """
+    with _opened(info['design_store'] if store is None else store) as store:
+        sparse = load_sparse(store, info['run'])
+        dense = load_dense(store, info['run'])
+    return prepare_run_design(sparse, dense, drop_missing)
+
+
+def prepare_run_design(sparse, dense, drop_missing=False):
+    """ Prepare events and regressors, as loaded from a design store, as by
+    :func:`load_run_design` """
+    if sparse is not None:
+        sparse = sparse.rename(
+            columns={'condition': 'trial_type',
+                     'amplitude': 'modulation'})
+        sparse = sparse.dropna(subset=['modulation'])  # Drop NAs
+
+    drift_model = 'cosine'
+    if dense is not None:
+        missing_columns = dense.isna().all()
+        if drop_missing:
+            # Remove columns with NaNs
+            dense = dense[dense.columns[~missing_columns]]
+        elif missing_columns.any():
+            missing_names = ', '.join(
+                dense.columns[missing_columns].tolist())
+            raise RuntimeError(
+                f'The following columns are empty: {missing_names}. '
+                'Use --drop-missing to drop before model fitting.')
+
+        column_names = dense.columns.tolist()
+        if ('cosine00' in column_names) or ('cosine_00' in column_names):
+            drift_model = None
+
+        if dense.empty:
+            dense = None
+
+    return sparse, dense, drift_model
+
+
+def save_design_matrix(fname, matrix):
+    """ Save a design matrix, indexed by frame time, to a NumPy archive """
+    with open(fname, 'wb') as fobj:
+        np.savez(fobj,
+                 values=matrix.to_numpy(dtype=float),
+                 columns=np.array(matrix.columns, dtype=str),
+                 frame_times=matrix.index.to_numpy(dtype=float))
+
+
+def load_design_matrix(fname):
+    """ Load a design matrix saved by :func:`save_design_matrix`
+
+    Design matrices saved as TSV files, with frame times in the first column,
+    are also accepted.
+    """
+    if str(fname).endswith('.tsv'):
+        return pd.read_csv(fname, sep='\t', index_col=0)
+    with np.load(fname) as archive:
+        return pd.DataFrame(archive['values'], columns=archive['columns'],
+                            index=archive['frame_times'])
@@ -0,0 +1,374 @@
+"""
+Image utilities
+^^^^^^^^^^^^^^^
+
+Compressed BOLD series may be decompressed once into a cache directory
+(see :func:`cached_bold`), so that fitting several models to a dataset reads
+uncompressed, memory-mapped images rather than decompressing each series for
+every fit.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+
+import numpy as np
+import nibabel as nb
+
+try:
+    import fcntl
+except ImportError:  # Windows, where open files cannot be removed
+    fcntl = None
+
+
+def scan_geometry(fname):
+    """ Describe the geometry of a BOLD series without reading its data
+
+    Returns a dictionary with the number of volumes (``n_vols``), ``shape``,
+    ``affine`` (``None`` for surface data), on-disk ``dtype`` and the
+    ``slope`` and ``inter`` scaling factors (``None`` if not applicable).
+
+    Only the header of volumetric images is read.
+    GIFTI files are parsed incrementally, counting data arrays without decoding
+    them.
+    """
+    if str(fname).endswith('.gii'):
+        return _scan_gifti(fname)
+
+    img = nb.load(fname)
+    # Scaling is moved from the header to the data proxy on load
+    slope = getattr(img.dataobj, 'slope', None)
+    inter = getattr(img.dataobj, 'inter', None)
+    return {'n_vols': img.shape[3] if len(img.shape) > 3 else 1,
+            'shape': list(img.shape),
+            'affine': img.affine.tolist(),
+            'dtype': str(img.get_data_dtype()),
+            'slope': None if slope is None else float(slope),
+            'inter': None if inter is None else float(inter)}
+
+
+def downcast_scaling(img, geometry=None):
+    """ Cast the scaling factors of ``img`` to 32-bit floats, if nearly lossless
+
+    Retrieved data are then not cast to float64 unless necessary to prevent
+    an overflow.
+    Scaling factors may be passed in ``geometry`` (see :func:`scan_geometry`),
+    rather than read from the image.
+    """
+    if not isinstance(img, nb.dataobj_images.DataobjImage):
+        return img
+    geometry = geometry or {}
+    # For NIfTI-1 files, slope and inter are 32-bit floats, so this is
+    # "safe". For NIfTI-2 (including CIFTI-2), these fields are 64-bit,
+    # so include a check to make sure casting doesn't lose too much.
+    slope = geometry.get('slope')
+    if slope is None:
+        slope = img.dataobj._slope
+    inter = geometry.get('inter')
+    if inter is None:
+        inter = img.dataobj._inter
+    slope32 = np.float32(slope)
+    inter32 = np.float32(inter)
+    if max(np.abs(slope32 - slope), np.abs(inter32 - inter)) < 1e-7:
+        img.dataobj._slope = slope32
+        img.dataobj._inter = inter32
+    return img
+
+
+def _scan_gifti(fname):
+    from xml.etree.ElementTree import iterparse
+    from nibabel.nifti1 import data_type_codes
+
+    n_vols = 0
+    n_vertices = None
+    dtype = None
+    for event, elem in iterparse(str(fname), events=('start', 'end')):
+        if elem.tag != 'DataArray':
+            continue
+        if event == 'start':
+            n_vols += 1
+            n_vertices = int(elem.get('Dim0'))
+            dtype = str(data_type_codes.dtype[elem.get('DataType')])
+        else:
+            # Drop encoded data as we go
+            elem.clear()
+    return {'n_vols': n_vols,
+            'shape': [n_vertices, n_vols],
+            'affine': None,
+            'dtype': dtype,
+            'slope': None,
+            'inter': None}
+
+
+def smoothing_radius(affine, fwhm, axis=2):
+    """ Number of slices on either side of a voxel that smoothing draws on
+
+    Smoothing follows :func:`nilearn.image.smooth_img`, which truncates its
+    Gaussian kernel at four standard deviations.
+    """
+    vox_size = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+    sigma = fwhm / (np.sqrt(8 * np.log(2)) * vox_size[axis])
+    return int(4 * sigma + 0.5)
+
+
+def mask_bounds(mask, pad=0):
+    """ Bounding box of the non-zero voxels of a 3D ``mask``, as slices
+
+    The box is grown by ``pad`` voxels on either side (one value per axis, or
+    one for all), within the bounds of the mask.
+    Returns ``None`` for an empty mask.
+
+    >>> mask = np.zeros((5, 6, 7), dtype=bool)
+    >>> mask[1:3, 2, 3:5] = True
+    >>> mask_bounds(mask)
+    (slice(1, 3, None), slice(2, 3, None), slice(3, 5, None))
+    >>> mask_bounds(mask, pad=(0, 1, 3))
+    (slice(1, 3, None), slice(1, 4, None), slice(0, 7, None))
+    """
+    mask = np.asarray(mask)
+    if not mask.any():
+        return None
+    pad = np.broadcast_to(pad, (mask.ndim,))
+    bounds = []
+    for axis, width in enumerate(pad):
+        other = tuple(ax for ax in range(mask.ndim) if ax != axis)
+        nonzero = np.flatnonzero(mask.any(axis=other))
+        bounds.append(slice(max(nonzero[0] - width, 0),
+                            min(nonzero[-1] + 1 + width, mask.shape[axis])))
+    return tuple(bounds)
+
+
+def crop_to_mask(img, mask_file, smoothing_fwhm=None):
+    """ Crop a 4D image to the bounding box of a mask on the same grid
+
+    Only the voxels within the box are read through the data proxy of ``img``.
+    If ``smoothing_fwhm`` is given, the box is grown by the radius of the
+    smoothing kernel, so that smoothing the cropped image within the mask is
+    equivalent to smoothing the full image.
+
+    Returns ``(cropped, mask_img, bounds)``, the cropped image and mask and the
+    slices of the box (see :func:`uncrop`), or ``None`` if the mask must be
+    resampled to ``img`` or is empty.
+    """
+    mask_img = nb.load(mask_file)
+    if (len(img.shape) != 4 or mask_img.shape[:3] != img.shape[:3] or
+            not np.allclose(mask_img.affine, img.affine)):
+        return None
+    mask = np.asanyarray(mask_img.dataobj) != 0
+    pad = 0
+    if smoothing_fwhm is not None:
+        pad = [smoothing_radius(img.affine, smoothing_fwhm, axis) for axis in range(3)]
+    bounds = mask_bounds(mask, pad)
+    if bounds is None:
+        return None
+
+    affine = img.affine.copy()
+    affine[:3, 3] = img.affine[:3, :3] @ [box.start for box in bounds] + img.affine[:3, 3]
+    cropped = nb.Nifti1Image(np.asanyarray(img.dataobj[bounds]), affine)
+    return cropped, nb.Nifti1Image(mask[bounds].astype(np.int8), affine), bounds
+
+
+def uncrop(img, ref_img, bounds):
+    """ Pad a cropped 3D image back to the field of view of ``ref_img`` """
+    data = np.asanyarray(img.dataobj)
+    full = np.zeros(ref_img.shape[:3] + data.shape[3:], dtype=data.dtype)
+    full[bounds] = data
+    return nb.Nifti1Image(full, ref_img.affine, img.header)
+
+
+@contextmanager
+def load_indexed(fname, max_index_bytes=None):
+    """ Load a gzipped NIfTI image, reading its data through a seek-point index
+
+    Reading a slab of slices through a plain gzip stream decompresses the file
+    up to the end of the slab in each volume.
+    If `indexed_gzip <https://github.com/pauldmccarthy/indexed_gzip>`_ is
+    installed, an index of seek points is built in a single pass, and each
+    read decompresses only from the seek point preceding it.
+    Seek points hold 32 KB each, and are spaced so that the index takes at
+    most ``max_index_bytes``.
+
+    Used as a context manager, yielding the image; the index and its file
+    handle are released when the context exits, and the image should not be
+    read afterwards.
+    Yields the image loaded with :func:`nibabel.load` if ``indexed_gzip`` is
+    unavailable or the image is not compressed.
+    """
+    fname = str(fname)
+    img = nb.load(fname)
+    try:
+        from indexed_gzip import IndexedGzipFile
+    except ImportError:
+        IndexedGzipFile = None
+    if IndexedGzipFile is None or not fname.endswith('.gz'):
+        yield img
+        return
+
+    spacing = 1024 ** 2
+    if max_index_bytes is not None:
+        nbytes = img.header.get_data_offset() + img.header.get_data_dtype().itemsize * \
+            int(np.prod(img.shape))
+        n_points = max(int(max_index_bytes // (32 * 1024)), 1)
+        spacing = max(nbytes // n_points, 64 * 1024)
+    with IndexedGzipFile(fname, spacing=int(spacing)) as fobj:
+        fobj.build_full_index()
+        file_map = img.make_file_map({'image': fobj, 'header': fobj})
+        yield type(img).from_file_map(file_map)
+
+
+def iter_slabs(img, mask, n_slices, smoothing_fwhm=None):
+    """ Read the masked time series of a 4D image, a slab of slices at a time
+
+    Slabs of ``n_slices`` slices along the third axis are read through the
+    data proxy of ``img``, so that only one slab is held in memory at once,
+    and cropped to the bounding box of ``mask`` within each slice.
+    If ``smoothing_fwhm`` is given, each slab is read with enough neighboring
+    voxels to smooth it as :func:`nilearn.image.smooth_img` smooths the whole
+    image.
+
+    Yields ``(index, data)`` pairs, where ``data`` is an array of shape
+    (time points, voxels) and ``index`` the position of its voxels among all
+    voxels of ``mask``, in the order of ``mask.nonzero()``.
+    """
+    from nilearn.image import smooth_img
+
+    mask = np.asarray(mask, dtype=bool)
+    order = np.full(mask.shape, -1)
+    order[mask] = np.arange(mask.sum())
+    n_z = mask.shape[2]
+    halo = [0, 0, 0]
+    if smoothing_fwhm is not None:
+        halo = [smoothing_radius(img.affine, smoothing_fwhm, axis) for axis in range(3)]
+    bounds = mask_bounds(mask, halo[:2] + [0])
+    if bounds is None:
+        return
+    box = bounds[:2]
+    for start in range(0, n_z, n_slices):
+        stop = min(start + n_slices, n_z)
+        slab_mask = mask[box + (slice(start, stop),)]
+        if not slab_mask.any():
+            continue
+        lo, hi = max(start - halo[2], 0), min(stop + halo[2], n_z)
+        data = np.asanyarray(img.dataobj[box + (slice(lo, hi),)])
+        if smoothing_fwhm is not None:
+            data = smooth_img(nb.Nifti1Image(data, img.affine), smoothing_fwhm).dataobj
+        # A single copy of the masked data is held while it is fit
+        data = np.ascontiguousarray(data[:, :, start - lo:stop - lo][slab_mask].T)
+        yield order[box + (slice(start, stop),)][slab_mask], data
+
+
+def read_dtype(img):
+    """ Data type of the data of ``img``, as read (and scaled) through its proxy """
+    return np.asanyarray(img.dataobj[(slice(0, 1),) * len(img.shape)]).dtype
+
+
+def mean_image(img, n_slices):
+    """ Average a 4D image over time, a slab of slices at a time """
+    mean = np.zeros(img.shape[:3])
+    for start in range(0, img.shape[2], n_slices):
+        stop = min(start + n_slices, img.shape[2])
+        mean[:, :, start:stop] = np.asanyarray(img.dataobj[:, :, start:stop]).mean(axis=-1)
+    return nb.Nifti1Image(mean, img.affine)
+
+
+@contextmanager
+def cached_bold(fname, cache_dir, max_size_gb=None):
+    """ Decompress a gzipped NIfTI image into ``cache_dir``, once
+
+    Cached images are keyed by the path, modification time and size of
+    ``fname``, and shared by all fits (and processes) using the same cache.
+    Once the cache exceeds ``max_size_gb``, the least recently used images are
+    removed, except for images in use.
+
+    Used as a context manager, yielding the path to the uncompressed image
+    (or ``fname`` if it is not compressed), which is locked against eviction
+    until the context exits.
+    """
+    fname = os.path.abspath(str(fname))
+    if not fname.endswith('.nii.gz'):
+        yield fname
+        return
+
+    stat = os.stat(fname)
+    key = json.dumps([fname, stat.st_mtime_ns, stat.st_size])
+    cached = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.nii')
+    os.makedirs(cache_dir, exist_ok=True)
+    while True:
+        if not os.path.exists(cached):
+            # Decompress to a temporary file first, as other processes may be reading the
+            # cache; the lock marks it as being written
+            with gzip.open(fname, 'rb') as src, \
+                    NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as dst:
+                _lock(dst, exclusive=True)
+                shutil.copyfileobj(src, dst, 16 * 1024 ** 2)
+            try:
+                os.replace(dst.name, cached)
+            except FileNotFoundError:
+                continue
+        try:
+            handle = open(cached, 'rb')
+        except FileNotFoundError:
+            continue
+        _lock(handle)
+        # The image may have been evicted while waiting for the lock
+        try:
+            if os.path.samefile(cached, handle.fileno()):
+                break
+        except FileNotFoundError:
+            pass
+        handle.close()
+
+    with handle:
+        # Mark as recently used
+        os.utime(cached)
+        if max_size_gb is not None:
+            _evict(cache_dir, max_size_gb * 1024 ** 3)
+        yield cached
+
+
+def _lock(handle, exclusive=False):
+    """ Hold an advisory lock on an open file until it is closed """
+    if fcntl is not None:
+        fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def _remove_unused(path):
+    """ Remove a cache file, unless another process holds a lock on it """
+    try:
+        with open(path, 'rb') as handle:
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(path)
+                return True
+        # Without advisory locks, files open in other processes cannot be removed
+        os.remove(path)
+    except OSError:
+        return False
+    return True
+
+
+def _evict(cache_dir, max_bytes):
+    """ Remove least recently used images until the cache fits within ``max_bytes``
+
+    Images locked by fits and temporary files being written are counted but
+    kept; temporary files left by interrupted processes are removed.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(('.nii', '.tmp')):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((entry.name.endswith('.nii'), stat.st_mtime, stat.st_size,
+                            entry.path))
+    total = sum(size for _, _, size, _ in entries)
+    # Temporary files come first, then images from the least recently used
+    for is_image, _, size, path in sorted(entries):
+        if is_image and total <= max_bytes:
+            break
+        if _remove_unused(path):
+            total -= size
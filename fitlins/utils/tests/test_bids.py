@@ -0,0 +1,199 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from ...conftest import SPACE, make_dataset
+from ..bids import (
+    _diff_trees, _scan_tree, add_selector_patterns, init_layout, layout_cache_path)
+
+
+def _index(layout):
+    """ Entities, metadata and associations of every file in a layout and its derivatives """
+    from bids.layout.models import FileAssociation
+    index = {}
+    for sublayout in [layout] + list(layout.derivatives.values()):
+        files = {bf.path: bf.entities for bf in sublayout.get(scope='self')}
+        associations = {(assoc.src, assoc.dst, assoc.kind)
+                        for assoc in sublayout.session.query(FileAssociation)}
+        index[sublayout.root] = files, associations
+    return index
+
+
+def _touch(path):
+    """ Advance a file's modification time, which may be coarser than a rewrite """
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_init_layout_persisted(bids_dir, tmp_path, monkeypatch):
+    from bids.layout import BIDSLayout
+
+    deriv = str(bids_dir / 'derivatives' / 'fmriprep')
+    cache_dir = str(tmp_path / 'dbcache')
+    database_path = layout_cache_path(cache_dir, str(bids_dir), [deriv])
+    fresh = init_layout(str(bids_dir), [deriv])
+    with monkeypatch.context() as patch:
+        # The index is built from the threaded scan, without walking the dataset again
+        patch.setattr(os, 'walk', None)
+        layout = init_layout(str(bids_dir), [deriv], database_path=database_path,
+                             n_workers=2)
+    # Consumers open the same snapshot without walking the dataset
+    assert _index(BIDSLayout.load(database_path)) == _index(layout) == _index(fresh)
+
+    # Each set of indexing options has its own index
+    assert layout_cache_path(cache_dir, str(bids_dir), [deriv]) == database_path
+    for options in ({'derivatives': None}, {'ignore': ['code']},
+                    {'force_index': ['/.*_echo-2_.*/']}):
+        kwargs = dict({'derivatives': [deriv]}, **options)
+        assert layout_cache_path(cache_dir, str(bids_dir), **kwargs) != database_path
+
+    # Files forced into the index from ignored directories are listed
+    (bids_dir / 'code').mkdir()
+    (bids_dir / 'code' / 'model.json').write_text('{}')
+    (bids_dir / 'code' / 'other.json').write_text('{}')
+    options = {'ignore': ['code'], 'force_index': ['/model\\.json$/']}
+    layout = init_layout(str(bids_dir), [deriv], database_path=str(tmp_path / 'forced'),
+                         **options)
+    assert _index(layout) == _index(init_layout(str(bids_dir), [deriv], **options))
+    indexed = layout.get(return_type='filename', extension='json', scope='raw')
+    assert str(bids_dir / 'code' / 'model.json') in indexed
+    assert str(bids_dir / 'code' / 'other.json') not in indexed
+
+
+@pytest.mark.parametrize('change_sidecar', [False, True])
+def test_init_layout_update(tmp_path, change_sidecar):
+    bids_dir = make_dataset(tmp_path / 'ds', subjects=('01', '02', '03'))
+    deriv = bids_dir / 'derivatives' / 'fmriprep'
+    func = bids_dir / 'sub-01' / 'func'
+    # Events are only linked to their runs if they have metadata
+    (bids_dir / 'task-x_events.json').write_text(json.dumps({'StimulusPresentation': {}}))
+    # Events of a run that has yet to be added
+    shutil.copy(str(func / 'sub-01_task-x_run-1_events.tsv'),
+                str(func / 'sub-01_task-x_run-3_events.tsv'))
+    database_path = str(tmp_path / 'db')
+    init_layout(str(bids_dir), [str(deriv)], database_path=database_path)
+
+    # Add a subject, with raw, derivative and linked files, and remove another
+    make_dataset(tmp_path / 'new', subjects=('04',))
+    for root in (bids_dir, deriv):
+        new = tmp_path / 'new' / root.relative_to(bids_dir)
+        shutil.copytree(str(new / 'sub-04'), str(root / 'sub-04'))
+    shutil.rmtree(str(bids_dir / 'sub-03'))
+    shutil.copy(str(func / 'sub-01_task-x_run-1_bold.nii.gz'),
+                str(func / 'sub-01_task-x_run-3_bold.nii.gz'))
+    # Remove a run of an indexed subject
+    for path in (deriv / 'sub-02' / 'func').glob('sub-02_task-x_run-2_*'):
+        path.unlink()
+    if change_sidecar:
+        (bids_dir / 'task-x_bold.json').write_text(json.dumps({'RepetitionTime': 3.0,
+                                                               'TaskName': 'y'}))
+
+    updated = init_layout(str(bids_dir), [str(deriv)], database_path=database_path)
+    fresh = init_layout(str(bids_dir), [str(deriv)])
+    assert _index(updated) == _index(fresh)
+
+    bold = updated.get(subject='04', suffix='bold', extension='nii.gz', scope='raw')[0]
+    assert bold.get_metadata()['TaskName'] == ('y' if change_sidecar else 'x')
+    assert not updated.get(subject='03', scope='raw')
+    events = updated.get_file(str(func / 'sub-01_task-x_run-3_events.tsv'))
+    assert [bf.path for bf in events.get_associations('IntendedFor')] == [
+        str(func / 'sub-01_task-x_run-3_bold.nii.gz')]
+
+
+def test_init_layout_modified(bids_dir, tmp_path):
+    deriv = str(bids_dir / 'derivatives' / 'fmriprep')
+    database_path = str(tmp_path / 'db')
+    layout = init_layout(str(bids_dir), [deriv], database_path=database_path)
+    bold = layout.get(subject='01', run=1, suffix='bold', scope='raw')[0].path
+    assert layout.get_metadata(bold)['RepetitionTime'] == 2.0
+
+    # Rewrite a sidecar without adding or removing any file
+    sidecar = bids_dir / 'task-x_bold.json'
+    sidecar.write_text(json.dumps({'RepetitionTime': 3.0, 'TaskName': 'x'}))
+    _touch(sidecar)
+    updated = init_layout(str(bids_dir), [deriv], database_path=database_path)
+    assert updated.get_metadata(bold)['RepetitionTime'] == 3.0
+    assert _index(updated) == _index(init_layout(str(bids_dir), [deriv]))
+
+
+def test_init_layout_other_pybids(bids_dir, tmp_path, monkeypatch):
+    import bids
+    from .. import bids as bids_utils
+
+    deriv = str(bids_dir / 'derivatives' / 'fmriprep')
+    database_path = str(tmp_path / 'db')
+    init_layout(str(bids_dir), [deriv], database_path=database_path)
+    assert os.path.exists(os.path.join(database_path, bids_utils.MANIFEST_FILENAME))
+
+    # Without the index internals of pybids 0.10, the index is rebuilt from scratch
+    monkeypatch.setattr(bids, '__version__', '0.11.0')
+    for helper in ('_scan_tree', '_update_index', '_index_listed_files'):
+        monkeypatch.setattr(bids_utils, helper, None)
+    (bids_dir / 'task-x_bold.json').write_text(json.dumps({'RepetitionTime': 3.0}))
+    layout = init_layout(str(bids_dir), [deriv], database_path=database_path)
+    assert _index(layout) == _index(init_layout(str(bids_dir), [deriv]))
+    assert not os.path.exists(os.path.join(database_path, bids_utils.MANIFEST_FILENAME))
+
+
+def test_add_selector_patterns(bids_dir):
+    deriv = bids_dir / 'derivatives' / 'fmriprep'
+    func = deriv / 'sub-01' / 'func'
+    for path in list(func.glob('*_space-{}_*'.format(SPACE))):
+        shutil.copy(str(path), str(path).replace(SPACE, 'T1w'))
+    bold = func / 'sub-01_task-x_run-1_space-{}_desc-preproc_bold.nii.gz'.format(SPACE)
+    shutil.copy(str(bold), str(bold).replace('desc-preproc', 'desc-smooth'))
+
+    ignore = add_selector_patterns(None, str(bids_dir), derivatives=[str(deriv)],
+                                   participants=['01'], space=SPACE, desc='preproc')
+    layout = init_layout(str(bids_dir), [str(deriv)], ignore=ignore)
+    full = init_layout(str(bids_dir), [str(deriv)])
+
+    # Every file that can be selected is indexed, and nothing else
+    selectors = {'subject': '01', 'space': SPACE, 'desc': 'preproc', 'suffix': 'bold'}
+    assert (layout.get(return_type='filename', **selectors) ==
+            full.get(return_type='filename', **selectors))
+    for query in ({'subject': '01', 'desc': 'confounds'},
+                  {'subject': '01', 'suffix': 'events'},
+                  {'subject': '01', 'desc': 'brain', 'space': SPACE}):
+        assert layout.get(return_type='filename', **query) == full.get(
+            return_type='filename', **query)
+        assert layout.get(return_type='filename', **query)
+    assert not layout.get(subject='02')
+    assert not layout.get(space='T1w')
+    assert not layout.get(desc='smooth')
+    assert full.get(subject='02') and full.get(space='T1w') and full.get(desc='smooth')
+
+
+def test_scan_tree(bids_dir):
+    root = str(bids_dir)
+    tree = _scan_tree(root)
+    assert _scan_tree(root, n_workers=4) == tree
+    # Derivatives are scanned as separate roots
+    assert not any(rel.startswith('derivatives') for rel in tree)
+    assert 'task-x_bold.json' in tree['.']
+    assert set(tree['sub-01/func']) == {
+        'sub-01_task-x_run-{}_{}'.format(run, suffix)
+        for run in (1, 2) for suffix in ('bold.nii.gz', 'events.tsv')}
+
+    func = bids_dir / 'sub-01' / 'func'
+    events = func / 'sub-01_task-x_run-1_events.tsv'
+    events.write_text(events.read_text() + '\n')
+    (func / 'sub-01_task-x_run-2_events.tsv').unlink()
+    (func / 'sub-01_task-x_run-3_events.tsv').write_text('onset\tduration\n')
+    shutil.rmtree(str(bids_dir / 'sub-02'))
+    # Files rewritten in place, leaving their directory unchanged, are found
+    sidecar = bids_dir / 'task-x_bold.json'
+    mtime = os.stat(str(bids_dir)).st_mtime_ns
+    sidecar.write_text(sidecar.read_text().replace('2.0', '3.0'))
+    _touch(sidecar)
+    assert os.stat(str(bids_dir)).st_mtime_ns == mtime
+    new_tree = _scan_tree(root, n_workers=4)
+
+    added, removed = _diff_trees(root, tree, new_tree)
+    assert sorted(added) == sorted(
+        [str(events), str(func / 'sub-01_task-x_run-3_events.tsv'), str(sidecar)])
+    assert sorted(removed) == sorted(
+        [str(events), str(func / 'sub-01_task-x_run-2_events.tsv'), str(sidecar)] +
+        [str(bids_dir / 'sub-02' / 'func' / fname) for fname in tree['sub-02/func']])
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from ..contrasts import (
+    CompiledContrasts, contrast_key, load_contrasts, load_run_contrasts, run_contrasts,
+    save_contrast_store)
+
+CONTRASTS = [{'name': 'a', 'type': 't', 'weights': [{'a': 1}]},
+             {'name': 'a-b', 'type': 't', 'weights': [{'a': 1, 'b': -1}]},
+             {'name': 'abc', 'type': 'F', 'weights': [{'a': 1}, {'b': 1}, {'c': .5}]},
+             {'name': 'd', 'type': 't', 'weights': [{'d': 1, 'a': 0}]},
+             {'name': 'e', 'type': 't', 'weights': [{'a': 1, 'e': 0}]}]
+
+
+def _prepare_contrasts(contrasts, all_regressors):
+    """ Contrasts weights as computed for each run before they were compiled """
+    out_contrasts = []
+    for contrast in contrasts:
+        missing = any([[n for n, v in row.items()
+                        if v != 0 and n not in all_regressors]
+                       for row in contrast['weights']])
+        if not missing:
+            weights = np.array([
+                [row[col] if col in row else 0 for col in all_regressors]
+                for row in contrast['weights']])
+            out_contrasts.append((contrast['name'], weights, contrast['type']))
+    return out_contrasts
+
+
+@pytest.mark.parametrize('columns', [['a', 'b', 'c', 'constant'],
+                                     ['constant', 'c', 'b', 'a', 'd'],
+                                     ['b', 'a', 'drift_1', 'constant']])
+def test_compiled_contrasts(tmp_path, columns):
+    compiled = CompiledContrasts.from_contrast_info(CONTRASTS)
+    fname = str(tmp_path / 'contrasts.npz')
+    key = contrast_key(CONTRASTS)
+    save_contrast_store(fname, {key: compiled})
+
+    expected = _prepare_contrasts(CONTRASTS, columns)
+    for contrasts in (compiled.weights_for(columns),
+                      load_contrasts(fname, key).weights_for(columns),
+                      run_contrasts({'contrast_store': fname, 'contrast_key': key}, None,
+                                    columns),
+                      run_contrasts({}, CONTRASTS, columns)):
+        assert [(name, stat) for name, _, stat in contrasts] == [
+            (name, stat) for name, _, stat in expected]
+        for (_, weights, _), (_, expected_weights, _) in zip(contrasts, expected):
+            assert np.array_equal(weights, expected_weights)
+
+    # Contrast matrices of a run are read from the store, without compiling contrasts
+    info = {'contrast_store': fname, 'contrast_key': key}
+    assert load_run_contrasts(info, None).matrix(columns).equals(compiled.matrix(columns))
+
+
+def test_contrast_key():
+    assert contrast_key(CONTRASTS) == contrast_key([dict(con) for con in CONTRASTS])
+    assert contrast_key(CONTRASTS) != contrast_key(CONTRASTS[::-1])
+    changed = CONTRASTS[:1] + [dict(CONTRASTS[1], weights=[{'a': 1, 'b': -2}])]
+    assert contrast_key(changed) != contrast_key(CONTRASTS[:2])
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from .. import design
+from ..design import (
+    DesignStore, load_dense, load_design_matrix, load_run_design, load_sparse, open_design_stores,
+    save_design_matrix, save_design_store)
+
+
+def _sparse(rng, n_events=6):
+    return pd.DataFrame({'onset': np.arange(n_events) * 10. + rng.rand(n_events),
+                         'duration': rng.rand(n_events),
+                         'condition': np.resize(['a', 'b'], n_events),
+                         'amplitude': rng.randn(n_events)})
+
+
+def _dense(rng, n_vols=20, columns=('trans_x', 'white_matter')):
+    return pd.DataFrame(rng.randn(n_vols, len(columns)), columns=list(columns))
+
+
+def test_design_store(tmp_path):
+    rng = np.random.RandomState(0)
+    fname = str(tmp_path / 'design.npz')
+    designs = {'0': (_sparse(rng), _dense(rng)),
+               '1': (None, _dense(rng, columns=['cosine00'])),
+               '2': (_sparse(rng), None)}
+    save_design_store(fname, designs)
+
+    for run, (sparse, dense) in designs.items():
+        for loaded, expected in ((load_sparse(fname, run), sparse),
+                                 (load_dense(fname, run), dense)):
+            if expected is None:
+                assert loaded is None
+            else:
+                # Values round-trip exactly
+                pd.testing.assert_frame_equal(loaded, expected)
+
+    # Arrays are mapped from the archive, rather than read
+    with DesignStore(fname) as store:
+        values = store['0/dense/values']
+        assert isinstance(values, np.memmap) and not values.flags.writeable
+        assert np.array_equal(values, designs['0'][1].to_numpy())
+        assert store['0/sparse/condition'].tolist() == designs['0'][0]['condition'].tolist()
+        assert '1/sparse/onset' not in store
+    # Empty and compressed arrays are read
+    save_design_store(fname, {'0': (_sparse(rng, 0), None)})
+    assert load_sparse(fname, '0').empty
+    np.savez_compressed(fname, **{'0/dense/values': np.eye(2),
+                                  '0/dense/columns': np.array(['a', 'b'])})
+    assert np.array_equal(load_dense(fname, '0').to_numpy(), np.eye(2))
+
+
+def test_open_design_stores(tmp_path, monkeypatch):
+    rng = np.random.RandomState(3)
+    infos = []
+    for store in ('a.npz', 'b.npz'):
+        fname = str(tmp_path / store)
+        save_design_store(fname, {'0': (_sparse(rng), _dense(rng)), '1': (None, _dense(rng))})
+        infos.extend({'design_store': fname, 'run': run} for run in ('0', '1'))
+    expected = [load_run_design(info) for info in infos]
+
+    opened = []
+
+    class Store(DesignStore):
+        def __init__(self, fname):
+            opened.append(fname)
+            super(Store, self).__init__(fname)
+
+    monkeypatch.setattr(design, 'DesignStore', Store)
+    with open_design_stores(infos) as stores:
+        for info, (sparse, dense, drift_model) in zip(infos, expected):
+            store = stores[info['design_store']]
+            loaded = load_run_design(info, store=store)
+            assert loaded[2] == drift_model
+            for frame, expected_frame in zip(loaded[:2], (sparse, dense)):
+                if expected_frame is None:
+                    assert frame is None
+                else:
+                    pd.testing.assert_frame_equal(frame, expected_frame)
+            pd.testing.assert_frame_equal(load_dense(store, info['run']),
+                                          load_dense(info['design_store'], info['run']))
+    # Each store is opened once, apart from the loads by file name
+    assert opened[:2] == [infos[0]['design_store'], infos[2]['design_store']]
+    assert len(opened) == 2 + len(infos)
+    # Stores are closed on exit
+    assert all(store.closed for store in stores.values())
+
+
+def test_load_run_design(tmp_path):
+    rng = np.random.RandomState(1)
+    fname = str(tmp_path / 'design.npz')
+    sparse = _sparse(rng)
+    sparse.loc[2, 'amplitude'] = np.nan
+    dense = _dense(rng)
+    dense['empty'] = np.nan
+    save_design_store(fname, {'0': (sparse, dense),
+                              '1': (None, _dense(rng, columns=['cosine00']))})
+
+    events, regressors, drift_model = load_run_design(
+        {'design_store': fname, 'run': '0'}, drop_missing=True)
+    assert events.columns.tolist() == ['onset', 'duration', 'trial_type', 'modulation']
+    # Events without amplitude are dropped
+    assert events.onset.tolist() == sparse.onset.drop(2).tolist()
+    assert regressors.columns.tolist() == ['trans_x', 'white_matter']
+    assert drift_model == 'cosine'
+    with pytest.raises(RuntimeError, match='columns are empty: empty'):
+        load_run_design({'design_store': fname, 'run': '0'})
+
+    # Drift regressors in the model replace the default drift model
+    events, regressors, drift_model = load_run_design({'design_store': fname, 'run': '1'})
+    assert events is None and drift_model is None
+
+
+def test_design_matrix_round_trip(tmp_path):
+    rng = np.random.RandomState(2)
+    matrix = pd.DataFrame(rng.randn(30, 3) / 3, columns=['a', 'b', 'constant'],
+                          index=np.arange(30) * 1.7)
+    fname = str(tmp_path / 'design.npz')
+    save_design_matrix(fname, matrix)
+    # Values keep full precision
+    pd.testing.assert_frame_equal(load_design_matrix(fname), matrix, check_exact=True,
+                                  check_index_type=False, check_column_type=False)
+
+    # Design matrices written as TSV are still accepted
+    matrix.to_csv(str(tmp_path / 'design.tsv'), sep='\t')
+    assert np.allclose(load_design_matrix(str(tmp_path / 'design.tsv')), matrix)
@@ -0,0 +1,184 @@
+import os
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+from ..images import (
+    cached_bold, crop_to_mask, downcast_scaling, load_indexed, scan_geometry, uncrop)
+
+
+def _bold(path, name, shape=(4, 4, 4, 10), seed=0):
+    data = np.random.RandomState(seed).randn(*shape).astype(np.float32)
+    fname = str(path / name)
+    nb.Nifti1Image(data, np.eye(4)).to_filename(fname)
+    return fname, data
+
+
+def _open_files(fname):
+    """ Paths of the open file descriptors of this process that refer to ``fname`` """
+    fds = '/proc/self/fd'
+    if not os.path.isdir(fds):
+        pytest.skip('Open files cannot be listed')
+    paths = []
+    for fd in os.listdir(fds):
+        try:
+            paths.append(os.readlink(os.path.join(fds, fd)))
+        except OSError:
+            continue
+    return [path for path in paths if path == fname]
+
+
+def _age(path, seconds):
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime - seconds, stat.st_mtime - seconds))
+
+
+def test_cached_bold(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    fname, data = _bold(tmp_path, 'bold.nii.gz')
+    with cached_bold(fname, cache_dir) as cached:
+        assert cached.endswith('.nii') and os.path.dirname(cached) == cache_dir
+        assert np.array_equal(nb.load(cached).get_fdata(), data)
+    mtime = os.stat(cached).st_mtime_ns
+    with cached_bold(fname, cache_dir) as again:
+        assert again == cached
+    # Decompressed once, then reused
+    assert os.stat(cached).st_mtime_ns >= mtime
+    assert os.listdir(cache_dir) == [os.path.basename(cached)]
+
+    # Uncompressed images are used in place
+    plain, _ = _bold(tmp_path, 'bold.nii')
+    with cached_bold(plain, cache_dir) as cached:
+        assert cached == plain
+
+
+def test_cached_bold_eviction(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    fnames = [_bold(tmp_path, 'bold{}.nii.gz'.format(ix), seed=ix)[0] for ix in range(3)]
+
+    with cached_bold(fnames[0], cache_dir) as in_use:
+        with cached_bold(fnames[1], cache_dir) as unused:
+            pass
+        size_gb = os.path.getsize(in_use) * 1.5 / 1024 ** 3
+        _age(in_use, 100)
+        _age(unused, 50)
+        # The least recently used image is in use, so the next one is removed
+        with cached_bold(fnames[2], cache_dir, max_size_gb=size_gb) as newest:
+            assert os.path.exists(in_use) and os.path.exists(newest)
+            assert not os.path.exists(unused)
+
+    # Once released, it is evicted in turn
+    with cached_bold(fnames[1], cache_dir, max_size_gb=size_gb) as cached:
+        assert sorted(os.listdir(cache_dir)) == [os.path.basename(cached)]
+
+
+def test_cached_bold_temporary_files(tmp_path):
+    fcntl = pytest.importorskip('fcntl')
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    fnames = [_bold(tmp_path, 'bold{}.nii.gz'.format(ix), seed=ix)[0] for ix in range(2)]
+    # Header and data of an uncompressed image
+    image_size = 352 + 4 * 4 * 4 * 10 * 4
+
+    # Left by an interrupted process
+    stale = cache_dir / 'stale.tmp'
+    stale.write_bytes(b'\0' * image_size)
+    # Being written by another process
+    active = cache_dir / 'active.tmp'
+    active.write_bytes(b'\0' * image_size)
+    with open(str(active), 'rb') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        with cached_bold(fnames[0], str(cache_dir), max_size_gb=1) as first:
+            assert os.path.getsize(first) == image_size
+            assert sorted(os.listdir(str(cache_dir))) == sorted(
+                [os.path.basename(first), 'active.tmp'])
+        _age(first, 100)
+
+        # Files being written count towards the size of the cache
+        max_size_gb = image_size * 2.5 / 1024 ** 3
+        with cached_bold(fnames[1], str(cache_dir), max_size_gb=max_size_gb) as second:
+            assert sorted(os.listdir(str(cache_dir))) == sorted(
+                [os.path.basename(second), 'active.tmp'])
+
+
+@pytest.mark.parametrize('max_index_bytes', [None, 32 * 1024])
+def test_load_indexed(tmp_path, max_index_bytes):
+    fname, data = _bold(tmp_path, 'bold.nii.gz', shape=(8, 8, 8, 20))
+    with load_indexed(fname, max_index_bytes) as img:
+        assert np.array_equal(img.dataobj[:, :, 2:5], data[:, :, 2:5])
+        assert np.array_equal(img.dataobj[..., 10], data[..., 10])
+    # The index and file handle are released
+    assert not _open_files(fname)
+
+    plain, _ = _bold(tmp_path, 'bold.nii', shape=(8, 8, 8, 20))
+    with load_indexed(plain, max_index_bytes) as img:
+        assert np.array_equal(img.dataobj[:, :, 2:5], data[:, :, 2:5])
+
+
+def test_scan_geometry(tmp_path):
+    data = np.random.RandomState(0).randint(0, 1000, (4, 5, 6, 7)).astype(np.int16)
+    img = nb.Nifti1Image(data, np.diag([2., 2., 3., 1.]))
+    img.header.set_slope_inter(0.5, 10)
+    fname = str(tmp_path / 'bold.nii.gz')
+    img.to_filename(fname)
+
+    geometry = scan_geometry(fname)
+    assert geometry == {'n_vols': 7, 'shape': [4, 5, 6, 7],
+                        'affine': np.diag([2., 2., 3., 1.]).tolist(),
+                        'dtype': 'int16', 'slope': 0.5, 'inter': 10.}
+    # Scaling factors of the scan are used without reading them from the image
+    loaded = nb.load(fname)
+    loaded.dataobj._slope, loaded.dataobj._inter = 1., 0.
+    downcast_scaling(loaded, geometry)
+    assert np.asanyarray(loaded.dataobj).dtype == np.float32
+    assert np.array_equal(np.asanyarray(loaded.dataobj), data * 0.5 + 10)
+
+    darrays = [nb.gifti.GiftiDataArray(np.arange(10, dtype=np.float32) + vol)
+               for vol in range(3)]
+    fname = str(tmp_path / 'bold.func.gii')
+    nb.save(nb.GiftiImage(darrays=darrays), fname)
+    assert scan_geometry(fname) == {'n_vols': 3, 'shape': [10, 3], 'affine': None,
+                                    'dtype': 'float32', 'slope': None, 'inter': None}
+
+
+@pytest.mark.parametrize('smoothing_fwhm', [None, 5.])
+def test_crop_to_mask(tmp_path, smoothing_fwhm):
+    from nilearn.input_data import NiftiMasker
+
+    affine = np.diag([2., 2., 2.5, 1.])
+    affine[:3, 3] = [-10, 4, 7]
+    data = np.random.RandomState(0).randn(14, 12, 10, 5)
+    img = nb.Nifti1Image(data, affine)
+    mask = np.zeros(data.shape[:3], dtype=np.uint8)
+    mask[4:9, 5:8, 3:6] = 1
+    mask[6, 6, 4] = 0
+    mask_file = str(tmp_path / 'mask.nii.gz')
+    nb.Nifti1Image(mask, affine).to_filename(mask_file)
+
+    cropped, cropped_mask, bounds = crop_to_mask(img, mask_file, smoothing_fwhm)
+    assert cropped.shape[:3] == cropped_mask.shape
+    assert all(size < full_size for size, full_size in zip(cropped_mask.shape, mask.shape))
+    # The cropped image occupies the same positions in space
+    corner = [box.start for box in bounds]
+    assert np.allclose(cropped.affine[:3, 3], nb.affines.apply_affine(affine, corner))
+    # Masked and smoothed data are unaffected by cropping
+    expected = NiftiMasker(mask_file, smoothing_fwhm=smoothing_fwhm).fit_transform(img)
+    masked = NiftiMasker(cropped_mask, smoothing_fwhm=smoothing_fwhm).fit_transform(cropped)
+    assert np.allclose(masked, expected)
+
+    cropped_map = nb.Nifti1Image(cropped.get_fdata()[..., 0], cropped.affine)
+    full = uncrop(cropped_map, img, bounds)
+    assert full.shape == mask.shape and np.allclose(full.affine, affine)
+    assert np.array_equal(full.get_fdata()[bounds], cropped_map.get_fdata())
+    outside = np.ones(mask.shape, dtype=bool)
+    outside[bounds] = False
+    assert not full.get_fdata()[outside].any()
+
+    # Masks that must be resampled, or are empty, are not cropped to
+    shifted = affine.copy()
+    shifted[:3, 3] += 1
+    nb.Nifti1Image(mask, shifted).to_filename(mask_file)
+    assert crop_to_mask(img, mask_file) is None
+    nb.Nifti1Image(np.zeros_like(mask), affine).to_filename(mask_file)
+    assert crop_to_mask(img, mask_file) is None
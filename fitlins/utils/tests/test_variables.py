@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from ...conftest import CONFOUNDS
+from ..variables import ProjectedLayout, model_variables
+
+SELECTORS = {'desc': 'preproc', 'space': 'MNI152NLin2009cAsym'}
+
+
+def _model(x):
+    return {'Name': 'test', 'Input': {'Task': 'x'},
+            'Steps': [{'Level': 'run',
+                       'Transformations': [{'Name': 'Factor', 'Input': ['trial_type']}],
+                       'Model': {'X': x}}]}
+
+
+def _design_matrices(layout, model, projected, cache_dir=None):
+    from bids.analysis import Analysis
+
+    analysis = Analysis(layout, model=model)
+    if projected:
+        analysis.layout = ProjectedLayout(layout, model_variables(model), cache_dir=cache_dir)
+        for step in analysis.steps:
+            step.layout = analysis.layout
+    analysis.setup(drop_na=False, **SELECTORS)
+    return analysis.steps[0].get_design_matrix()
+
+
+def test_projected_layout_wildcards(bids_dir):
+    from bids.layout import BIDSLayout
+
+    layout = BIDSLayout(str(bids_dir), derivatives=True, validate=False)
+    model = _model(['trial_type.a', 'a_comp_cor_*', 'trans_?', 'framewise_displacement'])
+
+    expected = _design_matrices(layout, model, projected=False)
+    projected = _design_matrices(layout, model, projected=True)
+    assert len(expected) == len(projected) == 4
+    for (sparse0, dense0, ents0), (sparse1, dense1, ents1) in zip(expected, projected):
+        assert ents0 == ents1
+        assert sparse0.equals(sparse1)
+        assert dense0.columns.equals(dense1.columns)
+        confounds = [column for column in dense1.columns if column in CONFOUNDS]
+        assert sorted(confounds) == [
+            'a_comp_cor_00', 'a_comp_cor_01', 'framewise_displacement', 'trans_x', 'trans_y']
+        assert np.allclose(dense0[confounds], dense1[confounds], equal_nan=True)
+
+
+def _assert_designs_equal(designs0, designs1):
+    assert len(designs0) == len(designs1)
+    for (sparse0, dense0, ents0), (sparse1, dense1, ents1) in zip(designs0, designs1):
+        assert ents0 == ents1
+        assert sparse0.equals(sparse1)
+        assert dense0.equals(dense1)
+
+
+def test_projected_layout_cache(bids_dir, tmp_path, monkeypatch):
+    import bids.variables
+    from bids.layout import BIDSLayout
+
+    layout = BIDSLayout(str(bids_dir), derivatives=True, validate=False)
+    cache_dir = str(tmp_path / 'cache')
+    model = _model(['trial_type.a', 'trans_x'])
+    expected = _design_matrices(layout, model, projected=True)
+    _assert_designs_equal(_design_matrices(layout, model, True, cache_dir), expected)
+
+    parsed = []
+    load_variables = bids.variables.load_variables
+    monkeypatch.setattr(bids.variables, 'load_variables',
+                        lambda *args, **kwargs: parsed.append(kwargs) or load_variables(
+                            *args, **kwargs))
+    # Cached variables are reused by other models, which may add regressors
+    _assert_designs_equal(_design_matrices(layout, model, True, cache_dir), expected)
+    assert not parsed
+    model = _model(['trial_type.a', 'trans_x', 'white_matter'])
+    expected = _design_matrices(layout, model, projected=True)
+    parsed.clear()
+    _assert_designs_equal(_design_matrices(layout, model, True, cache_dir), expected)
+    assert not parsed
+
+    # Changed files are parsed again
+    events = bids_dir / 'sub-02' / 'func' / 'sub-02_task-x_run-1_events.tsv'
+    events.write_text(events.read_text().replace('\t2.0\t', '\t4.0\t'))
+    layout = BIDSLayout(str(bids_dir), derivatives=True, validate=False)
+    expected = _design_matrices(layout, model, projected=True)
+    assert expected[2][0].duration.unique().tolist() == [4.]
+    parsed.clear()
+    _assert_designs_equal(_design_matrices(layout, model, True, cache_dir), expected)
+    assert [kwargs['subject'] for kwargs in parsed] == ['02']
+
+
+def test_projected_layout_defaults():
+    import inspect
+    from bids.layout import BIDSLayout
+
+    def defaults(method):
+        return {name: param.default
+                for name, param in inspect.signature(method).parameters.items()
+                if param.default is not param.empty}
+
+    assert defaults(ProjectedLayout.get_collections) == defaults(BIDSLayout.get_collections)
+
+    class Layout(object):
+        def get_collections(self, level, **kwargs):
+            return kwargs
+
+    forwarded = ProjectedLayout(Layout()).get_collections('subject')
+    assert forwarded['skip_empty'] is False
+
+
+@pytest.mark.parametrize('sampling_rate,expected', [(None, 10), (5., 5.), ('TR', .5)])
+def test_projected_layout_sampling_rate(bids_dir, sampling_rate, expected):
+    from bids.layout import BIDSLayout
+
+    layout = BIDSLayout(str(bids_dir), derivatives=True, validate=False)
+    projected = ProjectedLayout(layout, ['trial_type'], sampling_rate=sampling_rate)
+    collections = projected.get_collections('run', task='x', subject='01', **SELECTORS)
+    assert len(collections) == 2
+    assert [collection.sampling_rate for collection in collections] == [expected] * 2
+    # Rates passed to get_collections take precedence
+    collections = projected.get_collections('run', task='x', subject='01',
+                                            sampling_rate=2., **SELECTORS)
+    assert [collection.sampling_rate for collection in collections] == [2.] * 2
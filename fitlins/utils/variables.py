@@ -0,0 +1,292 @@
+"""
+Loading BIDS variables
+^^^^^^^^^^^^^^^^^^^^^^
+
+Preprocessing pipelines produce confound files with hundreds of columns,
+of which a model typically uses a handful.
+:class:`ProjectedLayout` restricts the regressors loaded for a model to the
+columns it might refer to, so that the others are never parsed or converted
+into variables.
+
+Parsed variables may also be cached on disk, keyed by the paths, modification
+times and sizes of the files they were read from, so that fitting several
+models to a dataset parses its events and confounds only once.
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import pickle
+import re
+from tempfile import NamedTemporaryFile
+
+import pandas as pd
+
+# Columns included in first-level designs whether or not they appear in the model
+IMPLICIT_PREFIXES = ('non_steady_state',)
+# Names containing these characters are expanded by pybids as unix-style patterns
+WILDCARD = re.compile(r'[*?\[\]]')
+
+
+def model_variables(model):
+    """ Collect every name a BIDS-StatsModel may use to refer to a variable
+
+    This is deliberately conservative: every string in the model is included,
+    as are the components of dotted names (such as ``trial_type.word``, produced
+    by a ``Factor`` transformation).
+
+    >>> names = model_variables({
+    ...     'Steps': [{'Level': 'run',
+    ...                'Transformations': [{'Name': 'Factor', 'Input': ['trial_type']}],
+    ...                'Model': {'X': ['trial_type.word', 'framewise_displacement']}}]})
+    >>> sorted(name for name in names if name.islower())
+    ['framewise_displacement', 'run', 'trial_type', 'trial_type.word', 'word']
+    """
+    names = set()
+
+    def collect(obj):
+        if isinstance(obj, str):
+            names.add(obj)
+            if '.' in obj:
+                names.update(obj.split('.'))
+        elif isinstance(obj, dict):
+            for key, val in obj.items():
+                collect(key)
+                collect(val)
+        elif isinstance(obj, (list, tuple)):
+            for val in obj:
+                collect(val)
+
+    collect(model)
+    return names
+
+
+class ProjectedLayout(object):
+    """ Proxy a :class:`~bids.layout.BIDSLayout`, loading only selected regressors
+
+    Run-level collections are loaded as by :meth:`BIDSLayout.get_collections`,
+    except that only the columns of ``*_regressors.tsv`` files that are
+    selected by ``columns`` (see :func:`column_selector`) are read.
+    All other attributes are those of the wrapped layout.
+
+    If ``n_procs > 1`` and the layout index is persisted at ``database_path``,
+    run-level variables are loaded one subject at a time in a pool of
+    ``n_procs`` processes.
+    If ``cache_dir`` is provided, parsed variables are cached there (see
+    :func:`load_run_index`).
+
+    ``sampling_rate`` (in Hz, or ``'TR'`` for the acquisition rate of each run)
+    sets the rate at which run-level collections densify sparse variables,
+    if not given to :meth:`get_collections`.
+    By default, the pybids default of 10 Hz is used.
+    """
+    def __init__(self, layout, columns=None, n_procs=1, database_path=None,
+                 cache_dir=None, sampling_rate=None):
+        self._layout = layout
+        self.columns = columns
+        self.n_procs = n_procs
+        self.database_path = database_path
+        self.cache_dir = cache_dir
+        self.sampling_rate = sampling_rate
+
+    def __getattr__(self, attr):
+        return getattr(self._layout, attr)
+
+    def get_collections(self, level, types=None, variables=None, merge=False,
+                        sampling_rate=None, skip_empty=False, **kwargs):
+        if level != 'run' or types is not None:
+            return self._layout.get_collections(
+                level, types=types, variables=variables, merge=merge,
+                sampling_rate=sampling_rate, skip_empty=skip_empty, **kwargs)
+
+        subjects = self._layout.get_subjects()
+        if kwargs.get('subject') is not None:
+            selected = kwargs['subject']
+            if isinstance(selected, str):
+                selected = [selected]
+            subjects = [sub for sub in subjects if sub in selected]
+
+        if self.n_procs > 1 and self.database_path is not None and len(subjects) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=min(self.n_procs, len(subjects))) as pool:
+                futures = [pool.submit(_load_subject_index, self.database_path,
+                                       self.columns, skip_empty, self.cache_dir,
+                                       dict(kwargs, subject=sub))
+                           for sub in subjects]
+                index = _merge_indexes([future.result() for future in futures])
+        elif self.cache_dir is not None:
+            # Cache entries are per subject, so they are shared by any selection
+            index = _merge_indexes([
+                load_run_index(self._layout, self.columns, skip_empty, self.cache_dir,
+                               **dict(kwargs, subject=sub))
+                for sub in subjects])
+        else:
+            index = load_run_index(self._layout, self.columns, skip_empty, **kwargs)
+
+        if sampling_rate is None:
+            sampling_rate = self.sampling_rate
+        if sampling_rate != 'TR':
+            return index.get_collections(level, variables, merge, sampling_rate=sampling_rate)
+
+        collections = index.get_collections(level, variables, merge)
+        if collections is None:
+            return None
+        for collection in collections if isinstance(collections, list) else [collections]:
+            trs = {run_info.tr for var in collection.variables.values()
+                   for run_info in var.run_info}
+            if len(trs) > 1:
+                raise ValueError("Non-unique repetition times found ({!r}); specify "
+                                 "sampling rate explicitly".format(sorted(trs)))
+            if trs:
+                collection.sampling_rate = 1. / trs.pop()
+        return collections
+
+
+def load_run_index(layout, columns=None, skip_empty=True, cache_dir=None, **kwargs):
+    """ Load run-level variables into a :class:`~bids.variables.entities.NodeIndex`
+
+    Equivalent to :func:`bids.variables.load_variables` with the ``events``,
+    ``physio``, ``stim`` and ``regressors`` types, but reading only the columns
+    of regressors files that are selected as described in
+    :class:`ProjectedLayout`.
+
+    If ``cache_dir`` is provided, events, physio and stim variables are cached
+    there, keyed by the selection and by the path, modification time and size
+    of every file of the selected subjects and of the dataset-level sidecars.
+    The columns read from each regressors file are cached, keyed by the path,
+    modification time and size of that file, and are added to as models
+    request new columns.
+    """
+    from bids.variables import load_variables
+    from bids.variables.io import BASE_ENTITIES
+    from bids.variables.variables import DenseRunVariable
+
+    keep_column = column_selector(columns)
+    types = ['events', 'physio', 'stim']
+    if cache_dir is None:
+        index = load_variables(layout, types=types, skip_empty=skip_empty, **kwargs)
+    else:
+        files = layout.get(subject=None, return_type='file')
+        if kwargs.get('subject') is not None:
+            files += layout.get(subject=kwargs['subject'], return_type='file')
+        else:
+            files = layout.get(return_type='file')
+        key = _cache_key(files, types=types, skip_empty=skip_empty, **kwargs)
+        cache_file = os.path.join(cache_dir, 'runs', key + '.pkl')
+        index = _read_cache(cache_file)
+        if index is None:
+            index = load_variables(layout, types=types, skip_empty=skip_empty, **kwargs)
+            _write_cache(cache_file, index)
+
+    scope = kwargs.get('scope', 'all')
+    for run in index.get_nodes('run'):
+        run_info = run.get_info()
+        sub_ents = {key: val for key, val in run_info.entities.items()
+                    if key in BASE_ENTITIES}
+        confound_files = layout.get(suffix='regressors', extension='tsv',
+                                    scope=scope, return_type='file', **sub_ents)
+        for confound_file in confound_files:
+            data = _read_regressors(confound_file, keep_column, cache_dir)
+            for col in data.columns:
+                run.add_variable(DenseRunVariable(
+                    name=col, values=data[[col]], run_info=run_info,
+                    source='regressors', sampling_rate=1. / run.repetition_time))
+
+    return index
+
+
+def column_selector(columns):
+    """ Make a function selecting the regressors columns that ``columns`` refer to
+
+    Columns are selected if they are named in ``columns``, match a name with
+    unix-style wildcards (as pybids transformations expand, e.g. ``trans_*``),
+    or start with one of ``IMPLICIT_PREFIXES``.
+    All columns are selected if ``columns`` is ``None``.
+
+    >>> keep_column = column_selector({'framewise_displacement', 'a_comp_cor_0[01]',
+    ...                                'trans_*'})
+    >>> [column for column in ['a_comp_cor_00', 'a_comp_cor_02', 'framewise_displacement',
+    ...                        'non_steady_state_outlier00', 'trans_x', 'rot_x']
+    ...  if keep_column(column)]
+    ['a_comp_cor_00', 'framewise_displacement', 'non_steady_state_outlier00', 'trans_x']
+    """
+    if columns is None:
+        return lambda column: True
+    patterns = [name for name in columns if WILDCARD.search(name)]
+
+    def keep_column(column):
+        return (column in columns or column.startswith(IMPLICIT_PREFIXES) or
+                any(fnmatch.fnmatchcase(column, pattern) for pattern in patterns))
+    return keep_column
+
+
+def _read_regressors(fname, keep_column, cache_dir=None):
+    """ Read the selected columns of a regressors file, through a cache if provided """
+    if cache_dir is None:
+        return pd.read_csv(fname, sep='\t', na_values='n/a', usecols=keep_column)
+
+    header = pd.read_csv(fname, sep='\t', nrows=0).columns
+    wanted = [col for col in header if keep_column(col)]
+
+    cache_file = os.path.join(cache_dir, 'regressors', _cache_key([fname]) + '.pkl')
+    cached = _read_cache(cache_file)
+    if cached is None:
+        cached = pd.DataFrame(index=pd.RangeIndex(0))
+    missing = [col for col in wanted if col not in cached.columns]
+    if missing:
+        new = pd.read_csv(fname, sep='\t', na_values='n/a', usecols=missing)
+        cached = new if cached.columns.empty else pd.concat([cached, new], axis=1)
+        _write_cache(cache_file, cached)
+    return cached[wanted]
+
+
+def _cache_key(files, **params):
+    """ Hash the paths, modification times and sizes of ``files``, and ``params`` """
+    from bids import __version__ as bids_version
+
+    stats = []
+    for fname in sorted(set(files)):
+        stat = os.stat(fname)
+        stats.append([fname, stat.st_mtime_ns, stat.st_size])
+    key = json.dumps([bids_version, stats, params], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _read_cache(fname):
+    try:
+        with open(fname, 'rb') as fobj:
+            return pickle.load(fobj)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _write_cache(fname, obj):
+    # Write to a temporary file first, as other processes may be reading the cache
+    dirname = os.path.dirname(fname)
+    os.makedirs(dirname, exist_ok=True)
+    with NamedTemporaryFile(dir=dirname, suffix='.tmp', delete=False) as fobj:
+        pickle.dump(obj, fobj, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(fobj.name, fname)
+
+
+def _load_subject_index(database_path, columns, skip_empty, cache_dir, kwargs):
+    from bids.layout import BIDSLayout
+    return load_run_index(BIDSLayout.load(database_path), columns, skip_empty, cache_dir,
+                          **kwargs)
+
+
+def _merge_indexes(indexes):
+    from bids.variables.entities import NodeIndex
+
+    merged = NodeIndex()
+    rows = []
+    for index in indexes:
+        offset = len(merged.nodes)
+        merged.nodes.extend(index.nodes)
+        if not index.index.empty:
+            rows.append(index.index.assign(
+                node_index=index.index['node_index'].astype(int) + offset))
+    if rows:
+        merged.index = pd.concat(rows, ignore_index=True, sort=False)
+    return merged
@@ -3,6 +3,7 @@ from pathlib import Path
 import jinja2
 import pkg_resources as pkgr
 from bids.layout import add_config_paths, BIDSLayout
+from bids.layout.writing import build_path
 
 from ..utils import snake_to_camel
 
@@ -113,9 +114,6 @@ def build_report_dict(deriv_dir, work_dir, analysis):
 
 
 def write_full_report(report_dict, run_context, deriv_dir):
-    fl_layout = BIDSLayout(
-        deriv_dir, config=['bids', 'derivatives', 'fitlins'])
-
     env = jinja2.Environment(
         loader=jinja2.FileSystemLoader(
             searchpath=pkgr.resource_filename('fitlins', '/')))
@@ -123,8 +121,6 @@ def write_full_report(report_dict, run_context, deriv_dir):
     tpl = env.get_template('data/full_report.tpl')
 
     model = snake_to_camel(report_dict['model']['name'])
-    target_file = op.join(
-        deriv_dir, fl_layout.build_path(
-            {'model': model}, PATH_PATTERNS, validate=False))
+    target_file = op.join(deriv_dir, build_path({'model': model}, PATH_PATTERNS))
     html = tpl.render(deroot({**report_dict, **run_context}, op.dirname(target_file)))
     Path(target_file).write_text(html)
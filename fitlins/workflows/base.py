@@ -6,15 +6,22 @@ def init_fitlins_wf(bids_dir, derivatives, out_dir, analysis_level, space,
                     desc=None, model=None, participants=None,
                     ignore=None, force_index=None,
                     smoothing=None, drop_missing=False,
-                    base_dir=None, name='fitlins_wf'):
+                    database_path=None, design_engine='nistats', estimator='nistats',
+                    max_node_mem=None, bold_cache=None, bold_cache_gb=None,
+                    precision='float64', shared_mask=False, validate_model=True,
+                    n_procs=1, subjects_per_loader=None, variable_cache=None,
+                    sampling_rate=None, base_dir=None, name='fitlins_wf'):
     from nipype.pipeline import engine as pe
     from nipype.interfaces import utility as niu
     from ..interfaces.bids import (
-        ModelSpecLoader, LoadBIDSModel, BIDSSelect, BIDSDataSink)
+        ModelSpecLoader, LoadBIDSModel, MergeModelShards, BIDSSelect, BIDSDataSink)
+    from ..interfaces.native import (
+        FirstLevelModel as NativeFirstLevelModel, SubjectMask, ValidateModel)
     from ..interfaces.nistats import DesignMatrix, FirstLevelModel, SecondLevelModel
     from ..interfaces.visualizations import (
         DesignPlot, DesignCorrelationPlot, ContrastMatrixPlot, GlassBrainPlot)
     from ..interfaces.utils import MergeAll, CollateWithMetadata
+    from ..utils.bids import format_patterns
 
     wf = pe.Workflow(name=name, base_dir=base_dir)
 
@@ -22,6 +29,8 @@ def init_fitlins_wf(bids_dir, derivatives, out_dir, analysis_level, space,
     specs = ModelSpecLoader(bids_dir=bids_dir)
     if model is not None:
         specs.inputs.model = model
+    if database_path is not None:
+        specs.inputs.database_path = database_path
 
     model_dict = specs.run().outputs.model_spec
     if not model_dict:
@@ -34,28 +43,58 @@ def init_fitlins_wf(bids_dir, derivatives, out_dir, analysis_level, space,
     # Load and run the model
     #
 
-    loader = pe.Node(
-        LoadBIDSModel(bids_dir=bids_dir,
-                      derivatives=derivatives,
-                      model=model_dict,
-                      selectors={'desc': desc,
-                                 'space': space}),
-        name='loader')
-
-    if ignore is not None:
-        loader.inputs.ignore = ignore
-    if force_index is not None:
-        loader.inputs.force_index = force_index
-    if participants is not None:
-        loader.inputs.selectors['subject'] = participants
-
-    # Select preprocessed BOLD series to analyze
-    getter = pe.Node(
-        BIDSSelect(
-            bids_dir=bids_dir, derivatives=derivatives,
-            selectors={'suffix': 'bold',
-                       'extension': ['nii.gz', 'nii', 'gii']}),
-        name='getter')
+    # All subjects are loaded at once by default. With ``subjects_per_loader``,
+    # subjects are loaded in shards, each feeding its own first-level nodes, so
+    # that the runs of a shard are validated, designed and fit as soon as it is
+    # loaded, while later shards are still loading.
+    shards = [participants]
+    if subjects_per_loader:
+        if participants is None:
+            from ..utils.bids import init_layout, collect_participants
+            participants = collect_participants(init_layout(
+                bids_dir, derivatives=derivatives, ignore=ignore,
+                force_index=force_index, database_path=database_path))
+        shards = [participants[ix:ix + subjects_per_loader]
+                  for ix in range(0, len(participants), subjects_per_loader)]
+
+    loaders = []
+    for ix, shard in enumerate(shards):
+        selectors = {'desc': desc, 'space': space}
+        if shard is not None:
+            selectors['subject'] = shard
+        shard_procs = n_procs if shard is None else min(n_procs, len(shard))
+        shard_loader = pe.Node(
+            LoadBIDSModel(bids_dir=bids_dir,
+                          derivatives=derivatives,
+                          model=model_dict,
+                          selectors=selectors,
+                          n_procs=shard_procs),
+            name='loader' if len(shards) == 1 else 'loader_{:d}'.format(ix),
+            n_procs=shard_procs)
+
+        # Patterns may be compiled regular expressions (see ``add_selector_patterns``)
+        if ignore is not None:
+            shard_loader.inputs.ignore = format_patterns(ignore)
+        if force_index is not None:
+            shard_loader.inputs.force_index = format_patterns(force_index)
+        if database_path is not None:
+            shard_loader.inputs.database_path = database_path
+        if variable_cache is not None:
+            shard_loader.inputs.variable_cache = variable_cache
+        if sampling_rate is not None:
+            shard_loader.inputs.sampling_rate = sampling_rate
+        loaders.append(shard_loader)
+
+    if len(loaders) == 1:
+        loader = loaders[0]
+    else:
+        loader = pe.Node(MergeModelShards(n_shards=len(loaders)),
+                         name='merge_loaders')
+        for ix, shard_loader in enumerate(loaders):
+            wf.connect(shard_loader, 'design_info', loader, 'design_info{:d}'.format(ix))
+            wf.connect(shard_loader, 'contrast_info', loader, 'contrast_info{:d}'.format(ix))
+            wf.connect(shard_loader, 'entities', loader, 'entities{:d}'.format(ix))
+            wf.connect(shard_loader, 'warnings', loader, 'warnings{:d}'.format(ix))
 
     if smoothing:
         smoothing_params = smoothing.split(':', 2)
@@ -84,25 +123,30 @@ def init_fitlins_wf(bids_dir, derivatives, out_dir, analysis_level, space,
                                              for step in model_dict['Steps']):
             raise ValueError(f"Invalid smoothing level {smoothing_level}")
 
-    design_matrix = pe.MapNode(
-        DesignMatrix(drop_missing=drop_missing),
-        iterfield=['session_info', 'bold_file'],
-        name='design_matrix')
-
-    l1_model = pe.MapNode(
-        FirstLevelModel(),
-        iterfield=['design_matrix', 'contrast_info', 'bold_file', 'mask_file'],
-        name='l1_model')
-
-    def _deindex(tsv):
+    def _design_tsv(design_matrix):
         from pathlib import Path
-        import pandas as pd
-        out_tsv = str(Path.cwd() / Path(tsv).name)
-        pd.read_csv(tsv, sep='\t', index_col=0).to_csv(out_tsv, sep='\t', index=False)
+        from fitlins.utils.design import load_design_matrix
+        out_tsv = str(Path.cwd() / Path(design_matrix).with_suffix('.tsv').name)
+        load_design_matrix(design_matrix).to_csv(out_tsv, sep='\t', index=False)
         return out_tsv
 
-    deindex_tsv = pe.MapNode(niu.Function(function=_deindex),
-                             iterfield=['tsv'], name='deindex_tsv')
+    def _group_runs(bold_files, mask_files, entities):
+        from collections import OrderedDict
+        groups = OrderedDict()
+        for ix, ents in enumerate(entities):
+            groups.setdefault((ents.get('subject'), ents.get('space')), []).append(ix)
+        runs = list(groups.values())
+        return ([[bold_files[ix] for ix in group] for group in runs],
+                [[mask_files[ix] for ix in group] for group in runs],
+                [[entities[ix] for ix in group] for group in runs],
+                runs)
+
+    def _ungroup_masks(mask_files, runs):
+        out_files = [None] * sum(len(group) for group in runs)
+        for group_masks, group in zip(mask_files, runs):
+            for mask_file, ix in zip(group_masks, group):
+                out_files[ix] = mask_file
+        return out_files
 
     # Set up common patterns
     image_pattern = 'reports/[sub-{subject}/][ses-{session}/]figures/[run-{run}/]' \
@@ -131,72 +175,211 @@ def init_fitlins_wf(bids_dir, derivatives, out_dir, analysis_level, space,
     reportlet_dir.mkdir(parents=True, exist_ok=True)
     snippet_pattern = '[sub-{subject}/][ses-{session}/][sub-{subject}_]' \
         '[ses-{session}_]task-{task}_[run-{run}_]snippet.html'
-    ds_model_warnings = pe.MapNode(
-        BIDSDataSink(base_directory=str(reportlet_dir),
-                     path_patterns=snippet_pattern),
-        iterfield=['entities', 'in_file'],
-        run_without_submitting=True,
-        name='ds_model_warning')
-
-    plot_design = pe.MapNode(
-        DesignPlot(image_type='svg'),
-        iterfield='data',
-        name='plot_design')
-
-    plot_corr = pe.MapNode(
-        DesignCorrelationPlot(image_type='svg'),
-        iterfield=['data', 'contrast_info'],
-        name='plot_corr')
-
-    plot_l1_contrast_matrix = pe.MapNode(
-        ContrastMatrixPlot(image_type='svg'),
-        iterfield=['data', 'contrast_info'],
-        name='plot_l1_contrast_matrix')
-
-    ds_design = pe.MapNode(
-        BIDSDataSink(base_directory=out_dir, fixed_entities={'suffix': 'design'},
-                     path_patterns=image_pattern),
-        iterfield=['entities', 'in_file'],
-        run_without_submitting=True,
-        name='ds_design')
-
-    ds_design_matrix = pe.MapNode(
-        BIDSDataSink(base_directory=out_dir, fixed_entities={'suffix': 'design'},
-                     path_patterns=design_matrix_pattern),
-        iterfield=['entities', 'in_file'],
-        run_without_submitting=True,
-        name='ds_design_matrix')
-
-    ds_corr = pe.MapNode(
-        BIDSDataSink(base_directory=out_dir, fixed_entities={'suffix': 'corr'},
-                     path_patterns=image_pattern),
-        iterfield=['entities', 'in_file'],
-        run_without_submitting=True,
-        name='ds_corr')
-
-    ds_l1_contrasts = pe.MapNode(
-        BIDSDataSink(base_directory=out_dir, fixed_entities={'suffix': 'contrasts'},
-                     path_patterns=image_pattern),
-        iterfield=['entities', 'in_file'],
-        run_without_submitting=True,
-        name='ds_l1_contrasts')
 
-    #
-    # General Connections
-    #
-    wf.connect([
-        (loader, ds_model_warnings, [('warnings', 'in_file')]),
-        (loader, design_matrix, [('design_info', 'session_info')]),
-        (getter, design_matrix, [('bold_files', 'bold_file')]),
-        (getter, l1_model, [('bold_files', 'bold_file'),
-                            ('mask_files', 'mask_file')]),
-        (design_matrix, l1_model, [('design_matrix', 'design_matrix')]),
-        (design_matrix, plot_design, [('design_matrix', 'data')]),
-        (design_matrix, plot_l1_contrast_matrix,  [('design_matrix', 'data')]),
-        (design_matrix, plot_corr,  [('design_matrix', 'data')]),
-        (design_matrix, deindex_tsv, [('design_matrix', 'tsv')]),
-        (deindex_tsv, ds_design_matrix, [('out', 'in_file')]),
-        ])
+    def init_first_level(loader, suffix=''):
+        """ Set up first-level nodes for the runs described by ``loader`` """
+        select_entities = pe.Node(
+            niu.Select(index=0),
+            name='select_l1_entities' + suffix,
+            run_without_submitting=True)
+
+        select_contrasts = pe.Node(
+            niu.Select(index=0),
+            name='select_l1_contrasts' + suffix,
+            run_without_submitting=True)
+
+        # Select preprocessed BOLD series to analyze
+        getter = pe.Node(
+            BIDSSelect(
+                bids_dir=bids_dir, derivatives=derivatives,
+                selectors={'suffix': 'bold',
+                           'extension': ['nii.gz', 'nii', 'gii']}),
+            name='getter' + suffix)
+
+        if database_path is not None:
+            getter.inputs.database_path = database_path
+
+        # Check the model against all runs (of this shard) before building or
+        # fitting designs, unless disabled
+        info_source = getter
+        if validate_model:
+            info_source = pe.Node(
+                ValidateModel(drop_missing=drop_missing),
+                name='validate_model' + suffix)
+            wf.connect(getter, 'design_info', info_source, 'design_info')
+            wf.connect(getter, 'bold_files', info_source, 'bold_file')
+
+        if design_engine in ('native', 'native-tr'):
+            from ..interfaces.native import DesignMatrix as BatchDesignMatrix
+            design_matrix = pe.Node(
+                BatchDesignMatrix(drop_missing=drop_missing,
+                                  tr_grid=(design_engine == 'native-tr')),
+                name='design_matrix' + suffix)
+        else:
+            design_matrix = pe.MapNode(
+                DesignMatrix(drop_missing=drop_missing),
+                iterfield=['session_info', 'bold_file'],
+                name='design_matrix' + suffix)
+
+        # Fits stream BOLD series within the memory budget, which the
+        # scheduler uses to run as many as fit in memory
+        l1_mem = {} if max_node_mem is None else {'mem_gb': max_node_mem}
+        l1_model = pe.MapNode(
+            NativeFirstLevelModel() if estimator == 'native' else FirstLevelModel(),
+            iterfield=['session_info', 'design_matrix', 'contrast_info', 'bold_file', 'mask_file'],
+            name='l1_model' + suffix, **l1_mem)
+        l1_model.inputs.precision = precision
+        if max_node_mem is not None:
+            l1_model.inputs.max_mem_gb = max_node_mem
+        if bold_cache is not None:
+            l1_model.inputs.bold_cache = bold_cache
+            if bold_cache_gb is not None:
+                l1_model.inputs.bold_cache_gb = bold_cache_gb
+
+        # Design matrices are passed between nodes as NumPy archives, and only
+        # written as TSV files for the derivatives
+        design_tsv = pe.MapNode(niu.Function(function=_design_tsv),
+                                iterfield=['design_matrix'], name='design_tsv' + suffix)
+
+        ds_model_warnings = pe.MapNode(
+            BIDSDataSink(base_directory=str(reportlet_dir),
+                         path_patterns=snippet_pattern),
+            iterfield=['entities', 'in_file'],
+            run_without_submitting=True,
+            name='ds_model_warning' + suffix)
+
+        plot_design = pe.MapNode(
+            DesignPlot(image_type='svg'),
+            iterfield='data',
+            name='plot_design' + suffix)
+
+        plot_corr = pe.MapNode(
+            DesignCorrelationPlot(image_type='svg'),
+            iterfield=['data', 'contrast_info', 'session_info'],
+            name='plot_corr' + suffix)
+
+        plot_l1_contrast_matrix = pe.MapNode(
+            ContrastMatrixPlot(image_type='svg'),
+            iterfield=['data', 'contrast_info', 'session_info'],
+            name='plot_l1_contrast_matrix' + suffix)
+
+        ds_design = pe.MapNode(
+            BIDSDataSink(base_directory=out_dir, fixed_entities={'suffix': 'design'},
+                         path_patterns=image_pattern),
+            iterfield=['entities', 'in_file'],
+            run_without_submitting=True,
+            name='ds_design' + suffix)
+
+        ds_design_matrix = pe.MapNode(
+            BIDSDataSink(base_directory=out_dir, fixed_entities={'suffix': 'design'},
+                         path_patterns=design_matrix_pattern),
+            iterfield=['entities', 'in_file'],
+            run_without_submitting=True,
+            name='ds_design_matrix' + suffix)
+
+        ds_corr = pe.MapNode(
+            BIDSDataSink(base_directory=out_dir, fixed_entities={'suffix': 'corr'},
+                         path_patterns=image_pattern),
+            iterfield=['entities', 'in_file'],
+            run_without_submitting=True,
+            name='ds_corr' + suffix)
+
+        ds_l1_contrasts = pe.MapNode(
+            BIDSDataSink(base_directory=out_dir, fixed_entities={'suffix': 'contrasts'},
+                         path_patterns=image_pattern),
+            iterfield=['entities', 'in_file'],
+            run_without_submitting=True,
+            name='ds_l1_contrasts' + suffix)
+
+        #
+        # General Connections
+        #
+        wf.connect([
+            (loader, ds_model_warnings, [('warnings', 'in_file')]),
+            (loader, getter, [('design_info', 'design_info')]),
+            (info_source, design_matrix, [('design_info', 'session_info')]),
+            (getter, design_matrix, [('bold_files', 'bold_file')]),
+            (info_source, l1_model, [('design_info', 'session_info')]),
+            (info_source, plot_l1_contrast_matrix, [('design_info', 'session_info')]),
+            (info_source, plot_corr, [('design_info', 'session_info')]),
+            (getter, l1_model, [('bold_files', 'bold_file')]),
+            (design_matrix, l1_model, [('design_matrix', 'design_matrix')]),
+            (design_matrix, plot_design, [('design_matrix', 'data')]),
+            (design_matrix, plot_l1_contrast_matrix,  [('design_matrix', 'data')]),
+            (design_matrix, plot_corr,  [('design_matrix', 'data')]),
+            (design_matrix, design_tsv, [('design_matrix', 'design_matrix')]),
+            (design_tsv, ds_design_matrix, [('out', 'in_file')]),
+            (loader, select_contrasts, [('contrast_info', 'inlist')]),
+            (select_contrasts, l1_model,  [('out', 'contrast_info')]),
+            (loader, select_entities, [('entities', 'inlist')]),
+            (select_entities, getter,  [('out', 'entities')]),
+            (select_entities, ds_model_warnings,  [('out', 'entities')]),
+            (select_entities, ds_design, [('out', 'entities')]),
+            (select_entities, ds_design_matrix, [('out', 'entities')]),
+            (plot_design, ds_design, [('figure', 'in_file')]),
+            (select_contrasts, plot_l1_contrast_matrix,  [('out', 'contrast_info')]),
+            (select_contrasts, plot_corr,  [('out', 'contrast_info')]),
+            (select_entities, ds_l1_contrasts, [('out', 'entities')]),
+            (select_entities, ds_corr, [('out', 'entities')]),
+            (plot_l1_contrast_matrix, ds_l1_contrasts,  [('figure', 'in_file')]),
+            (plot_corr, ds_corr,  [('figure', 'in_file')]),
+            ])
+
+        if shared_mask:
+            # Masks are intersected or computed once per subject and space, and
+            # subjects are processed in parallel
+            group_runs = pe.Node(
+                niu.Function(function=_group_runs,
+                             output_names=['bold_files', 'mask_files', 'entities', 'runs']),
+                name='group_runs' + suffix,
+                run_without_submitting=True)
+            subject_mask = pe.MapNode(SubjectMask(),
+                                      iterfield=['bold_file', 'mask_file', 'entities'],
+                                      name='subject_mask' + suffix, **l1_mem)
+            if max_node_mem is not None:
+                subject_mask.inputs.max_mem_gb = max_node_mem
+            ungroup_masks = pe.Node(
+                niu.Function(function=_ungroup_masks, output_names=['mask_files']),
+                name='ungroup_masks' + suffix,
+                run_without_submitting=True)
+            wf.connect([
+                (getter, group_runs, [('bold_files', 'bold_files'),
+                                      ('mask_files', 'mask_files'),
+                                      ('entities', 'entities')]),
+                (group_runs, subject_mask, [('bold_files', 'bold_file'),
+                                            ('mask_files', 'mask_file'),
+                                            ('entities', 'entities')]),
+                (group_runs, ungroup_masks, [('runs', 'runs')]),
+                (subject_mask, ungroup_masks, [('mask_file', 'mask_files')]),
+                (ungroup_masks, l1_model, [('mask_files', 'mask_file')]),
+            ])
+        else:
+            wf.connect(getter, 'mask_files', l1_model, 'mask_file')
+
+        if smoothing and smoothing_level in (model_dict['Steps'][0]['Level'], 'l1'):
+            l1_model.inputs.smoothing_fwhm = smoothing_fwhm
+
+        return l1_model
+
+    if len(loaders) == 1:
+        l1_model = init_first_level(loader)
+    else:
+        # Each shard is validated, designed and fit as soon as it is loaded, so
+        # problems are reported for one shard at a time
+        l1_models = [init_first_level(shard_loader, '_{:d}'.format(ix))
+                     for ix, shard_loader in enumerate(loaders)]
+
+        # Higher levels see the runs of all shards, in order
+        l1_fields = ['effect_maps', 'variance_maps', 'stat_maps', 'zscore_maps',
+                     'pvalue_maps', 'contrast_metadata']
+        l1_model = pe.Node(niu.IdentityInterface(fields=l1_fields), name='l1_model')
+        for field in l1_fields:
+            merge_field = pe.Node(niu.Merge(len(l1_models)),
+                                  name='merge_l1_{}'.format(field),
+                                  run_without_submitting=True)
+            for ix, shard_model in enumerate(l1_models):
+                wf.connect(shard_model, field, merge_field, 'in{:d}'.format(ix + 1))
+            wf.connect(merge_field, 'out', l1_model, field)
 
     stage = None
     model = l1_model
@@ -210,18 +393,6 @@ def init_fitlins_wf(bids_dir, derivatives, out_dir, analysis_level, space,
 
         level = 'l{:d}'.format(ix + 1)
 
-        # TODO: No longer used at higher level, suggesting we can simply return
-        # entities from loader as a single list
-        select_entities = pe.Node(
-            niu.Select(index=ix),
-            name='select_{}_entities'.format(level),
-            run_without_submitting=True)
-
-        select_contrasts = pe.Node(
-            niu.Select(index=ix),
-            name='select_{}_contrasts'.format(level),
-            run_without_submitting=True)
-
         # Squash the results of MapNodes that may have generated multiple maps
         # into single lists.
         # Do the same with corresponding metadata - interface will complain if shapes mismatch
@@ -268,26 +439,17 @@ def init_fitlins_wf(bids_dir, derivatives, out_dir, analysis_level, space,
             run_without_submitting=True,
             name='ds_{}_contrast_plots'.format(level))
 
-        if ix == 0:
-            wf.connect([
-                (loader, select_entities, [('entities', 'inlist')]),
-                (select_entities, getter,  [('out', 'entities')]),
-                (select_entities, ds_model_warnings,  [('out', 'entities')]),
-                (select_entities, ds_design, [('out', 'entities')]),
-                (select_entities, ds_design_matrix, [('out', 'entities')]),
-                (plot_design, ds_design, [('figure', 'in_file')]),
-                (select_contrasts, plot_l1_contrast_matrix,  [('out', 'contrast_info')]),
-                (select_contrasts, plot_corr,  [('out', 'contrast_info')]),
-                (select_entities, ds_l1_contrasts, [('out', 'entities')]),
-                (select_entities, ds_corr, [('out', 'entities')]),
-                (plot_l1_contrast_matrix, ds_l1_contrasts,  [('figure', 'in_file')]),
-                (plot_corr, ds_corr,  [('figure', 'in_file')]),
-            ])
-
         #  Set up higher levels
-        else:
+        if ix > 0:
+            select_contrasts = pe.Node(
+                niu.Select(index=ix),
+                name='select_{}_contrasts'.format(level),
+                run_without_submitting=True)
+
+            # Higher-level models are estimated in double precision; ``precision``
+            # only sets the data type of the maps they write
             model = pe.MapNode(
-                SecondLevelModel(),
+                SecondLevelModel(precision=precision),
                 iterfield=['contrast_info'],
                 name='{}_model'.format(level))
 
@@ -295,14 +457,14 @@ def init_fitlins_wf(bids_dir, derivatives, out_dir, analysis_level, space,
                 (stage, model, [('effect_maps', 'effect_maps'),
                                 ('variance_maps', 'variance_maps'),
                                 ('contrast_metadata', 'stat_metadata')]),
+                (loader, select_contrasts, [('contrast_info', 'inlist')]),
+                (select_contrasts, model,  [('out', 'contrast_info')]),
             ])
 
-        if smoothing and smoothing_level in (step, level):
-            model.inputs.smoothing_fwhm = smoothing_fwhm
+            if smoothing and smoothing_level in (step, level):
+                model.inputs.smoothing_fwhm = smoothing_fwhm
 
         wf.connect([
-            (loader, select_contrasts, [('contrast_info', 'inlist')]),
-            (select_contrasts, model,  [('out', 'contrast_info')]),
             (model, collate, [('effect_maps', 'effect_maps'),
                               ('variance_maps', 'variance_maps'),
                               ('stat_maps', 'stat_maps'),